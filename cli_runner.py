@@ -1,9 +1,13 @@
 ﻿# cli_runner.py
 # 这个文件是命令行版本 (.exe) 的主入口。
 
+import multiprocessing
+
 # 从您的项目中导入CLI主函数
 from cotton_toolkit.cli import cli
 
 if __name__ == "__main__":
+    # 打包版本中，进程池的子进程会重新执行入口文件，必须先交给 freeze_support 处理
+    multiprocessing.freeze_support()
     # 执行CLI主函数
     cli()
\ No newline at end of file
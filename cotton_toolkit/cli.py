@@ -16,7 +16,8 @@ from .pipelines import (
     run_download_pipeline,
     run_homology_mapping,
     run_ai_task, run_gff_lookup, run_functional_annotation, run_preprocess_annotation_files, run_enrichment_pipeline,
-    run_locus_conversion, run_xlsx_to_csv,
+    run_batch_enrichment_pipeline, read_gene_list_dir,
+    run_locus_conversion, run_xlsx_to_csv, run_build_bridge_maps, run_bsa_analysis,
 )
 from .config.loader import load_config, generate_default_config_files, MainConfig, get_genome_data_sources, \
     check_annotation_file_status
@@ -181,12 +182,17 @@ def homology(ctx, genes, region, source_asm, target_asm, output_csv, top_n, eval
 @click.option('--prompt', help=_("自定义提示词模板。必须包含 {text}。"))
 @click.option('--temperature', type=float, help=_("控制模型输出的随机性。"))
 @click.option('--use-ai-proxy', is_flag=True, help=_("为本次AI任务强制使用代理（覆盖配置）。"))
+@click.option('--rows-per-request', type=int, help=_("每个AI请求打包的最大行数（覆盖配置），1 表示逐行请求。"))
+@click.option('--chunk-rows', type=int, help=_("流式处理的分块行数（覆盖配置），启用后可在中断后断点续跑。"))
 @click.pass_context
-def ai_task(ctx, input_file, source_column, new_column, output_file, task_type, prompt, temperature, use_ai_proxy):
+def ai_task(ctx, input_file, source_column, new_column, output_file, task_type, prompt, temperature, use_ai_proxy,
+            rows_per_request, chunk_rows):
     """在CSV文件上运行批量AI任务。"""
     cli_overrides = {
         "temperature": temperature,
-        "use_proxy_for_ai": use_ai_proxy
+        "use_proxy_for_ai": use_ai_proxy,
+        "max_rows_per_request": rows_per_request,
+        "chunk_rows": chunk_rows
     }
     with click.progressbar(length=100, label=_("准备AI任务...").ljust(40)) as bar:
         run_ai_task(
@@ -238,6 +244,45 @@ def gff_query(ctx, assembly_id, genes, region, output_csv):
     else:
         click.echo(_("GFF查询任务失败或无结果。"), err=True)
 
+@cli.command('bsa')
+@click.option('--vcf', required=True, type=click.Path(exists=True, dir_okay=False),
+              help=_("包含两个混池的VCF文件（支持 bgzip 压缩），需含 AD 字段。"))
+@click.option('--pool1', help=_("混池1（通常为野生型/高值混池）的样本名。默认为VCF中的第一个样本。"))
+@click.option('--pool2', help=_("混池2（通常为突变型/低值混池）的样本名。默认为VCF中的第二个样本。"))
+@click.option('--assembly-id', help=_("【可选】用于注释候选区域基因的基因组版本ID。"))
+@click.option('--output-dir', type=click.Path(file_okay=False), help=_("结果输出目录。默认为配置中的目录。"))
+@click.option('--window-size', type=int, help=_("滑动窗口大小（bp，覆盖配置）。"))
+@click.option('--step-size', type=int, help=_("滑动步长（bp，覆盖配置）。"))
+@click.option('--min-depth', type=int, help=_("每个混池的最小读深（覆盖配置）。"))
+@click.option('--min-snp-ratio', type=float, help=_("位点过滤：两个混池的 SNP-index 都低于该值的位点不参与计算，默认 0.3（覆盖配置）。"))
+@click.option('--threshold', type=float, help=_("候选区域的 |Δ(SNP-index)| 阈值（覆盖配置）。"))
+@click.option('--workers', type=int, help=_("并行计算的进程数（覆盖配置）。"))
+@click.pass_context
+def bsa(ctx, vcf, pool1, pool2, assembly_id, output_dir, window_size, step_size, min_depth, min_snp_ratio, threshold,
+        workers):
+    """混池分离分析（BSA）：计算滑动窗口 Δ(SNP-index) 并定位候选区域。"""
+    cli_overrides = {
+        "window_size": window_size,
+        "step_size": step_size,
+        "min_depth": min_depth,
+        "min_snp_ratio": min_snp_ratio,
+        "delta_threshold": threshold,
+        "max_workers": workers
+    }
+    with click.progressbar(length=100, label=_("准备BSA分析...").ljust(40)) as bar:
+        success = run_bsa_analysis(
+            config=ctx.obj.config, vcf_path=vcf, assembly_id=assembly_id,
+            pool1_sample=pool1, pool2_sample=pool2, output_dir=output_dir, cli_overrides=cli_overrides,
+            status_callback=lambda msg, level: click.echo(f"[{level}] {msg}", err=True),
+            progress_callback=_create_cli_progress_callback(bar),
+            cancel_event=ctx.obj.cancel_event
+        )
+
+    if success:
+        click.echo(_("BSA分析任务成功完成。"))
+    else:
+        click.echo(_("BSA分析任务失败或被取消。"), err=True)
+
 @cli.command('locus-convert')
 @click.option('--source-asm', required=True, help=_("源基因组版本ID。"))
 @click.option('--target-asm', required=True, help=_("目标基因组版本ID。"))
@@ -267,6 +312,26 @@ def locus_convert(ctx, source_asm, target_asm, region, output_csv):
         click.secho(_("位点转换失败。请查看日志获取详情。"), fg='red')
         raise click.Abort()
 
+@cli.command('build-bridge-maps')
+@click.option('--source-asm', help=_("源基因组版本ID列表，以逗号分隔。默认为全部。"))
+@click.option('--target-asm', help=_("目标基因组版本ID列表，以逗号分隔。默认为全部。"))
+@click.option('--force', is_flag=True, help=_("即使映射表已是最新也强制重建。"))
+@click.pass_context
+def build_bridge_maps(ctx, source_asm, target_asm, force):
+    """预计算基因组间经由拟南芥桥梁的同源映射表，加速同源映射与位点转换。"""
+    with click.progressbar(length=100, label=_("准备预计算映射表...").ljust(40)) as bar:
+        success = run_build_bridge_maps(
+            config=ctx.obj.config,
+            source_assembly_ids=source_asm.split(',') if source_asm else None,
+            target_assembly_ids=target_asm.split(',') if target_asm else None,
+            force=force,
+            status_callback=lambda msg, level: click.echo(f"[{level}] {msg}", err=True),
+            progress_callback=_create_cli_progress_callback(bar),
+            cancel_event=ctx.obj.cancel_event
+        )
+    if not success:
+        raise click.Abort()
+
 @cli.command('xlsx-to-csv')
 @click.option('--input-excel', required=True, type=click.Path(exists=True, dir_okay=False), help=_("输入的Excel (.xlsx) 文件路径。"))
 @click.option('--output-csv', required=True, type=click.Path(), help=_("输出的CSV文件路径。"))
@@ -358,19 +423,59 @@ def annotate(ctx, genes, assembly_id, types, output_path):
         )
 
 @cli.command('enrich')
-@click.option('--genes', required=True, help=_("要进行富集分析的基因ID列表 (逗号分隔), 或包含基因列表的文件路径。"))
+@click.option('--genes', help=_("要进行富集分析的基因ID列表 (逗号分隔), 或包含基因列表的文件路径。"))
+@click.option('--gene-lists', type=click.Path(exists=True, file_okay=False), help=_("批量模式: 包含多个基因列表文件的目录，每个文件作为一个基因集。"))
+@click.option('--workers', type=int, help=_("批量模式下的并行进程数。默认为CPU核心数减一。"))
+@click.option('--plot-workers', type=int, help=_("并行绘制图表的进程数。默认为CPU核心数。"))
+@click.option('--cnet-layout', type=click.Choice(['auto', 'spring', 'grouped']), default='auto', show_default=True,
+              help=_("网络图(Cnet)的布局方式。grouped 适合包含上千个基因的大网络。"))
 @click.option('--assembly-id', required=True, help=_("基因ID所属的基因组版本。"))
 @click.option('--analysis-type', type=click.Choice(['go', 'kegg'], case_sensitive=False), default='go', show_default=True, help=_("富集分析的类型。"))
 @click.option('--output-dir', required=True, type=click.Path(file_okay=False), help=_("富集结果和图表的输出目录。"))
 @click.option('--plot-types', default='bubble,bar', show_default=True, help=_("要生成的图表类型, 逗号分隔 (可选: bubble, bar, upset, cnet)。"))
 @click.option('--top-n', type=int, default=20, show_default=True, help=_("在图表中显示的前N个富集条目。"))
 @click.option('--collapse-transcripts', is_flag=True, default=False, show_default=True, help=_("将转录本ID合并为其父基因ID进行分析。"))
+@click.option('--no-matching-report', is_flag=True, default=False, help=_("不生成基因匹配报告 (gene_matching_report.csv)，只输出统计结果。"))
 @click.pass_context
-def enrich(ctx, genes, assembly_id, analysis_type, output_dir, plot_types, top_n, collapse_transcripts):
-    """对基因列表进行GO或KEGG富集分析并生成图表。"""
+def enrich(ctx, genes, gene_lists, workers, plot_workers, cnet_layout, assembly_id, analysis_type, output_dir, plot_types, top_n,
+           collapse_transcripts, no_matching_report):
+    """对基因列表进行GO或KEGG富集分析并生成图表。使用 --gene-lists 时对目录中的所有基因列表批量分析（不生成图表）。"""
     config = ctx.obj.config
     cancel_event = ctx.obj.cancel_event
 
+    if bool(genes) == bool(gene_lists):
+        raise click.UsageError(_("错误: 必须且只能提供 --genes 或 --gene-lists 其中之一。"))
+
+    if gene_lists:
+        try:
+            study_sets = read_gene_list_dir(gene_lists)
+        except Exception as e:
+            raise click.UsageError(_("读取基因列表目录失败: {}").format(e))
+        if not study_sets:
+            raise click.UsageError(_("错误: 目录中没有找到任何基因列表文件。"))
+        click.echo(_("共找到 {} 个基因列表用于批量分析。").format(len(study_sets)))
+
+        with click.progressbar(length=100, label=_("准备批量富集分析...").ljust(40)) as bar:
+            result_df = run_batch_enrichment_pipeline(
+                config=config,
+                assembly_id=assembly_id,
+                study_sets=study_sets,
+                analysis_type=analysis_type,
+                output_dir=output_dir,
+                collapse_transcripts=collapse_transcripts,
+                max_workers=workers,
+                status_callback=lambda msg, level="INFO": click.echo(f"[{level.upper()}] {msg}", err=True),
+                progress_callback=_create_cli_progress_callback(bar),
+                cancel_event=cancel_event
+            )
+        if result_df is None:
+            click.secho(_("批量富集分析失败或被取消。"), fg='red', err=True)
+        elif result_df.empty:
+            click.secho(_("批量富集分析执行完毕，但没有产生任何结果。"), fg='yellow')
+        else:
+            click.secho(_("批量富集分析执行完毕。结果已保存至: {}").format(output_dir), fg='green')
+        return
+
     gene_ids_list = []
     if os.path.exists(genes):
         click.echo(_("从文件读取基因列表: {}").format(genes))
@@ -397,6 +502,9 @@ def enrich(ctx, genes, assembly_id, analysis_type, output_dir, plot_types, top_n
             output_dir=output_dir,
             top_n=top_n,
             collapse_transcripts=collapse_transcripts,
+            plot_workers=plot_workers,
+            cnet_layout=cnet_layout,
+            write_matching_report=not no_matching_report,
             status_callback=lambda msg, level: click.echo(f"[{level.upper()}] {msg}", err=True),
             progress_callback=_create_cli_progress_callback(bar),
             cancel_event=cancel_event
@@ -426,15 +534,17 @@ def status(ctx):
                 click.secho(file_status, fg=status_colors.get(file_status, 'white'))
 
 @cli.command('preprocess-annos')
+@click.option('--workers', type=int, default=None, help=_("并行转换的进程数。默认为 CPU 核数减一。"))
 @click.pass_context
-def preprocess_annos(ctx):
+def preprocess_annos(ctx, workers):
     """预处理所有已下载的注释文件，转换为标准的CSV格式。"""
     with click.progressbar(length=100, label=_("准备预处理...").ljust(40)) as bar:
         run_preprocess_annotation_files(
             config=ctx.obj.config,
             status_callback=lambda msg, level: click.echo(f"[{level}] {msg}", err=True),
             progress_callback=_create_cli_progress_callback(bar),
-            cancel_event=ctx.obj.cancel_event
+            cancel_event=ctx.obj.cancel_event,
+            max_workers=workers
         )
 
 @cli.command('test-ai')
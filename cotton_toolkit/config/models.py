@@ -15,6 +15,14 @@ class ProviderConfig(BaseModel):
     model: str = "default-model"
     base_url: Optional[str] = None
     available_models: Optional[str] = None
+    # 速率限制，None 表示不限：每分钟请求数、每分钟 token 数（按提示词长度估算）
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    # 同时进行的最大请求数，None 表示使用 batch_ai_processor.max_workers；被限流时会自动降低
+    max_concurrency: Optional[int] = None
+    # 同一服务商的其他 API Key 与该服务商在服务池中的权重（见 AIServicesConfig.pool_providers）
+    extra_api_keys: List[str] = Field(default_factory=list)
+    pool_weight: float = 1.0
 
 
 class DownloaderConfig(BaseModel):
@@ -23,15 +31,21 @@ class DownloaderConfig(BaseModel):
     download_output_base_dir: str = "genomes"
     force_download :bool = False
     use_proxy_for_download :bool = False
+    max_retries: int = 5
+    segments_per_file: int = 4
+    segment_min_size_mb: int = 64
 
 class LocusConversionConfig(BaseModel):
     output_dir_name: str = "locus_conversion_results"
     gff_db_storage_dir: str = "gff_databases_cache"
+    bridge_map_storage_dir: str = "bridge_maps_cache"
 
 
 class AIServicesConfig(BaseModel):
     default_provider: str = "google"
     use_proxy_for_ai: bool = False
+    # 批量AI任务同时使用的服务商；为空时只使用默认服务商（若其配置了多个 API Key，则在这些 Key 之间分配请求）
+    pool_providers: List[str] = Field(default_factory=list)
     providers: Dict[str, ProviderConfig] = Field(default_factory=lambda: AIServicesConfig._default_providers())
 
     @staticmethod
@@ -97,7 +111,12 @@ class BSAAnalyzerConfig(BaseModel):
     window_size: int = 1000000
     step_size: int = 100000
     min_depth: int = 5
-    min_snp_ratio: float = 0.8
+    # 位点过滤（SNP-index 下限）：两个混池的 SNP-index 都低于该值的位点不参与计算。
+    # 默认 0.3 为 QTL-seq 的常规过滤；取值过高会只剩极端位点，使大部分窗口没有数据、候选区域被拉宽
+    min_snp_ratio: float = 0.3
+    min_snps_per_window: int = 10
+    # 候选区域阈值：窗口 |Δ(SNP-index)| 不低于该值（F2 群体中主效位点约为 0.67）
+    delta_threshold: float = 0.5
 
 class ArabidopsisAnalyzerConfig(BaseModel):
     output_dir_name: str = "arabidopsis_homology_results"
@@ -108,8 +127,16 @@ class BatchAIProcessorConfig(BaseModel):
     max_tokens: int = 4096
     max_workers: int = 4
     max_retries: int = 3
+    # 每个请求最多打包的行数，1 表示逐行请求；打包时每个请求的输入与预计输出之和不超过 max_tokens
+    max_rows_per_request: int = 1
+    # 流式处理时每块的行数，0 表示一次读入整个文件；大于 0 时逐块写出结果并支持断点续跑
+    chunk_rows: int = 0
     output_dir_name: str = "ai_processed_results"
     prompt_template_file: str = "prompt_template.txt"
+    # 全局AI结果缓存（相对路径以配置文件所在目录为基准），超过大小上限时淘汰最久未用的条目；ttl 为 None 表示永不过期
+    cache_dir: str = "ai_cache"
+    cache_size_limit_mb: int = 512
+    cache_ttl_days: Optional[float] = 30
 
 class HomologySelectionCriteria(BaseModel):
     sort_by: List[str] = Field(default_factory=lambda: HomologySelectionCriteria._default_sort_by())
@@ -0,0 +1,278 @@
+﻿# cotton_toolkit/core/ai_engine.py
+
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional, Callable, Any, Tuple
+
+from .ai_wrapper import AIWrapper, AIServiceError, AIRateLimitError
+
+# --- 国际化和日志设置 ---
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.ai_engine")
+
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_MAX_RETRIES = 3
+BACKOFF_FACTOR = 2.0
+MAX_BACKOFF_SECONDS = 60.0
+# 被限流后并发数减半；此后每连续成功这么多次，并发数加一，直到配置的上限
+CONCURRENCY_INCREASE_AFTER = 10
+# 估算 token 数时按每个 token 约 4 个字符计算
+CHARS_PER_TOKEN = 4
+# 这些 4xx 状态码表示请求可以原样重试，其余 4xx（鉴权失败、参数错误等）重试也不会成功
+RETRYABLE_CLIENT_STATUS_CODES = {408, 409, 425, 429}
+
+
+class AICancelled(Exception):
+    """AI 请求在等待限流或重试期间被用户取消。"""
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    status_code = getattr(error, 'status_code', None)
+    return status_code is None or status_code >= 500 or status_code in RETRYABLE_CLIENT_STATUS_CODES
+
+
+def cancellable_sleep(seconds: float, stop_check: Callable[[], bool]):
+    """分段睡眠，期间 stop_check() 为真时抛出 AICancelled。"""
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        if stop_check():
+            raise AICancelled()
+        time.sleep(min(0.2, max(0.0, deadline - time.monotonic())))
+
+
+def run_concurrently(process: Callable[..., str], texts: List[str], prompt_template: str, max_workers: int,
+                     cancel_event: Optional[threading.Event] = None,
+                     on_result: Optional[Callable[[int, Any], None]] = None, **kwargs) -> List[Any]:
+    """
+    用线程池对每条文本调用 process(text, prompt_template, cancel_event, **kwargs)，返回与输入顺序一致的结果列表；
+    单条失败时该位置为对应的异常对象。on_result(序号, 结果或异常) 在每条完成时于调用线程中回调。
+    """
+    results: List[Any] = [None] * len(texts)
+    with ThreadPoolExecutor(max_workers=min(max_workers, max(1, len(texts)))) as executor:
+        future_to_index = {executor.submit(process, text, prompt_template, cancel_event, **kwargs): i
+                           for i, text in enumerate(texts)}
+        for future in as_completed(future_to_index):
+            index = future_to_index[future]
+            try:
+                results[index] = future.result()
+            except Exception as e:
+                results[index] = e
+            if on_result:
+                on_result(index, results[index])
+    return results
+
+
+class TokenBucket:
+    """
+    按分钟配额的令牌桶：容量等于每分钟配额，令牌以 配额/60 每秒的速度匀速补充。
+    采用预约方式扣除令牌（余额可以为负），返回调用方需要等待的秒数，先到的请求先得到配额。
+    """
+
+    def __init__(self, per_minute: Optional[float]):
+        self.capacity = float(per_minute) if per_minute and per_minute > 0 else None
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def available_fraction(self) -> float:
+        """当前剩余配额占整桶容量的比例（不限速时为 1）。"""
+        if self.capacity is None:
+            return 1.0
+        with self._lock:
+            tokens = min(self.capacity, self.tokens + (time.monotonic() - self._updated) * self.capacity / 60.0)
+        return max(0.0, tokens / self.capacity)
+
+    def reserve(self, amount: float = 1.0) -> float:
+        if self.capacity is None:
+            return 0.0
+        fill_rate = self.capacity / 60.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * fill_rate)
+            self._updated = now
+            # 单个请求超过整桶容量时按整桶计算，否则它永远等不到配额
+            self.tokens -= min(amount, self.capacity)
+            return max(0.0, -self.tokens / fill_rate)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    自适应并发限制：遇到限流时并发上限减半（至少为 1），之后连续成功若干次再逐步加一，
+    即“加性增、乘性减”，在不触发限流的前提下尽量用满服务商允许的吞吐量。
+    """
+
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max(1, max_concurrency)
+        self.limit = self.max_concurrency
+        self._active = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, stop_check: Callable[[], bool]):
+        with self._condition:
+            while self._active >= self.limit:
+                if stop_check():
+                    raise AICancelled()
+                self._condition.wait(0.2)
+            self._active += 1
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= CONCURRENCY_INCREASE_AFTER and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify()
+
+    def free_fraction(self) -> float:
+        with self._condition:
+            return max(0, self.limit - self._active) / self.max_concurrency
+
+    def on_rate_limited(self) -> int:
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+            return self.limit
+
+
+class AIExecutionEngine:
+    """
+    AI 请求的并发执行引擎：在 AIWrapper 外层统一实现
+    - 每分钟请求数与每分钟 token 数两个令牌桶限流；
+    - 根据 429 响应自动降低并发，并遵守服务商返回的 Retry-After（期间所有请求一起暂停）；
+    - 带随机抖动的指数退避重试；
+    - 等待期间随时响应取消。
+    同一个引擎可以被多个线程同时调用。
+    """
+
+    def __init__(
+            self,
+            client: AIWrapper,
+            max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+            requests_per_minute: Optional[int] = None,
+            tokens_per_minute: Optional[int] = None,
+            max_retries: int = DEFAULT_MAX_RETRIES,
+            backoff_factor: float = BACKOFF_FACTOR,
+            status_callback: Optional[Callable[[str, str], None]] = None
+    ):
+        self.client = client
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max(0, max_retries)
+        self.backoff_factor = backoff_factor
+        self.log = status_callback if status_callback else lambda msg, level="INFO": logger.info(f"[{level}] {msg}")
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrencyLimiter(self.max_concurrency)
+        self._paused_until = 0.0
+        self._pause_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, client: AIWrapper, provider_config: Any, batch_config: Any,
+                    status_callback: Optional[Callable[[str, str], None]] = None) -> 'AIExecutionEngine':
+        """由服务商配置（限流参数）与批处理配置（默认并发数、重试次数）创建引擎。"""
+        max_concurrency = getattr(provider_config, 'max_concurrency', None) or batch_config.max_workers
+        return cls(client,
+                   max_concurrency=max_concurrency,
+                   requests_per_minute=getattr(provider_config, 'requests_per_minute', None),
+                   tokens_per_minute=getattr(provider_config, 'tokens_per_minute', None),
+                   max_retries=batch_config.max_retries,
+                   status_callback=status_callback)
+
+    @property
+    def cache_identity(self) -> Tuple[str, str]:
+        """(服务商, 模型)，结果缓存据此区分不同模型的输出。"""
+        return self.client.provider, self.client.model
+
+    def headroom(self) -> float:
+        """剩余可用能力（0~1）：空闲并发比例与两个令牌桶剩余比例中的最小值，因限流暂停期间为 0。"""
+        with self._pause_lock:
+            if self._paused_until > time.monotonic():
+                return 0.0
+        return min(self.concurrency.free_fraction(), self.request_bucket.available_fraction(),
+                   self.token_bucket.available_fraction())
+
+    def _pause_all(self, seconds: float):
+        with self._pause_lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _wait_for_quota(self, prompt: str, stop_check: Callable[[], bool]):
+        with self._pause_lock:
+            paused_for = self._paused_until - time.monotonic()
+        if paused_for > 0:
+            cancellable_sleep(paused_for, stop_check)
+        wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(estimate_tokens(prompt)))
+        if wait > 0:
+            cancellable_sleep(wait, stop_check)
+
+    def _backoff_delay(self, attempt: int) -> float:
+        return min(MAX_BACKOFF_SECONDS, self.backoff_factor * (2 ** attempt)) * random.uniform(0.5, 1.0)
+
+    def process(self, text: str, prompt_template: str = "{text}",
+                cancel_event: Optional[threading.Event] = None, **kwargs) -> str:
+        """
+        在限流与重试策略下调用一次 AIWrapper.process()。
+        被取消时抛出 AICancelled；重试耗尽或遇到不可重试的错误时抛出最后一次的 AIServiceError。
+        """
+        stop_check = lambda: bool(cancel_event and cancel_event.is_set())
+        prompt = prompt_template.format(text=text)
+
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_quota(prompt, stop_check)
+            self.concurrency.acquire(stop_check)
+            try:
+                result = self.client.process(text=text, custom_prompt_template=prompt_template, **kwargs)
+            except AIRateLimitError as e:
+                limit = self.concurrency.on_rate_limited()
+                delay = e.retry_after if e.retry_after is not None else self._backoff_delay(attempt)
+                # 即使不再重试也要暂停：同一引擎上的其他请求同样会被限流
+                self._pause_all(delay)
+                error = e
+                message = _("WARNING: AI服务商限流，并发数降为 {}，{:.1f} 秒后重试 {}/{}。").format(
+                    limit, delay, attempt + 1, self.max_retries)
+            except AIServiceError as e:
+                error = e
+                if not is_retryable_error(e):
+                    raise
+                delay = self._backoff_delay(attempt)
+                message = _("API调用错误: {}。在 {:.1f}秒 后重试 {}/{}。").format(e, delay, attempt + 1,
+                                                                             self.max_retries)
+            else:
+                self.concurrency.on_success()
+                return result
+            finally:
+                self.concurrency.release()
+
+            if attempt >= self.max_retries:
+                raise error
+            self.log(message, "WARNING")
+            cancellable_sleep(delay, stop_check)
+
+    def map(self, texts: List[str], prompt_template: str = "{text}",
+            cancel_event: Optional[threading.Event] = None,
+            on_result: Optional[Callable[[int, Any], None]] = None, **kwargs) -> List[Any]:
+        """
+        并发处理多条文本，返回与输入顺序一致的结果列表；单条失败时该位置为对应的异常对象。
+        on_result(序号, 结果或异常) 在每条完成时于调用线程中回调，可用于汇报进度。
+        其余关键字参数（如 temperature）原样传给 AIWrapper.process()。
+        """
+        return run_concurrently(self.process, texts, prompt_template, self.max_concurrency, cancel_event,
+                                on_result, **kwargs)
@@ -0,0 +1,195 @@
+﻿# cotton_toolkit/core/ai_pool.py
+
+import logging
+import random
+import threading
+import time
+from typing import List, Dict, Optional, Callable, Any, Tuple
+
+from .ai_engine import AIExecutionEngine, AICancelled, BACKOFF_FACTOR, MAX_BACKOFF_SECONDS, cancellable_sleep, \
+    is_retryable_error, run_concurrently
+from .ai_wrapper import AIWrapper, AIServiceError
+
+# --- 国际化和日志设置 ---
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.ai_pool")
+
+# 延迟的指数移动平均系数，以及尚无观测时假定的初始延迟（秒）
+LATENCY_EWMA_ALPHA = 0.3
+INITIAL_LATENCY_SECONDS = 1.0
+# 端点出错后暂停分配请求的时长：按连续失败次数指数增长，并设上限
+FAILURE_COOLDOWN_SECONDS = 5.0
+MAX_FAILURE_COOLDOWN_SECONDS = 120.0
+# 剩余能力为 0 的端点仍保留一个很小的权重，避免所有端点都满载时无法选择
+MIN_HEADROOM_WEIGHT = 0.01
+
+
+def is_valid_api_key(api_key: Optional[str]) -> bool:
+    return bool(api_key) and "YOUR_API_KEY" not in api_key and not api_key.startswith("YOUR_")
+
+
+class PoolEndpoint:
+    """池中的一个端点（服务商 + API Key），有自己的执行引擎（独立限流）与健康统计。"""
+
+    def __init__(self, name: str, engine: AIExecutionEngine, weight: float = 1.0):
+        self.name = name
+        self.engine = engine
+        self.weight = max(0.0, weight)
+        self.latency = INITIAL_LATENCY_SECONDS
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def is_available(self) -> bool:
+        return self.cooldown_until <= time.monotonic()
+
+    def score(self) -> float:
+        """选择权重 = 配置权重 × 剩余能力 / 平滑延迟：越快、越空闲的端点分到越多请求。"""
+        return self.weight * max(MIN_HEADROOM_WEIGHT, self.engine.headroom()) / max(self.latency, 1e-3)
+
+    def record_success(self, elapsed: float):
+        with self._lock:
+            self.requests += 1
+            self.latency = (1 - LATENCY_EWMA_ALPHA) * self.latency + LATENCY_EWMA_ALPHA * elapsed
+            self.consecutive_failures = 0
+
+    def record_failure(self, elapsed: float, cooldown: bool = True) -> float:
+        """记录一次失败；cooldown 为 False 时（请求本身的问题，与端点健康无关）不暂停该端点，返回 0。"""
+        with self._lock:
+            self.requests += 1
+            self.failures += 1
+            # 失败（包括超时）同样计入延迟，使持续变慢的端点权重下降
+            self.latency = (1 - LATENCY_EWMA_ALPHA) * self.latency + LATENCY_EWMA_ALPHA * elapsed
+            if not cooldown:
+                return 0.0
+            self.consecutive_failures += 1
+            cooldown = min(MAX_FAILURE_COOLDOWN_SECONDS,
+                           FAILURE_COOLDOWN_SECONDS * (2 ** (self.consecutive_failures - 1)))
+            self.cooldown_until = time.monotonic() + cooldown
+            return cooldown
+
+
+class AIProviderPool:
+    """
+    多端点AI客户端池，与 AIExecutionEngine 接口一致，可直接替代单个引擎用于批量任务。
+    每个请求按 配置权重 × 剩余限流余量 / 观测延迟 加权随机选择端点；端点出错（含 429）后进入冷却期，
+    请求立即转到其他端点重试。各端点独立限流，因此吞吐量随配置的服务商或 API Key 数量增长。
+    """
+
+    def __init__(self, endpoints: List[PoolEndpoint], max_retries: int = 3,
+                 backoff_factor: float = BACKOFF_FACTOR,
+                 status_callback: Optional[Callable[[str, str], None]] = None):
+        if not endpoints:
+            raise ValueError(_("AI服务池中至少需要一个端点。"))
+        self.endpoints = endpoints
+        self.max_retries = max(0, max_retries)
+        self.backoff_factor = backoff_factor
+        self.max_concurrency = sum(endpoint.engine.max_concurrency for endpoint in endpoints)
+        self.log = status_callback if status_callback else lambda msg, level="INFO": logger.info(f"[{level}] {msg}")
+
+    @classmethod
+    def from_config(cls, ai_services_config: Any, batch_config: Any, provider_names: List[str],
+                    proxies: Optional[Dict[str, str]] = None,
+                    status_callback: Optional[Callable[[str, str], None]] = None,
+                    model_override: Optional[str] = None) -> 'AIProviderPool':
+        """
+        为每个服务商的每个有效 API Key（api_key 与 extra_api_keys）创建一个端点。
+        端点内部不重试，出错时由池立即切换到其他端点。model_override 非空时所有端点都使用该模型。
+        """
+        endpoints = []
+        for provider_name in provider_names:
+            provider_cfg = ai_services_config.providers.get(provider_name)
+            if not provider_cfg:
+                raise ValueError(_("在配置中未找到AI服务商 '{}' 的设置。").format(provider_name))
+            api_keys = [key for key in [provider_cfg.api_key] + list(provider_cfg.extra_api_keys or [])
+                        if is_valid_api_key(key)]
+            max_concurrency = provider_cfg.max_concurrency or batch_config.max_workers
+            for i, api_key in enumerate(api_keys):
+                client = AIWrapper(provider=provider_name, api_key=api_key, model=model_override or provider_cfg.model,
+                                   base_url=provider_cfg.base_url, proxies=proxies, max_workers=max_concurrency)
+                engine = AIExecutionEngine(client, max_concurrency=max_concurrency,
+                                           requests_per_minute=provider_cfg.requests_per_minute,
+                                           tokens_per_minute=provider_cfg.tokens_per_minute,
+                                           max_retries=0, status_callback=status_callback)
+                name = provider_name if len(api_keys) == 1 else f"{provider_name}#{i + 1}"
+                endpoints.append(PoolEndpoint(name, engine, provider_cfg.pool_weight))
+        if not endpoints:
+            raise ValueError(_("AI服务池中没有任何配置了有效API Key的服务商。"))
+        return cls(endpoints, max_retries=batch_config.max_retries, status_callback=status_callback)
+
+    @property
+    def cache_identity(self) -> Tuple[str, str]:
+        providers = sorted({endpoint.engine.cache_identity[0] for endpoint in self.endpoints})
+        models = sorted({endpoint.engine.cache_identity[1] for endpoint in self.endpoints})
+        return ",".join(providers), ",".join(models)
+
+    def _choose(self, exclude: set) -> PoolEndpoint:
+        candidates = [e for e in self.endpoints if e not in exclude and e.is_available()] or \
+                     [e for e in self.endpoints if e not in exclude] or self.endpoints
+        weights = [endpoint.score() for endpoint in candidates]
+        if sum(weights) <= 0:
+            return random.choice(candidates)
+        return random.choices(candidates, weights=weights, k=1)[0]
+
+    def process(self, text: str, prompt_template: str = "{text}",
+                cancel_event: Optional[threading.Event] = None, **kwargs) -> str:
+        """
+        选择一个端点处理文本，失败时切换到尚未尝试过的端点；所有端点都试过后退避等待，再开始新一轮。
+        共进行 max_retries + 1 轮；被取消时抛出 AICancelled。
+        """
+        stop_check = lambda: bool(cancel_event and cancel_event.is_set())
+        last_error: Optional[Exception] = None
+        for round_index in range(self.max_retries + 1):
+            tried = set()
+            any_retryable = False
+            while len(tried) < len(self.endpoints):
+                endpoint = self._choose(tried)
+                tried.add(endpoint)
+                start = time.monotonic()
+                try:
+                    result = endpoint.engine.process(text, prompt_template, cancel_event, **kwargs)
+                except AICancelled:
+                    raise
+                except AIServiceError as e:
+                    retryable = is_retryable_error(e)
+                    # 不可重试的错误（如某一行内容导致的 400）说明的是请求本身的问题，不应让健康的端点进入冷却
+                    cooldown = endpoint.record_failure(time.monotonic() - start, cooldown=retryable)
+                    last_error = e
+                    any_retryable = any_retryable or retryable
+                    if len(self.endpoints) > 1 and retryable:
+                        self.log(_("WARNING: 端点 {} 请求失败（{}），暂停使用 {:.0f} 秒并切换到其他端点。").format(
+                            endpoint.name, type(e).__name__, cooldown), "WARNING")
+                    continue
+                endpoint.record_success(time.monotonic() - start)
+                return result
+
+            # 所有端点都返回不可重试的错误（例如请求本身无效）时，再来一轮也不会成功
+            if round_index < self.max_retries and any_retryable:
+                delay = min(MAX_BACKOFF_SECONDS, self.backoff_factor * (2 ** round_index)) * random.uniform(0.5, 1.0)
+                self.log(_("API调用错误: {}。在 {:.1f}秒 后重试 {}/{}。").format(
+                    last_error, delay, round_index + 1, self.max_retries), "WARNING")
+                cancellable_sleep(delay, stop_check)
+            elif not any_retryable:
+                break
+        raise last_error
+
+    def map(self, texts: List[str], prompt_template: str = "{text}",
+            cancel_event: Optional[threading.Event] = None,
+            on_result: Optional[Callable[[int, Any], None]] = None, **kwargs) -> List[Any]:
+        """与 AIExecutionEngine.map() 相同，线程数为所有端点并发上限之和。"""
+        return run_concurrently(self.process, texts, prompt_template, self.max_concurrency, cancel_event,
+                                on_result, **kwargs)
+
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """各端点的请求数、失败数与平滑延迟，用于任务结束后的日志。"""
+        return [{'endpoint': e.name, 'requests': e.requests, 'failures': e.failures,
+                 'latency': round(e.latency, 3)} for e in self.endpoints]
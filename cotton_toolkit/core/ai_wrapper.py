@@ -4,6 +4,8 @@ from typing import Dict, Any, Optional, List
 import threading
 import os
 import contextlib
+import time
+from email.utils import parsedate_to_datetime
 
 from requests.adapters import HTTPAdapter
 
@@ -20,6 +22,39 @@ except ImportError:
     _ = lambda s: str(s)
 
 
+DEFAULT_TEMPERATURE = 0.7
+
+
+class AIServiceError(RuntimeError):
+    """AI 服务调用失败。status_code 为服务商返回的 HTTP 状态码（如果有）。"""
+
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class AIRateLimitError(AIServiceError):
+    """服务商返回 429（或配额耗尽）。retry_after 为服务商要求等待的秒数，未提供时为 None。"""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None, status_code: Optional[int] = 429):
+        super().__init__(message, status_code)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 Retry-After 响应头，支持秒数与 HTTP 日期两种格式。"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
 @contextlib.contextmanager
 def temp_proxies(proxies: Optional[Dict[str, str]]):
     """一个上下文管理器，用于临时设置代理环境变量。"""
@@ -109,7 +144,7 @@ class AIWrapper:
             if self.proxies:
                 self.session.proxies.update(self.proxies)
 
-    def process(self, text: str, custom_prompt_template: str = "{text}", temperature: float = 0.7,
+    def process(self, text: str, custom_prompt_template: str = "{text}", temperature: float = DEFAULT_TEMPERATURE,
                 timeout: int = 90) -> str:
         prompt = custom_prompt_template.format(text=text)
         try:
@@ -130,18 +165,25 @@ class AIWrapper:
                 return data.get("choices", [{}])[0].get("message", {}).get("content", "").strip()
         except requests.exceptions.RequestException as e:
             error_message = f"{_('AI API请求失败 (requests):')} {e}"
+            status_code = None
             if e.response is not None:
+                status_code = e.response.status_code
                 try:
                     error_details = e.response.json()
                     msg = error_details.get('error', {}).get('message', str(error_details))
                     error_message += f"\n{_('服务商响应:')} {msg}"
-                except json.JSONDecodeError:
+                except (json.JSONDecodeError, ValueError, AttributeError):
                     error_message += f"\n{_('服务商响应 (非JSON):')} {e.response.text}"
-            raise RuntimeError(error_message) from e
+                if status_code == 429:
+                    raise AIRateLimitError(error_message, parse_retry_after(e.response.headers.get('Retry-After'))) from e
+            raise AIServiceError(error_message, status_code) from e
         except Exception as e:
             error_type = type(e).__name__
             error_message = f"{_('AI API处理时发生错误')} ({error_type}): {e}"
-            raise RuntimeError(error_message) from e
+            # google-generativeai 在配额耗尽时抛出 ResourceExhausted
+            if error_type == 'ResourceExhausted':
+                raise AIRateLimitError(error_message) from e
+            raise AIServiceError(error_message) from e
 
 
     @staticmethod
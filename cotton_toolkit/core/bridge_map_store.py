@@ -0,0 +1,225 @@
+﻿# cotton_toolkit/core/bridge_map_store.py
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+import pandas as pd
+
+from .homology_mapper import map_genes_via_bridge, DEFAULT_BRIDGE_ID_REGEX
+from .homology_store import HOMOLOGY_SOURCE_ATTR, get_homology_store_checksum
+from ..config.models import GenomeSourceItem
+from ..utils.id_normalizer import normalize_id, load_or_normalize_column
+
+# 国际化函数占位符
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.bridge_map_store")
+
+# 预计算映射表的格式版本号，映射逻辑或表结构变化时递增，旧表会被视为过期
+BRIDGE_MAP_VERSION = 1
+BRIDGE_MAP_TABLE = "bridge_map"
+BRIDGE_MAP_META_TABLE = "bridge_map_meta"
+SOURCE_GENE_COLUMN = "Source_Gene_ID"
+RANK_COLUMN = "_rank"
+# SQLite 单条语句可绑定的参数数量有限，批量查询时按此大小分块
+SQLITE_MAX_PARAMS = 900
+
+
+def get_bridge_map_key(
+        selection_criteria_s_to_b: Dict[str, Any],
+        selection_criteria_b_to_t: Dict[str, Any],
+        homology_columns: Dict[str, str],
+        source_genome_info: GenomeSourceItem,
+        target_genome_info: GenomeSourceItem,
+        bridge_id_regex: Optional[str]
+) -> str:
+    """根据筛选标准、列名与各基因组的ID正则生成映射表的标识，任一参数变化都会对应另一张表。"""
+    payload = json.dumps({
+        's2b': selection_criteria_s_to_b, 'b2t': selection_criteria_b_to_t, 'columns': homology_columns,
+        'source_regex': source_genome_info.gene_id_regex, 'target_regex': target_genome_info.gene_id_regex,
+        'bridge_regex': bridge_id_regex or DEFAULT_BRIDGE_ID_REGEX, 'version': BRIDGE_MAP_VERSION,
+    }, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def get_bridge_map_path(storage_dir: str, source_assembly_id: str, target_assembly_id: str, map_key: str) -> str:
+    """获取某个基因组对在给定筛选标准下的映射表路径。"""
+    safe_source = re.sub(r'[\\/*?:"<>|\s]', "_", source_assembly_id)
+    safe_target = re.sub(r'[\\/*?:"<>|\s]', "_", target_assembly_id)
+    return os.path.join(storage_dir, f"{safe_source}__to__{safe_target}_{map_key}.sqlite")
+
+
+def get_bridge_map_inputs(s_to_b_homology_file: str, b_to_t_homology_file: str, map_key: str) -> Optional[Dict[str, Any]]:
+    """
+    汇总决定映射表内容的全部输入（两个同源文件的校验和与映射标识）。
+    任一同源文件尚无有效的列式存储时返回 None。
+    """
+    if not s_to_b_homology_file or not b_to_t_homology_file:
+        return None
+    if not os.path.exists(s_to_b_homology_file) or not os.path.exists(b_to_t_homology_file):
+        return None
+    s2b_checksum = get_homology_store_checksum(s_to_b_homology_file)
+    b2t_checksum = get_homology_store_checksum(b_to_t_homology_file)
+    if not s2b_checksum or not b2t_checksum:
+        return None
+    return {'version': BRIDGE_MAP_VERSION, 'map_key': map_key,
+            's2b_sha256': s2b_checksum, 'b2t_sha256': b2t_checksum}
+
+
+def _read_bridge_map_meta(conn: sqlite3.Connection) -> Dict[str, Any]:
+    rows = conn.execute(f"SELECT key, value FROM {BRIDGE_MAP_META_TABLE}").fetchall()
+    return {key: json.loads(value) for key, value in rows}
+
+
+def is_bridge_map_current(db_path: str, expected_inputs: Optional[Dict[str, Any]]) -> bool:
+    """判断映射表是否存在且与当前输入一致。"""
+    if not expected_inputs or not os.path.exists(db_path):
+        return False
+    try:
+        with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+            meta = _read_bridge_map_meta(conn)
+        conn.close()
+    except (sqlite3.Error, ValueError):
+        return False
+    return all(meta.get(key) == value for key, value in expected_inputs.items())
+
+
+def write_bridge_map(db_path: str, mapped_df: pd.DataFrame, meta: Dict[str, Any]):
+    """将完整的映射结果写入带索引的 SQLite 表。先写入临时文件，完成后再原子替换。"""
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    tmp_path = f"{db_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    table_df = mapped_df.reset_index(drop=True)
+    if SOURCE_GENE_COLUMN not in table_df.columns:
+        table_df = pd.DataFrame(columns=[SOURCE_GENE_COLUMN])
+    table_df.insert(0, RANK_COLUMN, range(len(table_df)))
+
+    conn = sqlite3.connect(tmp_path)
+    try:
+        table_df.to_sql(BRIDGE_MAP_TABLE, conn, index=False)
+        conn.execute(f'CREATE INDEX idx_{BRIDGE_MAP_TABLE}_source ON {BRIDGE_MAP_TABLE} ("{SOURCE_GENE_COLUMN}")')
+        conn.execute(f"CREATE TABLE {BRIDGE_MAP_META_TABLE} (key TEXT PRIMARY KEY, value TEXT)")
+        conn.executemany(f"INSERT INTO {BRIDGE_MAP_META_TABLE} VALUES (?, ?)",
+                         [(key, json.dumps(value, default=str)) for key, value in meta.items()])
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, db_path)
+
+
+def lookup_bridge_map(
+        db_path: str,
+        expected_inputs: Optional[Dict[str, Any]],
+        source_gene_ids: List[str],
+        source_id_regex: Optional[str]
+) -> Optional[Tuple[pd.DataFrame, List[str]]]:
+    """
+    在预计算的映射表中按源基因ID直接查询，返回值与 map_genes_via_bridge 相同: (DataFrame, 失败基因列表)。
+    映射表不存在或已过期时返回 None，调用方应回退到实时计算。
+    """
+    if not is_bridge_map_current(db_path, expected_inputs):
+        return None
+
+    processed_ids = list(dict.fromkeys(normalize_id(gid, source_id_regex) for gid in source_gene_ids))
+    chunks = []
+    with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+        for start in range(0, len(processed_ids), SQLITE_MAX_PARAMS):
+            batch = processed_ids[start:start + SQLITE_MAX_PARAMS]
+            placeholders = ",".join("?" * len(batch))
+            chunks.append(pd.read_sql_query(
+                f'SELECT * FROM {BRIDGE_MAP_TABLE} WHERE "{SOURCE_GENE_COLUMN}" IN ({placeholders})', conn,
+                params=batch))
+    conn.close()
+
+    mapped_df = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+    if mapped_df.empty:
+        return pd.DataFrame(), list(source_gene_ids)
+
+    mapped_df = mapped_df.sort_values(RANK_COLUMN, kind='mergesort').drop(columns=[RANK_COLUMN])
+    mapped_df = mapped_df.reset_index(drop=True)
+    successfully_mapped_genes = set(mapped_df[SOURCE_GENE_COLUMN].unique())
+    failed_genes = [gid for gid in source_gene_ids if gid not in successfully_mapped_genes]
+    return mapped_df, failed_genes
+
+
+def build_bridge_map(
+        db_path: str,
+        expected_inputs: Dict[str, Any],
+        source_assembly_id: str,
+        target_assembly_id: str,
+        source_to_bridge_homology_df: pd.DataFrame,
+        bridge_to_target_homology_df: pd.DataFrame,
+        selection_criteria_s_to_b: Dict[str, Any],
+        selection_criteria_b_to_t: Dict[str, Any],
+        homology_columns: Dict[str, str],
+        source_genome_info: GenomeSourceItem,
+        target_genome_info: GenomeSourceItem,
+        bridge_genome_info: Optional[GenomeSourceItem] = None,
+        chunk_size: int = 2000,
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_event: Optional[threading.Event] = None
+) -> bool:
+    """
+    为源同源表中的全部基因计算“源 -> 桥梁 -> 目标”映射并写入映射表。
+    按基因分块调用 map_genes_via_bridge，因此结果与交互式实时计算完全一致，同时避免一次性做全表连接。
+    """
+    progress = progress_callback if progress_callback else lambda p, m: None
+
+    query_col = homology_columns.get('query', 'Query')
+    all_source_ids = load_or_normalize_column(
+        source_to_bridge_homology_df.attrs.get(HOMOLOGY_SOURCE_ATTR), query_col,
+        source_to_bridge_homology_df[query_col], source_genome_info.gene_id_regex)
+    all_source_ids = all_source_ids.dropna().unique().tolist()
+
+    results = []
+    total = len(all_source_ids)
+    for start in range(0, total, chunk_size):
+        if cancel_event and cancel_event.is_set():
+            return False
+        progress(int(start / total * 90) if total else 0,
+                 _("正在预计算映射: {}/{}").format(min(start + chunk_size, total), total))
+        chunk_df, _failed = map_genes_via_bridge(
+            source_gene_ids=all_source_ids[start:start + chunk_size],
+            source_assembly_name=source_assembly_id,
+            target_assembly_name=target_assembly_id,
+            bridge_species_name=bridge_genome_info.species_name if bridge_genome_info else '',
+            source_to_bridge_homology_df=source_to_bridge_homology_df,
+            bridge_to_target_homology_df=bridge_to_target_homology_df,
+            selection_criteria_s_to_b=selection_criteria_s_to_b,
+            selection_criteria_b_to_t=selection_criteria_b_to_t,
+            homology_columns=homology_columns,
+            source_genome_info=source_genome_info,
+            target_genome_info=target_genome_info,
+            bridge_genome_info=bridge_genome_info,
+            status_callback=lambda msg, level="INFO": None
+        )
+        if chunk_df is not None and not chunk_df.empty:
+            results.append(chunk_df)
+
+    progress(90, _("正在写入映射表..."))
+    mapped_df = pd.concat(results, ignore_index=True) if results else pd.DataFrame()
+    if not mapped_df.empty:
+        # 与实时计算相同的全局排序，查询时按此顺序返回
+        score_col_name = homology_columns.get('score', 'Score')
+        sort_cols = [col for col in (f"{score_col_name}_s2b", f"{score_col_name}_b2t") if col in mapped_df.columns]
+        if sort_cols:
+            mapped_df = mapped_df.sort_values(by=sort_cols, ascending=False, kind='mergesort')
+
+    write_bridge_map(db_path, mapped_df, {**expected_inputs, 'n_rows': int(len(mapped_df)),
+                                          'n_source_genes': int(total)})
+    progress(100, _("映射表构建完成。"))
+    return True
@@ -1,12 +1,15 @@
 ﻿# cotton_toolkit/core/convertXlsx2csv.py
-import traceback
-
-import pandas as pd
+import csv
 import gzip
-import io
 import os
+import shutil
+import tempfile
 import threading
-from typing import Callable, Optional, List
+import traceback
+from collections import defaultdict
+from typing import Callable, Optional, List, Any, Dict, IO, Tuple
+
+import openpyxl
 
 # 国际化函数占位符
 try:
@@ -17,15 +20,131 @@ except (AttributeError, ImportError):
     def _(text: str) -> str:
         return text
 
-def _find_header_row(sheet_df: pd.DataFrame, keywords: List[str]) -> Optional[int]:
-    """在一个工作表中寻找包含指定关键字的表头行，检查前3行。"""
-    for i in range(min(3, len(sheet_df))):
-        row_values = [str(v).lower() for v in sheet_df.iloc[i].values]
-        if any(keyword.lower() in row_values for keyword in keywords):
+# 用于识别表头的关键字，以及在每个Sheet中查找表头的行数
+HEADER_KEYWORDS = ['Query', 'Match', 'Score', 'Exp', 'PID', 'evalue', 'identity']
+HEADER_SEARCH_ROWS = 3
+# openpyxl 需要可随机访问的文件。.gz 解压后不超过此大小时只保存在内存中，更大时才溢出到系统临时目录
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+CANCEL_CHECK_INTERVAL = 10000
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or value == ''
+
+
+def _trim_row(row: tuple) -> List[Any]:
+    """去掉行尾的空单元格（与 pandas 读取 Excel 时的处理一致）。"""
+    values = list(row)
+    while values and _is_empty(values[-1]):
+        values.pop()
+    return values
+
+
+def _chain_trimmed(pending_rows: List[List[Any]], rows):
+    """先给出查找表头时已读取的行，再继续逐行读取剩余部分。"""
+    yield from pending_rows
+    for row in rows:
+        yield _trim_row(row)
+
+
+def _find_header_row(rows: List[List[Any]], keywords: List[str]) -> Optional[int]:
+    """在一个工作表的前 HEADER_SEARCH_ROWS 行中寻找包含指定关键字的表头行。"""
+    lowered_keywords = {keyword.lower() for keyword in keywords}
+    for i, row in enumerate(rows[:HEADER_SEARCH_ROWS]):
+        if any(str(v).lower() in lowered_keywords for v in row):
             return i
     return None
 
 
+def _make_column_names(header_row: List[Any], width: int) -> List[str]:
+    """生成与 pandas 一致的列名：空表头为 'Unnamed: i'，重名列依次加 '.1', '.2' 后缀。"""
+    names = [f"Unnamed: {i}" if i >= len(header_row) or _is_empty(header_row[i]) else str(header_row[i])
+             for i in range(width)]
+    counts: Dict[str, int] = defaultdict(int)
+    for i, name in enumerate(names):
+        current = counts[name]
+        while current > 0:
+            counts[name] = current + 1
+            name = f"{name}.{current}"
+            current = counts[name]
+        names[i] = name
+        counts[name] = current + 1
+    return names
+
+
+def _format_cell(value: Any) -> Any:
+    return '' if value is None else value
+
+
+class _StreamingCsvWriter:
+    """
+    逐行写出合并后的CSV。各Sheet的列按名称对齐到全局列序，某个Sheet出现新列时追加到末尾；
+    只有在列集合于写出数据后发生扩充时，才在结束时重写一次文件以补全表头和短行。
+    """
+
+    def __init__(self, handle: IO[str]):
+        self.handle = handle
+        self.writer = csv.writer(handle, lineterminator=os.linesep)
+        self.columns: List[str] = []
+        self.header_written_width = 0
+        self.rows_written = 0
+
+    def checkpoint(self) -> Tuple[Any, int, int, int]:
+        """记录当前的文件位置与列状态，处理某个Sheet出错时用 rollback() 撤销该Sheet已写出的内容。"""
+        self.handle.flush()
+        return self.handle.tell(), len(self.columns), self.header_written_width, self.rows_written
+
+    def rollback(self, checkpoint: Tuple[Any, int, int, int]):
+        position, column_count, self.header_written_width, self.rows_written = checkpoint
+        self.handle.seek(position)
+        self.handle.truncate()
+        del self.columns[column_count:]
+
+    def map_columns(self, names: List[str]) -> List[int]:
+        positions = []
+        for name in names:
+            if name not in self.columns:
+                self.columns.append(name)
+            positions.append(self.columns.index(name))
+        return positions
+
+    def write_header(self):
+        self.writer.writerow(self.columns)
+        self.header_written_width = len(self.columns)
+
+    def write_row(self, positions: List[int], values: List[Any]):
+        out = [''] * (max(positions) + 1 if positions else 0)
+        for position, value in zip(positions, values):
+            out[position] = _format_cell(value)
+        self.writer.writerow(out)
+        self.rows_written += 1
+
+
+def _open_workbook_source(excel_path: str):
+    """返回 openpyxl 可读取的对象：普通文件直接用路径；.gz 文件流式解压到内存（过大时溢出到临时文件）。"""
+    if not excel_path.lower().endswith('.gz'):
+        return excel_path
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    with gzip.open(excel_path, 'rb') as f_in:
+        shutil.copyfileobj(f_in, spool, 1024 * 1024)
+    spool.seek(0)
+    return spool
+
+
+def _pad_csv_file(path: str, columns: List[str]):
+    """列集合在写出数据后扩充时，用完整表头重写文件并把短行补齐。"""
+    padded_path = f"{path}.pad"
+    with open(path, 'r', encoding='utf-8-sig', newline='') as f_in, \
+            open(padded_path, 'w', encoding='utf-8-sig', newline='') as f_out:
+        reader = csv.reader(f_in)
+        writer = csv.writer(f_out, lineterminator=os.linesep)
+        next(reader, None)
+        writer.writerow(columns)
+        for row in reader:
+            writer.writerow(row + [''] * (len(columns) - len(row)))
+    os.replace(padded_path, path)
+
+
 def convert_excel_to_standard_csv(
         excel_path: str,
         output_csv_path: str,
@@ -35,68 +154,101 @@ def convert_excel_to_standard_csv(
 ) -> bool:
     """
     智能地将一个Excel文件（可含多Sheet，支持.gz压缩）转换为一个单一的、干净的CSV文件。
-    - 智能搜索表头：在每个Sheet的前3行中查找包含关键字的表头。
-    - 合并所有Sheet：将所有找到的有效数据合并。
-    - 清理空行：自动移除所有完全为空的行。
+    - 流式读取：openpyxl 只读模式逐行读取，边读边写，内存占用与工作簿大小无关；
+    - 智能搜索表头：在每个Sheet的前3行中查找包含关键字的表头（与数据读取在同一遍中完成）；
+    - 合并所有Sheet：按列名对齐后合并所有找到的有效数据；
+    - 清理空行：自动移除所有完全为空的行；
+    - 原子写入：先写临时文件，完成后再替换目标文件；
     - 支持取消：在处理过程中可被中断。
     """
     log = status_callback if status_callback else print
-    header_keywords = ['Query', 'Match', 'Score', 'Exp', 'PID', 'evalue', 'identity']  # 用于识别表头的关键字
+    tmp_csv_path = f"{output_csv_path}.tmp-{os.getpid()}-{threading.get_ident()}"
 
     try:
         log(_("INFO: Starting intelligent conversion for: {}").format(os.path.basename(excel_path)), "INFO")
 
         if cancel_event and cancel_event.is_set():
             log(_("INFO: Conversion cancelled before starting."), "INFO")
+            return False
 
-        open_func = gzip.open if excel_path.lower().endswith('.gz') else open
-        with open_func(excel_path, 'rb') as f:
-            xls = pd.ExcelFile(io.BytesIO(f.read()), engine='openpyxl')
-
-        all_data_frames = []
-        for sheet_name in xls.sheet_names:
-            if cancel_event and cancel_event.is_set():
-                log("INFO: Conversion cancelled while processing sheets.", "INFO");
-                return False
-
-            log(f"DEBUG: Processing sheet: '{sheet_name}'...", "DEBUG")
-            try:
-                # 先读取一个预览版来找表头，避免加载整个大文件
-                preview_df = pd.read_excel(xls, sheet_name=sheet_name, header=None, nrows=5)
-                header_row_index = _find_header_row(preview_df, header_keywords)
-
-                if header_row_index is not None:
-                    log(_("DEBUG: Header found in sheet '{}' at row {}.").format(sheet_name, header_row_index + 1),
-                        "DEBUG")
-                    # 找到表头后，从表头行开始重新读取整个sheet
-                    sheet_df = pd.read_excel(xls, sheet_name=sheet_name, header=header_row_index)
-                    # 清理完全是空值的行
-                    sheet_df.dropna(how='all', inplace=True)
-                    all_data_frames.append(sheet_df)
-                else:
-                    log(_("WARNING: No valid header found in sheet '{}'. Skipping this sheet.").format(sheet_name),
-                        "WARNING")
-            except Exception as e:
-                log(_("ERROR: Failed to process sheet '{}'. Reason: {}").format(sheet_name, e), "ERROR")
-
-        if not all_data_frames:
+        source = _open_workbook_source(excel_path)
+        workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+        try:
+            with open(tmp_csv_path, 'w', encoding='utf-8-sig', newline='') as handle:
+                writer = _StreamingCsvWriter(handle)
+                found_any_sheet = False
+                for sheet in workbook.worksheets:
+                    if cancel_event and cancel_event.is_set():
+                        log("INFO: Conversion cancelled while processing sheets.", "INFO")
+                        return False
+
+                    log(f"DEBUG: Processing sheet: '{sheet.title}'...", "DEBUG")
+                    checkpoint, sheet_found_before = writer.checkpoint(), found_any_sheet
+                    try:
+                        sheet.reset_dimensions()
+                        rows = sheet.iter_rows(values_only=True)
+                        head_rows = []
+                        for row in rows:
+                            head_rows.append(_trim_row(row))
+                            if len(head_rows) >= HEADER_SEARCH_ROWS:
+                                break
+
+                        header_row_index = _find_header_row(head_rows, HEADER_KEYWORDS)
+                        if header_row_index is None:
+                            log(_("WARNING: No valid header found in sheet '{}'. Skipping this sheet.").format(
+                                sheet.title), "WARNING")
+                            continue
+                        log(_("DEBUG: Header found in sheet '{}' at row {}.").format(sheet.title,
+                                                                                    header_row_index + 1), "DEBUG")
+
+                        header_row = head_rows[header_row_index]
+                        names = _make_column_names(header_row, len(header_row))
+                        positions = writer.map_columns(names)
+                        if not found_any_sheet:
+                            writer.write_header()
+                            found_any_sheet = True
+
+                        pending_rows = head_rows[header_row_index + 1:]
+                        for i, values in enumerate(_chain_trimmed(pending_rows, rows)):
+                            if i % CANCEL_CHECK_INTERVAL == 0 and cancel_event and cancel_event.is_set():
+                                log("INFO: Conversion cancelled while processing sheets.", "INFO")
+                                return False
+                            if all(_is_empty(v) for v in values):
+                                continue
+                            if len(values) > len(names):
+                                # 数据行比表头宽：与 pandas 一样为多出的列补上 'Unnamed: i' 列名
+                                names = _make_column_names(header_row, len(values))
+                                positions = writer.map_columns(names)
+                            writer.write_row(positions, values)
+                    except Exception as e:
+                        # 丢弃这个Sheet已经写出的行，整个Sheet视为无效
+                        writer.rollback(checkpoint)
+                        found_any_sheet = sheet_found_before
+                        log(_("ERROR: Failed to process sheet '{}'. Reason: {}").format(sheet.title, e), "ERROR")
+        finally:
+            workbook.close()
+            if hasattr(source, 'close'):
+                source.close()
+
+        if not found_any_sheet:
             log(_("ERROR: No data could be extracted from any sheet in the Excel file."), "ERROR")
             return False
 
-        # 合并所有找到的数据
-        combined_df = pd.concat(all_data_frames, ignore_index=True)
-        # 再次清理，确保合并后没有空行
-        combined_df.dropna(how='all', inplace=True)
-
         if cancel_event and cancel_event.is_set():
             log(_("INFO: Conversion cancelled before writing file."), "INFO")
             return False
 
-        combined_df.to_csv(output_csv_path, index=False, encoding='utf-8-sig')
+        if len(writer.columns) > writer.header_written_width:
+            _pad_csv_file(tmp_csv_path, writer.columns)
+        os.replace(tmp_csv_path, output_csv_path)
         log(_("SUCCESS: Successfully converted and saved to: {}").format(os.path.basename(output_csv_path)), "INFO")
         return True
 
     except Exception as e:
         log(_("ERROR: A critical error occurred during Excel to CSV conversion. Reason: {}").format(e), "ERROR")
         traceback.print_exc()
-        return False
\ No newline at end of file
+        return False
+    finally:
+        if os.path.exists(tmp_csv_path):
+            os.remove(tmp_csv_path)
+
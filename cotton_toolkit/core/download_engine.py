@@ -0,0 +1,500 @@
+﻿# cotton_toolkit/core/download_engine.py
+
+import logging
+import json
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional, Callable, Any, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+from urllib3.exceptions import HTTPError as Urllib3HTTPError
+
+from cotton_toolkit.config.models import DownloaderConfig
+from cotton_toolkit.utils.file_utils import calculate_file_checksum
+
+# --- 国际化和日志设置 ---
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.download_engine")
+
+# 未完成的下载写入 <目标文件>.part，完成并校验大小后再原子替换为目标文件；分段下载的各段为 .part.<序号>
+PART_SUFFIX = ".part"
+# 与 .part 同时保存的续传状态 <目标文件>.part.json：开始下载时服务器给出的校验值（ETag/Last-Modified）与文件大小
+PART_STATE_SUFFIX = ".json"
+# 自适应块大小的范围，以及读取一个块的目标耗时（秒）：读得更快时块加倍，更慢时减半
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+TARGET_CHUNK_SECONDS = 0.25
+# 服务器支持 Range 且文件不小于此大小时，使用多连接分段下载
+SEGMENTED_MIN_BYTES = 64 * 1024 * 1024
+DEFAULT_SEGMENTS = 4
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_FACTOR = 1.0
+MAX_BACKOFF_SECONDS = 30.0
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+# fetch 的结果状态
+DOWNLOAD_STATUS_DOWNLOADED = "downloaded"
+DOWNLOAD_STATUS_NOT_MODIFIED = "not_modified"
+DOWNLOAD_STATUS_FAILED = "failed"
+DOWNLOAD_STATUS_CANCELLED = "cancelled"
+# 断点续传依赖字节偏移，必须禁止服务器对传输内容再做压缩
+_IDENTITY_HEADERS = {'Accept-Encoding': 'identity'}
+
+
+class DownloadCancelled(Exception):
+    """下载被用户取消。已下载的部分保留在 .part 文件中，下次可继续。"""
+
+
+class _RetryableError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _RangeNotSupported(Exception):
+    """服务器忽略了 Range 请求（或文件已在服务器端变化），需要改为从头单连接下载。"""
+
+
+_RETRYABLE_EXCEPTIONS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                         requests.exceptions.ChunkedEncodingError, Urllib3HTTPError, _RetryableError)
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return max(0.0, float(value)) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _adapt_chunk_size(chunk_size: int, elapsed: float) -> int:
+    if elapsed < TARGET_CHUNK_SECONDS / 2:
+        return min(chunk_size * 2, MAX_CHUNK_SIZE)
+    if elapsed > TARGET_CHUNK_SECONDS * 2:
+        return max(chunk_size // 2, MIN_CHUNK_SIZE)
+    return chunk_size
+
+
+def _file_size(path: str) -> int:
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _parse_http_date(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return parsedate_to_datetime(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_remote_unchanged(info: Dict[str, Any], etag: Optional[str], last_modified: Optional[str],
+                         local_size: int) -> bool:
+    """
+    根据探测结果判断远程文件是否与本地记录一致：优先比较 ETag，其次比较 Last-Modified；
+    服务器两者都不提供时只能比较大小，连大小也没有时无法判断，保留本地文件（与过去“文件存在即跳过”的行为一致）。
+    """
+    if etag and info['etag']:
+        return info['etag'] == etag
+    remote_time, local_time = _parse_http_date(info['last_modified']), _parse_http_date(last_modified)
+    if remote_time is not None and local_time is not None:
+        return remote_time <= local_time
+    if not info['etag'] and not info['last_modified']:
+        return info['size'] is None or info['size'] == local_size
+    return False
+
+
+def _read_part_state(part_path: str) -> Dict[str, Any]:
+    try:
+        with open(part_path + PART_STATE_SUFFIX, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_part_state(part_path: str, validator: Optional[str], size: Optional[int]):
+    state_path = part_path + PART_STATE_SUFFIX
+    temp_path = state_path + ".tmp"
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'validator': validator, 'size': size}, f)
+    os.replace(temp_path, state_path)
+
+
+class DownloadEngine:
+    """
+    可续传的文件下载引擎，所有下载共享同一个带连接池的 requests.Session（线程安全，可在线程池中共用）。
+    - 未完成的内容保存在 .part 文件中，重试或下次运行时通过 HTTP Range 从断点继续；
+    - 大文件在服务器支持 Range 时拆成多段并行下载；
+    - 网络错误与 429/5xx 响应按指数退避重试，每次重试都从已下载的位置继续；
+    - 读取块大小根据实际吞吐在 MIN_CHUNK_SIZE ~ MAX_CHUNK_SIZE 之间自适应。
+    """
+
+    def __init__(
+            self,
+            proxies: Optional[Dict[str, str]] = None,
+            max_retries: int = DEFAULT_MAX_RETRIES,
+            backoff_factor: float = BACKOFF_FACTOR,
+            segments: int = DEFAULT_SEGMENTS,
+            segment_min_bytes: int = SEGMENTED_MIN_BYTES,
+            timeout: Tuple[float, float] = (10, 60),
+            pool_size: int = 16,
+            session: Optional[requests.Session] = None
+    ):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.segments = max(1, segments)
+        self.segment_min_bytes = segment_min_bytes
+        self.timeout = timeout
+        self._progress_lock = threading.Lock()
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        if proxies:
+            session.proxies.update(proxies)
+        self.session = session
+
+    @classmethod
+    def from_config(cls, downloader_config: DownloaderConfig,
+                    proxies: Optional[Dict[str, str]] = None) -> 'DownloadEngine':
+        # 连接池至少要容纳所有并发文件的全部分段连接
+        segments = downloader_config.segments_per_file
+        return cls(proxies=proxies, max_retries=downloader_config.max_retries, segments=segments,
+                   segment_min_bytes=downloader_config.segment_min_size_mb * 1024 * 1024,
+                   pool_size=max(16, downloader_config.max_workers * max(1, segments)))
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self) -> 'DownloadEngine':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _probe(self, url: str, conditional_headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """
+        用 HEAD 请求获取文件大小、是否支持 Range 以及 ETag / Last-Modified；服务器拒绝 HEAD（如 405）时，
+        改用只请求首字节的条件 GET 获取同样的信息。失败时各项为空，由 GET 响应决定。
+        带有 If-None-Match / If-Modified-Since 时，服务器返回 304 表示文件未变化（not_modified 为 True）。
+        """
+        info = {'size': None, 'accept_ranges': False, 'validator': None, 'etag': None, 'last_modified': None,
+                'not_modified': False, 'reachable': False}
+        headers = {**_IDENTITY_HEADERS, **(conditional_headers or {})}
+        try:
+            r = self.session.head(url, allow_redirects=True, timeout=self.timeout, headers=headers)
+            if r.status_code >= 400:
+                # 只读取响应头，不下载内容
+                with self.session.get(url, stream=True, timeout=self.timeout,
+                                      headers={**headers, 'Range': 'bytes=0-0'}) as r:
+                    pass
+        except requests.exceptions.RequestException:
+            return info
+        info['reachable'] = True
+        if r.status_code == 304:
+            info['not_modified'] = True
+            return info
+        if r.status_code >= 400:
+            return info
+        if r.status_code == 206:
+            # Content-Range: bytes 0-0/<总大小>
+            total = r.headers.get('Content-Range', '').rsplit('/', 1)[-1]
+            info['size'] = int(total) if total.isdigit() else None
+            info['accept_ranges'] = True
+        else:
+            length = r.headers.get('Content-Length')
+            info['size'] = int(length) if length and length.isdigit() else None
+            info['accept_ranges'] = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        info['etag'] = r.headers.get('ETag')
+        info['last_modified'] = r.headers.get('Last-Modified')
+        # If-Range 只接受强 ETag，没有时退回 Last-Modified
+        etag = info['etag']
+        info['validator'] = etag if etag and not etag.startswith('W/') else info['last_modified']
+        return info
+
+    def _advance(self, pbar: tqdm, n: int):
+        with self._progress_lock:
+            pbar.update(n)
+
+    def _fetch(
+            self,
+            url: str,
+            path: str,
+            start: int,
+            length: Optional[int],
+            is_segment: bool,
+            validator: Optional[str],
+            pbar: tqdm,
+            stop_check: Callable[[], bool]
+    ):
+        """
+        下载 [start, start+length) 范围的内容到 path。path 中已有的字节视为已下载，从其后继续。
+        length 为 None 时下载到服务器文件末尾（仅用于单连接下载）。
+        """
+        offset = _file_size(path)
+        if length is not None and offset > length:
+            # 本地分段比预期还长，说明不是同一文件的数据，丢弃后重新下载
+            self._advance(pbar, -offset)
+            os.remove(path)
+            offset = 0
+        if length is not None and offset == length:
+            return
+
+        headers = dict(_IDENTITY_HEADERS)
+        if is_segment:
+            headers['Range'] = f"bytes={start + offset}-{start + length - 1}"
+        elif offset:
+            headers['Range'] = f"bytes={offset}-"
+        if 'Range' in headers and validator:
+            headers['If-Range'] = validator
+
+        with self.session.get(url, stream=True, headers=headers, timeout=self.timeout) as r:
+            if r.status_code == 416 and not is_segment and offset and length is None:
+                # 请求的起点已是文件末尾：之前的下载其实已经完整
+                return
+            if r.status_code in RETRYABLE_STATUS_CODES:
+                raise _RetryableError(_("服务器返回 {}").format(r.status_code),
+                                      _parse_retry_after(r.headers.get('Retry-After')))
+            r.raise_for_status()
+
+            mode = 'ab'
+            if 'Range' in headers and r.status_code != 206:
+                if is_segment:
+                    raise _RangeNotSupported()
+                # 服务器忽略了 Range 或文件已变化，从头开始
+                self._advance(pbar, -offset)
+                mode, offset = 'wb', 0
+            if length is None:
+                content_length = r.headers.get('Content-Length')
+                if content_length and content_length.isdigit():
+                    length = offset + int(content_length)
+                    with self._progress_lock:
+                        if not pbar.total:
+                            pbar.total = length
+                            pbar.refresh()
+
+            chunk_size = MIN_CHUNK_SIZE
+            with open(path, mode) as f:
+                while True:
+                    if stop_check():
+                        raise DownloadCancelled()
+                    started = time.monotonic()
+                    data = r.raw.read(chunk_size)
+                    if not data:
+                        break
+                    f.write(data)
+                    self._advance(pbar, len(data))
+                    chunk_size = _adapt_chunk_size(chunk_size, time.monotonic() - started)
+
+        received = _file_size(path)
+        if length is not None and received < length:
+            raise _RetryableError(_("连接提前结束 ({}/{} 字节)").format(received, length))
+        if length is not None and received > length:
+            self._advance(pbar, -received)
+            os.remove(path)
+            raise _RetryableError(_("收到的数据多于预期 ({}/{} 字节)").format(received, length))
+
+    def _with_retries(self, func: Callable[[], None], description: str, log: Callable,
+                      stop_check: Callable[[], bool]):
+        for attempt in range(self.max_retries + 1):
+            try:
+                return func()
+            except _RETRYABLE_EXCEPTIONS as e:
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = getattr(e, 'retry_after', None)
+                delay = retry_after if retry_after is not None else min(
+                    MAX_BACKOFF_SECONDS, self.backoff_factor * (2 ** attempt)) * random.uniform(0.5, 1.0)
+                log(_("WARNING: 下载 {} 出错 ({})，{:.1f} 秒后进行第 {}/{} 次重试...").format(
+                    description, e, delay, attempt + 1, self.max_retries))
+                deadline = time.monotonic() + delay
+                while time.monotonic() < deadline:
+                    if stop_check():
+                        raise DownloadCancelled()
+                    time.sleep(min(0.2, max(0.0, deadline - time.monotonic())))
+
+    def _download_segmented(self, url: str, part_path: str, size: int, validator: Optional[str], pbar: tqdm,
+                            description: str, log: Callable, stop_check: Callable[[], bool]):
+        segment_size = -(-size // self.segments)
+        ranges = [(start, min(segment_size, size - start)) for start in range(0, size, segment_size)]
+        segment_paths = [f"{part_path}.{i}" for i in range(len(ranges))]
+        self._advance(pbar, sum(_file_size(p) for p in segment_paths))
+
+        failed = threading.Event()
+        segment_stop = lambda: failed.is_set() or stop_check()
+
+        def run_segment(i: int):
+            start, length = ranges[i]
+            try:
+                self._with_retries(
+                    lambda: self._fetch(url, segment_paths[i], start, length, True, validator, pbar, segment_stop),
+                    f"{description} [{i + 1}/{len(ranges)}]", log, segment_stop)
+            except BaseException:
+                failed.set()
+                raise
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(run_segment, i) for i in range(len(ranges))]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        # 优先报告真正的失败原因，而不是因其他分段失败而被中止的 DownloadCancelled
+        real_errors = [e for e in errors if not isinstance(e, DownloadCancelled)]
+        if real_errors:
+            raise real_errors[0]
+        if errors:
+            raise errors[0]
+
+        with open(part_path, 'wb') as out:
+            for segment_path in segment_paths:
+                with open(segment_path, 'rb') as segment_file:
+                    shutil.copyfileobj(segment_file, out, MAX_CHUNK_SIZE)
+        for segment_path in segment_paths:
+            os.remove(segment_path)
+
+    def _remove_segments(self, part_path: str):
+        for i in range(self.segments):
+            segment_path = f"{part_path}.{i}"
+            if os.path.exists(segment_path):
+                os.remove(segment_path)
+
+    def _prepare_resume(self, part_path: str, info: Dict[str, Any], log: Callable,
+                        description: str) -> Optional[str]:
+        """
+        检查上次留下的 .part / 分段文件能否续传：只有记录的校验值与本次探测到的一致时才保留，
+        否则（服务器文件已变化、没有校验值、或旧版本没有状态文件）全部删除并从头下载。
+        返回续传时 If-Range 使用的校验值，即 .part 开始下载时记录的值。
+        """
+        state = _read_part_state(part_path)
+        has_partial = os.path.exists(part_path) or any(
+            os.path.exists(f"{part_path}.{i}") for i in range(self.segments))
+        if has_partial and not (info['validator'] and state.get('validator') == info['validator']
+                                and state.get('size') == info['size']):
+            log(_("INFO: {} 的远程文件已变化或无法校验，丢弃未完成的下载并重新开始。").format(description))
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            self._remove_segments(part_path)
+            state = {}
+        if not state:
+            _write_part_state(part_path, info['validator'], info['size'])
+            return info['validator']
+        return state['validator']
+
+    def _remove_part_state(self, part_path: str):
+        state_path = part_path + PART_STATE_SUFFIX
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+    def fetch(
+            self,
+            url: str,
+            local_path: str,
+            description: str = "",
+            status_callback: Optional[Callable] = None,
+            cancel_event: Optional[threading.Event] = None,
+            etag: Optional[str] = None,
+            last_modified: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        下载 url 到 local_path，返回 {'status', 'size', 'etag', 'last_modified', 'sha256'}，status 为 DOWNLOAD_STATUS_* 之一。
+        local_path 已存在且给出了 etag / last_modified 时先发出条件请求，服务器返回 304 则不传输任何内容。
+        内容先写入 local_path + PART_SUFFIX，完整后才替换为 local_path，因此目标文件存在即代表下载完整。
+        失败或取消时保留 .part 文件，下次调用会从断点继续。
+        """
+        log = status_callback if status_callback else print
+        description = description or os.path.basename(local_path)
+        part_path = local_path + PART_SUFFIX
+        stop_check = lambda: bool(cancel_event and cancel_event.is_set())
+        result = {'status': DOWNLOAD_STATUS_FAILED, 'size': None, 'etag': None, 'last_modified': None,
+                  'sha256': None}
+
+        target_dir = os.path.dirname(local_path)
+        if target_dir:
+            os.makedirs(target_dir, exist_ok=True)
+
+        conditional_headers = {}
+        if os.path.exists(local_path):
+            if etag:
+                conditional_headers['If-None-Match'] = etag
+            if last_modified:
+                conditional_headers['If-Modified-Since'] = last_modified
+        info = self._probe(url, conditional_headers)
+        if conditional_headers and not info['reachable']:
+            # 连服务器都无法访问时不再尝试下载，本地文件保持不变
+            return result
+        # 不支持条件请求的服务器会直接返回 200，此时再在客户端比较一次校验值
+        if info['not_modified'] or (conditional_headers and _is_remote_unchanged(info, etag, last_modified,
+                                                                                 _file_size(local_path))):
+            return {**result, 'status': DOWNLOAD_STATUS_NOT_MODIFIED, 'etag': info['etag'] or etag,
+                    'last_modified': info['last_modified'] or last_modified}
+
+        size = info['size']
+        use_segments = (self.segments > 1 and info['accept_ranges'] and size is not None
+                        and size >= self.segment_min_bytes)
+        try:
+            validator = self._prepare_resume(part_path, info, log, description)
+            with tqdm(total=size or 0, unit='iB', unit_scale=True, desc=description, ncols=100, leave=False,
+                      ascii=" #") as pbar:
+                if use_segments:
+                    try:
+                        self._download_segmented(url, part_path, size, validator, pbar, description, log,
+                                                 stop_check)
+                    except _RangeNotSupported:
+                        log(_("INFO: 服务器不支持分段下载 {}，改为单连接下载。").format(description))
+                        self._remove_segments(part_path)
+                        pbar.reset(total=size)
+                        use_segments = False
+                if not use_segments:
+                    self._advance(pbar, _file_size(part_path))
+                    self._with_retries(
+                        lambda: self._fetch(url, part_path, 0, size, False, validator, pbar, stop_check),
+                        description, log, stop_check)
+        except DownloadCancelled:
+            log(_("INFO: Download for {} was cancelled by user.").format(description))
+            return {**result, 'status': DOWNLOAD_STATUS_CANCELLED}
+        except requests.exceptions.RequestException as e:
+            if stop_check():
+                log(_("INFO: Download for {} was cancelled during request setup.").format(description))
+                return {**result, 'status': DOWNLOAD_STATUS_CANCELLED}
+            log(_("ERROR: Failed to download {} from {}. Network error: {}").format(description, url, e))
+            return result
+        except Exception as e:
+            log(_("ERROR: An unexpected error occurred while downloading {}: {}").format(description, e))
+            return result
+
+        # 替换前校验：大小必须与服务器声明的一致，并记录内容的 SHA-256
+        received = _file_size(part_path)
+        if size is not None and received != size:
+            log(_("ERROR: Downloaded size for {} ({}) does not match the expected size ({}).").format(
+                description, received, size))
+            os.remove(part_path)
+            self._remove_part_state(part_path)
+            return result
+        sha256 = calculate_file_checksum(part_path)
+        os.replace(part_path, local_path)
+        self._remove_part_state(part_path)
+        return {'status': DOWNLOAD_STATUS_DOWNLOADED, 'size': received, 'etag': info['etag'],
+                'last_modified': info['last_modified'], 'sha256': sha256}
+
+    def download(
+            self,
+            url: str,
+            local_path: str,
+            description: str = "",
+            status_callback: Optional[Callable] = None,
+            cancel_event: Optional[threading.Event] = None
+    ) -> bool:
+        """无条件下载 url 到 local_path，成功返回 True。见 fetch。"""
+        result = self.fetch(url, local_path, description, status_callback=status_callback, cancel_event=cancel_event)
+        return result['status'] == DOWNLOAD_STATUS_DOWNLOADED
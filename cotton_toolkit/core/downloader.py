@@ -2,20 +2,26 @@
 
 import concurrent.futures  # 用于多线程
 import gzip  # 用于解压.gz文件
+import json
 import logging  # 用于日志记录
 import os
 import re
 import shutil  # 用于文件操作 (如 copyfileobj)
 import threading
 import time
-from typing import List, Dict, Optional, Callable, Any
+from email.utils import formatdate
+from typing import List, Dict, Optional, Callable, Any, Tuple
 from urllib.parse import urlparse  # 用于从URL解析文件名
 
-import requests  # 用于HTTP请求
-from tqdm import tqdm  # 用于显示进度条
-
 from cotton_toolkit.config.models import DownloaderConfig, GenomeSourceItem
 from cotton_toolkit.core.convertXlsx2csv import convert_excel_to_standard_csv
+from cotton_toolkit.core.download_engine import DownloadEngine, DOWNLOAD_STATUS_DOWNLOADED, \
+    DOWNLOAD_STATUS_NOT_MODIFIED, DOWNLOAD_STATUS_FAILED
+from cotton_toolkit.core.homology_index import prebuild_homology_indexes
+from cotton_toolkit.core.homology_mapper import DEFAULT_BRIDGE_ID_REGEX
+from cotton_toolkit.core.homology_store import build_homology_store
+from cotton_toolkit.utils.file_utils import DOWNLOAD_MANIFEST_FILENAME, read_download_manifest, \
+    calculate_file_checksum, get_file_fingerprint, get_sidecar_cache_dir
 
 # --- 国际化和日志设置 ---
 try:
@@ -28,6 +34,9 @@ except (AttributeError, ImportError):
 
 logger = logging.getLogger("cotton_toolkit.downloader")
 
+DOWNLOAD_MANIFEST_VERSION = 1
+_DOWNLOAD_MANIFEST_LOCK = threading.Lock()
+
 
 def decompress_gz_to_temp_file(gz_filepath: str, temp_output_filepath: str, log: Callable) -> bool:
     """解压 .gz 文件到指定的临时文件路径。"""
@@ -62,48 +71,154 @@ def download_file(
             logger.error(_("创建目录 {} 失败: {}").format(target_dir, e))
             return False
 
+    effective_desc = task_desc if task_desc else os.path.basename(target_path)
+    logger.info(_("开始下载: {} -> {} (代理: {})").format(url, target_path, proxies if proxies else _("系统默认/无")))
+    engine = DownloadEngine(proxies=proxies)
     try:
-        effective_desc = task_desc if task_desc else os.path.basename(target_path)
-        logger.info(
-            _("开始下载: {} -> {} (代理: {})").format(url, target_path, proxies if proxies else _("系统默认/无")))
-
-        # 使用分离的连接和读取超时以提高取消操作的响应性
-        response = requests.get(url, stream=True, timeout=(10, 60), proxies=proxies)
-        response.raise_for_status()
-
-        total_size_in_bytes = int(response.headers.get('content-length', 0))
-        block_size = 1024 * 8
-
-        with open(target_path, 'wb') as file, \
-                tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True, desc=effective_desc, leave=False,
-                     ascii=" #") as progress_bar:
-            for data in response.iter_content(block_size):
-                progress_bar.update(len(data))
-                file.write(data)
-
-        if total_size_in_bytes != 0 and progress_bar.n < total_size_in_bytes:
-            progress_bar.update(total_size_in_bytes - progress_bar.n)
-        progress_bar.close()
-
-        if total_size_in_bytes != 0 and os.path.getsize(target_path) != total_size_in_bytes:
-            logger.error(_("错误: 下载的文件 {} 大小 ({}) 与预期 ({}) 不符。可能下载不完整。").format(
-                os.path.basename(target_path), os.path.getsize(target_path), total_size_in_bytes
-            ))
-            return False
-
-        return True
-    except requests.exceptions.RequestException as e:
-        logger.error(_("网络请求错误导致下载失败: {}. URL: {}").format(e, url))
-    except Exception as e:
-        logger.exception(_("下载 {} 时发生未知错误:").format(url))
+        return engine.download(url, target_path, effective_desc, status_callback=logger.info)
+    finally:
+        engine.close()
+
+
+def get_converted_csv_path(gz_excel_path: str) -> str:
+    """同源 .xlsx.gz 文件转换出的 CSV 与其位于同一目录，文件名去掉 .xlsx.gz。"""
+    base_name, _V = os.path.splitext(os.path.basename(gz_excel_path))
+    return os.path.join(os.path.dirname(gz_excel_path), os.path.splitext(base_name)[0] + ".csv")
+
+
+def _write_download_manifest_entry(version_output_dir: str, filename: str, entry: Dict[str, Any]):
+    """在版本目录的下载清单中更新一个文件的记录。多个下载线程共用同一清单，因此加锁并原子替换。"""
+    manifest_path = os.path.join(version_output_dir, DOWNLOAD_MANIFEST_FILENAME)
+    with _DOWNLOAD_MANIFEST_LOCK:
+        files = read_download_manifest(version_output_dir)
+        files[filename] = entry
+        tmp_path = f"{manifest_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': DOWNLOAD_MANIFEST_VERSION, 'files': files}, f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, manifest_path)
+
+
+def _check_local_file(local_path: str, entry: Optional[Dict[str, Any]]) -> Optional[str]:
+    """
+    用下载清单校验本地文件，返回其 SHA-256；与清单记录不符（被截断或修改）时返回 None。
+    大小与修改时间都与记录一致时直接信任记录；没有记录时计算一次校验和。
+    """
+    fingerprint = get_file_fingerprint(local_path)
+    if entry and fingerprint['size'] != entry.get('size'):
+        return None
+    if entry and entry.get('sha256') and fingerprint['mtime'] == entry.get('mtime'):
+        return entry['sha256']
+    checksum = calculate_file_checksum(local_path)
+    if entry and entry.get('sha256') and checksum != entry['sha256']:
+        return None
+    return checksum
+
+
+def invalidate_derived_caches(local_path: str) -> List[str]:
+    """
+    删除由某个下载文件派生的缓存：.fcgt_cache 中以该文件名开头的条目（列式存储、ID缓存、富集背景等）、
+    prepare_input_file 生成的标准化CSV，以及同源Excel转换出的CSV。返回被删除的条目名。
+    GFF 数据库存放在单独的目录中，其构建清单记录的源文件 SHA-256 会通过下载清单自动判定为过期。
+    """
+    removed = []
+    basename = os.path.basename(local_path)
+    source_dir = os.path.dirname(os.path.abspath(local_path))
+    # 同目录下以本文件名为前缀的其他文件（如 a.gff3 与 a.gff3.gz）各自的缓存不能误删
+    longer_names = [name + '.' for name in os.listdir(source_dir) if name != basename and name.startswith(basename + '.')]
+
+    cache_dir = get_sidecar_cache_dir(local_path)
+    if os.path.isdir(cache_dir):
+        standardized_name = f"{basename.split('.')[0]}_standardized.csv"
+        for name in os.listdir(cache_dir):
+            if name != standardized_name and (not name.startswith(basename + '.') or
+                                              any(name.startswith(prefix) for prefix in longer_names)):
+                continue
+            path = os.path.join(cache_dir, name)
+            try:
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+                removed.append(name)
+            except OSError as e:
+                logger.warning(_("删除派生缓存 {} 失败: {}").format(path, e))
+
+    if local_path.lower().endswith(".xlsx.gz"):
+        converted_csv_path = get_converted_csv_path(local_path)
+        if os.path.exists(converted_csv_path):
+            try:
+                os.remove(converted_csv_path)
+                removed.append(os.path.basename(converted_csv_path))
+            except OSError as e:
+                logger.warning(_("删除派生缓存 {} 失败: {}").format(converted_csv_path, e))
+    return removed
+
+
+def _download_if_changed(
+        url: str,
+        local_path: str,
+        description: str,
+        force: bool,
+        proxies: Optional[Dict[str, str]],
+        log: Callable,
+        cancel_event: Optional[threading.Event],
+        engine: Optional[DownloadEngine]
+) -> Tuple[bool, bool]:
+    """
+    按下载清单决定是否需要传输文件，返回 (是否成功, 文件内容是否变化)。
+    - 本地文件完好时发出条件请求 (If-None-Match / If-Modified-Since)，远程未变化则不传输；
+    - 本地文件与清单记录不符或 force 时无条件重新下载；
+    - 下载完成后记录 URL、大小、ETag、Last-Modified 与 SHA-256。
+    """
+    version_output_dir = os.path.dirname(local_path)
+    filename = os.path.basename(local_path)
+    entry = read_download_manifest(version_output_dir).get(filename)
+
+    local_checksum = None
+    etag = last_modified = None
+    if os.path.exists(local_path):
+        local_checksum = _check_local_file(local_path, entry)
+        if local_checksum is None:
+            log(_("WARNING: 本地文件 {} 与下载清单记录不符，将重新下载。").format(filename))
+        elif not force:
+            etag = entry.get('etag') if entry else None
+            last_modified = entry.get('last_modified') if entry else None
+            if not etag and not last_modified:
+                # 旧版本下载的文件没有记录，以本地修改时间作为 If-Modified-Since
+                last_modified = formatdate(os.path.getmtime(local_path), usegmt=True)
+            log(_("INFO: 正在检查 {} 是否有更新...").format(description))
+
+    if etag is None and last_modified is None:
+        log(_("INFO: 开始下载: {}...").format(description))
 
-    if os.path.exists(target_path):
-        try:
-            os.remove(target_path)
-            logger.info(_("已删除不完整的下载文件: {}").format(target_path))
-        except OSError as e_del:
-            logger.warning(_("删除不完整文件 {} 失败: {}").format(target_path, e_del))
-    return False
+    owns_engine = engine is None
+    engine = engine or DownloadEngine(proxies=proxies)
+    try:
+        result = engine.fetch(url, local_path, description, status_callback=log, cancel_event=cancel_event,
+                              etag=etag, last_modified=last_modified)
+    finally:
+        if owns_engine:
+            engine.close()
+
+    status = result['status']
+    if status == DOWNLOAD_STATUS_NOT_MODIFIED:
+        log(_("INFO: 文件未更新，跳过下载: {}").format(filename))
+        fingerprint = get_file_fingerprint(local_path)
+        if not entry or entry.get('sha256') != local_checksum or entry.get('mtime') != fingerprint['mtime']:
+            _write_download_manifest_entry(version_output_dir, filename, {
+                **(entry or {}), 'url': url, 'size': fingerprint['size'], 'mtime': fingerprint['mtime'],
+                'etag': result['etag'], 'last_modified': result['last_modified'], 'sha256': local_checksum})
+        return True, False
+    if status != DOWNLOAD_STATUS_DOWNLOADED:
+        if status == DOWNLOAD_STATUS_FAILED and (etag or last_modified):
+            # 只是检查更新失败（如离线），本地文件本身是完好的
+            log(_("WARNING: 无法检查 {} 的更新，将继续使用本地文件。").format(filename))
+            return True, False
+        return False, False
+
+    fingerprint = get_file_fingerprint(local_path)
+    _write_download_manifest_entry(version_output_dir, filename, {
+        'url': url, 'size': result['size'], 'mtime': fingerprint['mtime'], 'etag': result['etag'],
+        'last_modified': result['last_modified'], 'sha256': result['sha256'],
+        'downloaded_at': formatdate(time.time(), usegmt=True)})
+    return True, result['sha256'] != local_checksum
 
 
 def download_genome_data(
@@ -116,8 +231,9 @@ def download_genome_data(
         proxies: Optional[Dict[str, str]],
         status_callback: Callable,
         cancel_event: Optional[threading.Event] = None,
+        engine: Optional[DownloadEngine] = None,
 ) -> bool:
-    """为单个文件执行下载和后续处理的包装函数。"""
+    """为单个文件执行下载和后续处理的包装函数。传入 engine 时复用其连接池（多个文件并发下载时应共享同一个）。"""
     log = status_callback
 
     if cancel_event and cancel_event.is_set():
@@ -142,45 +258,41 @@ def download_genome_data(
     filename = os.path.basename(urlparse(url).path)
     local_path = os.path.join(version_output_dir, filename)
 
-    if not force and os.path.exists(local_path):
-        log(_("INFO: 文件已存在，跳过下载: {}").format(os.path.basename(local_path)))
-        is_download_successful = True
-    else:
-        description = f"{version_id}_{file_key}"
-        log(_("INFO: 开始下载: {}...").format(description))
-        is_download_successful = _download_file_with_progress(url, local_path, description, proxies, log, cancel_event)
+    description = f"{version_id}_{file_key}"
+    is_download_successful, file_changed = _download_if_changed(url, local_path, description, force, proxies, log,
+                                                                cancel_event, engine)
 
     if cancel_event and cancel_event.is_set():
         return False
 
+    # 文件内容变化后，删除由旧文件生成的派生缓存（CSV转换、列式存储、富集背景等）
+    if is_download_successful and file_changed:
+        removed = invalidate_derived_caches(local_path)
+        if removed:
+            log(_("INFO: 源文件已更新，已清除 {} 个派生缓存: {}").format(len(removed), ", ".join(removed)))
+
     if is_download_successful and file_key == 'homology_ath' and local_path.lower().endswith(".xlsx.gz"):
         gz_excel_path = local_path
-        base_name, _V = os.path.splitext(os.path.basename(gz_excel_path))
-        csv_filename = os.path.splitext(base_name)[0] + ".csv"
-        final_csv_path = os.path.join(os.path.dirname(gz_excel_path), csv_filename)
+        final_csv_path = get_converted_csv_path(gz_excel_path)
+        csv_filename = os.path.basename(final_csv_path)
 
         if not force and os.path.exists(final_csv_path):
             log(_("INFO: 对应的CSV文件已存在，跳过转换: {}").format(csv_filename))
         else:
             if cancel_event and cancel_event.is_set(): return False
             log(_("INFO: 尝试将 {} 转换为 CSV...").format(os.path.basename(gz_excel_path)))
-            temp_xlsx_path = os.path.splitext(gz_excel_path)[0]
-            if decompress_gz_to_temp_file(gz_excel_path, temp_xlsx_path, log):
-                try:
-                    convert_excel_to_standard_csv(temp_xlsx_path, final_csv_path)
-                except Exception as e:
-                    log(_("ERROR: 转换Excel到CSV时发生错误: {}").format(e))
-                finally:
-                    if os.path.exists(temp_xlsx_path):
-                        for i in range(3):
-                            try:
-                                os.remove(temp_xlsx_path)
-                                break
-                            except PermissionError:
-                                time.sleep(0.5)
-                            except Exception as e:
-                                log(_("ERROR: 删除临时文件 {} 失败: {}").format(temp_xlsx_path, e))
-                                break
+            # 直接从 .gz 流式读取工作簿，不再解压出临时 .xlsx 文件
+            if not convert_excel_to_standard_csv(gz_excel_path, final_csv_path, status_callback=log,
+                                                 cancel_event=cancel_event):
+                log(_("ERROR: 转换Excel到CSV时发生错误: {}").format(gz_excel_path))
+
+    # 为同源文件构建列式存储，之后所有流水线都直接加载它而不再解析原始文件
+    if is_download_successful and file_key == 'homology_ath':
+        if cancel_event and cancel_event.is_set(): return False
+        if build_homology_store(local_path, force=force, status_callback=log):
+            # 同时预建查询列与匹配列的索引，映射时只需按基因ID直接取出命中行
+            prebuild_homology_indexes(local_path, genome_info.gene_id_regex, DEFAULT_BRIDGE_ID_REGEX,
+                                      status_callback=log)
     return is_download_successful
 
 
@@ -190,43 +302,16 @@ def _download_file_with_progress(
         description: str,
         proxies: Optional[Dict[str, str]],
         status_callback: Optional[Callable] = None,
-        cancel_event: Optional[threading.Event] = None
+        cancel_event: Optional[threading.Event] = None,
+        engine: Optional[DownloadEngine] = None
 ) -> bool:
-    """一个带有tqdm进度条和取消功能的文件下载辅助函数。"""
-    log = status_callback if status_callback else print
+    """一个带有tqdm进度条和取消功能的文件下载辅助函数。支持断点续传、分段下载与失败重试，见 DownloadEngine。"""
+    if engine is not None:
+        return engine.download(url, local_path, description, status_callback=status_callback,
+                               cancel_event=cancel_event)
+    engine = DownloadEngine(proxies=proxies)
     try:
-        # =========== 代码修正部分 ===========
-        # 使用分离的连接(10s)和读取(60s)超时来提高取消操作的响应性
-        with requests.get(url, stream=True, proxies=proxies, timeout=(10, 60)) as r:
-            r.raise_for_status()
-            total_size = int(r.headers.get('content-length', 0))
-
-            with tqdm(total=total_size, unit='iB', unit_scale=True, desc=description, ncols=100, leave=False,
-                      ascii=" #") as pbar:
-                with open(local_path, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192):
-                        if cancel_event and cancel_event.is_set():
-                            log(_("INFO: Download for {} was cancelled by user.").format(description))
-                            return False
-
-                        if chunk:
-                            f.write(chunk)
-                            pbar.update(len(chunk))
-
-            if total_size != 0 and os.path.getsize(local_path) < total_size:
-                log(_("WARNING: Downloaded size for {} is less than expected. The file might be incomplete.").format(
-                    description))
-                return False
-            return True
-
-    except requests.exceptions.RequestException as e:
-        if cancel_event and cancel_event.is_set():
-            log(_("INFO: Download for {} was cancelled during request setup.").format(description))
-        else:
-            log(_("ERROR: Failed to download {} from {}. Network error: {}").format(description, url, e))
-        if os.path.exists(local_path): os.remove(local_path)
-        return False
-    except Exception as e:
-        log(_("ERROR: An unexpected error occurred while downloading {}: {}").format(description, e))
-        if os.path.exists(local_path): os.remove(local_path)
-        return False
\ No newline at end of file
+        return engine.download(url, local_path, description, status_callback=status_callback,
+                               cancel_event=cancel_event)
+    finally:
+        engine.close()
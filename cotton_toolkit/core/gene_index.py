@@ -0,0 +1,222 @@
+﻿# cotton_toolkit/core/gene_index.py
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ..utils.file_utils import get_file_fingerprint
+
+# 国际化函数占位符
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.gene_index")
+
+# 索引格式版本号，格式变化时递增，旧索引会被自动重建
+GENE_INDEX_VERSION = 1
+GENE_INDEX_SUFFIX = ".geneidx.npz"
+GENE_COLUMNS = ['gene_id', 'chrom', 'start', 'end', 'strand', 'source', 'feature_type', 'aliases', 'description']
+_TEXT_COLUMNS = ['gene_id', 'strand', 'source', 'feature_type', 'aliases', 'description']
+_FEATURE_SELECT = "SELECT id, seqid, start, end, strand, source, featuretype, attributes FROM features"
+# SQLite 单条语句可绑定的参数数量有限，批量查询时按此大小分块
+SQLITE_MAX_PARAMS = 900
+
+# 进程内缓存: 索引文件路径 -> (数据库指纹, GeneIndex)
+_INDEX_CACHE: Dict[str, Tuple[Dict[str, Any], 'GeneIndex']] = {}
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+def _first_attribute(attributes_json: str, key: str) -> str:
+    try:
+        values = json.loads(attributes_json).get(key)
+    except (TypeError, ValueError):
+        return 'N/A'
+    return values[0] if values else 'N/A'
+
+
+def _feature_rows_to_frame(rows: List[tuple]) -> pd.DataFrame:
+    """将 features 表的原始行转换为与 extract_gene_details 字段一致的 DataFrame（属性为 JSON 文本）。"""
+    df = pd.DataFrame(rows, columns=['gene_id', 'chrom', 'start', 'end', 'strand', 'source', 'feature_type',
+                                     'attributes'])
+    df['aliases'] = [_first_attribute(attrs, 'Alias') for attrs in df['attributes']]
+    df['description'] = [_first_attribute(attrs, 'description') for attrs in df['attributes']]
+    return df[GENE_COLUMNS].copy()
+
+
+def fetch_genes_by_ids(
+        db_path: str,
+        gene_ids: List[str],
+        progress_callback: Optional[Callable[[int, str], None]] = None
+) -> Tuple[pd.DataFrame, List[str]]:
+    """
+    按ID批量查询基因：分块执行 IN (...) 查询，直接读取 features 表，不构造 gffutils 的 Feature 对象。
+    返回 (按输入顺序排列的基因信息 DataFrame, 未找到的ID列表)。
+    """
+    progress = progress_callback if progress_callback else lambda p, m: None
+    unique_ids = list(dict.fromkeys(str(gid) for gid in gene_ids))
+    total = len(unique_ids)
+
+    rows = []
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        for start in range(0, total, SQLITE_MAX_PARAMS):
+            batch = unique_ids[start:start + SQLITE_MAX_PARAMS]
+            progress(int(start / total * 100), _("正在查询基因 {}/{}").format(min(start + len(batch), total), total))
+            placeholders = ",".join("?" * len(batch))
+            rows.extend(conn.execute(f"{_FEATURE_SELECT} WHERE id IN ({placeholders})", batch).fetchall())
+    finally:
+        conn.close()
+
+    found_df = _feature_rows_to_frame(rows).drop_duplicates(subset=['gene_id'])
+    requested = pd.DataFrame({'gene_id': [str(gid) for gid in gene_ids]})
+    result_df = requested.merge(found_df, on='gene_id', how='inner')
+    found_ids = set(found_df['gene_id'])
+    not_found_ids = [gid for gid in gene_ids if str(gid) not in found_ids]
+    progress(100, _("基因查询完成。"))
+    return result_df, not_found_ids
+
+
+class GeneIndex:
+    """
+    基因区间索引：所有基因按 (染色体, 起始位置) 排序后存放在定长数组中。
+    每条染色体占据一段连续区间，并额外保存终止位置的前缀最大值，
+    使“与区间重叠的基因”可以用两次二分查找定位候选范围，无需逐个读取 gffutils 的 Feature 对象。
+    """
+
+    def __init__(self, seqids: np.ndarray, chrom_offsets: np.ndarray, columns: Dict[str, np.ndarray]):
+        self.seqids = seqids
+        self.chrom_offsets = chrom_offsets
+        self.columns = columns
+        self._seqid_positions = {str(seqid): i for i, seqid in enumerate(seqids)}
+        # 每条染色体内部终止位置的前缀最大值，保证对 end 的二分查找有效
+        ends = columns['end']
+        self.max_end = np.empty_like(ends)
+        for i in range(len(seqids)):
+            lo, hi = chrom_offsets[i], chrom_offsets[i + 1]
+            if hi > lo:
+                self.max_end[lo:hi] = np.maximum.accumulate(ends[lo:hi])
+
+    @classmethod
+    def from_gff_db(cls, db_path: str) -> 'GeneIndex':
+        """用一次 SQL 查询从 gffutils 数据库的 features 表构建索引。"""
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(f"{_FEATURE_SELECT} WHERE featuretype = 'gene'").fetchall()
+        finally:
+            conn.close()
+
+        df = _feature_rows_to_frame(rows)
+        df['start'] = pd.to_numeric(df['start'], errors='coerce').fillna(0).astype(np.int64)
+        df['end'] = pd.to_numeric(df['end'], errors='coerce').fillna(0).astype(np.int64)
+
+        chrom_codes, seqids = pd.factorize(df['chrom'].astype(str), sort=True)
+        order = np.lexsort((df['start'].to_numpy(), chrom_codes))
+        chrom_codes = chrom_codes[order]
+        counts = np.bincount(chrom_codes, minlength=len(seqids))
+        chrom_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        columns = {'start': df['start'].to_numpy()[order], 'end': df['end'].to_numpy()[order]}
+        for name in _TEXT_COLUMNS:
+            columns[name] = df[name].fillna('').astype(str).to_numpy()[order].astype(str)
+        return cls(np.asarray(seqids, dtype=str), chrom_offsets, columns)
+
+    def save(self, index_path: str, source_fingerprint: Dict[str, Any]):
+        tmp_path = f"{index_path}.tmp-{os.getpid()}.npz"
+        np.savez(tmp_path, seqids=self.seqids, chrom_offsets=self.chrom_offsets,
+                 meta=np.array(json.dumps({'version': GENE_INDEX_VERSION, 'source': source_fingerprint})),
+                 **self.columns)
+        os.replace(tmp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path: str, source_fingerprint: Dict[str, Any]) -> Optional['GeneIndex']:
+        if not os.path.exists(index_path):
+            return None
+        try:
+            with np.load(index_path, allow_pickle=False) as data:
+                meta = json.loads(str(data['meta']))
+                if meta.get('version') != GENE_INDEX_VERSION or meta.get('source') != source_fingerprint:
+                    return None
+                columns = {name: data[name] for name in ['start', 'end'] + _TEXT_COLUMNS}
+                return cls(data['seqids'], data['chrom_offsets'], columns)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __len__(self) -> int:
+        return len(self.columns['start'])
+
+    def get_seqids(self) -> List[str]:
+        return [str(seqid) for seqid in self.seqids]
+
+    def query_regions(self, regions: List[Tuple[str, int, int]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        批量查询与各区间重叠（闭区间，与 gffutils 的 region 查询一致）的基因。
+        返回 (区间序号, 基因行号) 两个等长数组，同一区间内的基因按起始位置排序。
+        """
+        region_hits, row_hits = [], []
+        for region_index, (seqid, start, end) in enumerate(regions):
+            position = self._seqid_positions.get(str(seqid))
+            if position is None:
+                continue
+            lo_bound, hi_bound = self.chrom_offsets[position], self.chrom_offsets[position + 1]
+            # 起始位置 <= 区间终点 的候选上界，以及 前缀最大终止位置 >= 区间起点 的候选下界
+            hi = lo_bound + np.searchsorted(self.columns['start'][lo_bound:hi_bound], end, side='right')
+            lo = lo_bound + np.searchsorted(self.max_end[lo_bound:hi_bound], start, side='left')
+            if hi <= lo:
+                continue
+            candidates = np.arange(lo, hi)
+            candidates = candidates[self.columns['end'][lo:hi] >= start]
+            region_hits.append(np.full(len(candidates), region_index, dtype=np.int64))
+            row_hits.append(candidates)
+
+        if not row_hits:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(region_hits), np.concatenate(row_hits)
+
+    def to_frame(self, rows: np.ndarray) -> pd.DataFrame:
+        """将基因行号转换为与 extract_gene_details 字段一致的 DataFrame。"""
+        chrom_positions = np.searchsorted(self.chrom_offsets, rows, side='right') - 1
+        data = {name: self.columns[name][rows] for name in ['start', 'end'] + _TEXT_COLUMNS}
+        data['chrom'] = self.seqids[chrom_positions] if len(rows) else np.array([], dtype=str)
+        return pd.DataFrame(data, columns=GENE_COLUMNS)
+
+
+def get_gene_index_path(db_path: str) -> str:
+    """基因区间索引与 GFF 数据库存放在同一目录。"""
+    return db_path + GENE_INDEX_SUFFIX
+
+
+def load_gene_index(db_path: str) -> GeneIndex:
+    """
+    获取 GFF 数据库对应的基因区间索引：优先使用进程内缓存，其次读取磁盘缓存，都不可用时从数据库构建并保存。
+    数据库文件的大小或修改时间变化后索引自动失效。
+    """
+    index_path = get_gene_index_path(db_path)
+    fingerprint = get_file_fingerprint(db_path)
+
+    with _INDEX_CACHE_LOCK:
+        cached = _INDEX_CACHE.get(index_path)
+        if cached is not None and cached[0] == fingerprint:
+            return cached[1]
+
+        index = GeneIndex.load(index_path, fingerprint)
+        if index is None:
+            logger.info(_("正在为 {} 构建基因区间索引...").format(os.path.basename(db_path)))
+            index = GeneIndex.from_gff_db(db_path)
+            try:
+                index.save(index_path, fingerprint)
+            except OSError as e:
+                logger.warning(_("保存基因区间索引失败，本次仅在内存中使用: {}").format(e))
+
+        _INDEX_CACHE[index_path] = (fingerprint, index)
+        return index
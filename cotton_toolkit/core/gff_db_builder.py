@@ -0,0 +1,304 @@
+﻿# cotton_toolkit/core/gff_db_builder.py
+
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Callable, Iterator, Tuple
+from urllib.parse import unquote
+
+from gffutils import constants as gffutils_constants
+from gffutils.bins import bins as gffutils_bins
+from gffutils.version import version as gffutils_version
+
+from ..utils.file_utils import get_file_checksum, get_file_fingerprint
+from ..utils.id_normalizer import normalize_id, ID_MODE_FALLBACK
+
+# 国际化函数占位符
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.gff_db_builder")
+
+# 构建器版本号，解析规则或表结构变化时递增
+GFF_DB_BUILDER_VERSION = 1
+# 每个工作进程一次处理的原始文本块大小
+CHUNK_BYTES = 8 * 1024 * 1024
+# 小于该大小的文件，进程间传递文本块的开销高于并行解析的收益，直接在主进程中解析
+PARALLEL_MIN_BYTES = 256 * 1024 * 1024
+# gzip 尾部的 ISIZE 只记录最后一个成员的长度（对 2^32 取模；bgzip 的结束块为 0），
+# 因此用压缩后大小乘以 GFF 文本压缩率的保守下限作为兜底估计
+GFF_GZIP_MIN_RATIO = 5
+INSERT_SQL = "INSERT OR IGNORE INTO features VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+# 与数据库同目录存放的构建清单，记录数据库由哪个源文件、以何种参数构建
+GFF_DB_MANIFEST_SUFFIX = ".manifest.json"
+
+
+def _parse_attributes(attribute_field: str) -> Dict[str, List[str]]:
+    """按 GFF3 规则解析第9列属性，保持原有顺序并对值做 URL 解码（与 gffutils 写入的内容一致）。"""
+    attributes: Dict[str, List[str]] = {}
+    for part in attribute_field.strip().split(';'):
+        if not part:
+            continue
+        key, _sep, value = part.partition('=')
+        values = attributes.setdefault(key.strip(), [])
+        values.extend(unquote(v) if '%' in v else v for v in value.split(',') if v != '')
+    return attributes
+
+
+def _iter_directives(text: str) -> Iterator[str]:
+    position = 0 if text.startswith('##') else text.find('\n##')
+    while position >= 0:
+        line_start = position if position == 0 and text.startswith('##') else position + 1
+        line_end = text.find('\n', line_start)
+        line = text[line_start:line_end if line_end >= 0 else len(text)]
+        if not line.startswith('###'):
+            yield line[2:].rstrip()
+        position = text.find('\n##', line_start)
+
+
+def _parse_gene_chunk(text: str, id_regex: Optional[str]) -> Tuple[List[tuple], List[str], int, int]:
+    """
+    解析一个文本块中的 'gene' 行，返回 (features 表行, 指令行, 总行数, 格式错误行数)。
+    在工作进程中执行。只定位包含 '\tgene\t' 的行，其余行（外显子、mRNA 等占绝大多数）不做逐行处理。
+    没有 ID 的基因以空 ID 返回，由主进程统一编号。
+    """
+    rows = []
+    n_malformed = 0
+    position = 0
+    while True:
+        hit = text.find('\tgene\t', position)
+        if hit < 0:
+            break
+        line_start = text.rfind('\n', 0, hit) + 1
+        line_end = text.find('\n', hit)
+        if line_end < 0:
+            line_end = len(text)
+        position = line_end
+        line = text[line_start:line_end]
+        if line.startswith('#'):
+            continue
+        columns = line.rstrip('\r').split('\t')
+        if len(columns) < 9 or columns[2] != 'gene':
+            continue
+        try:
+            start, end = int(columns[3]), int(columns[4])
+            attributes = _parse_attributes(columns[8])
+        except ValueError:
+            n_malformed += 1
+            continue
+        original_id = attributes.get('ID', [None])[0]
+        gene_id = normalize_id(original_id, id_regex, ID_MODE_FALLBACK) if original_id else ''
+        rows.append((gene_id, columns[0], columns[1], columns[2], start, end, columns[5], columns[6], columns[7],
+                     json.dumps(attributes, separators=(",", ":")), '[]', gffutils_bins(start, end, one=True)))
+    n_lines = text.count('\n') + (0 if text.endswith('\n') else 1)
+    return rows, list(_iter_directives(text)), n_lines, n_malformed
+
+
+def _iter_text_chunks(gff_filepath: str, chunk_bytes: int = CHUNK_BYTES) -> Iterator[str]:
+    """流式读取（可能是 gzip 压缩的）GFF 文件，按整行切分为大块文本。"""
+    opener = gzip.open if gff_filepath.lower().endswith('.gz') else open
+    with opener(gff_filepath, 'rt', encoding='utf-8', errors='ignore') as f:
+        remainder = ''
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = remainder + block
+            cut = block.rfind('\n')
+            if cut < 0:
+                remainder = block
+                continue
+            remainder = block[cut + 1:]
+            yield block[:cut + 1]
+        if remainder:
+            yield remainder
+
+
+def _estimate_text_size(gff_filepath: str) -> int:
+    """估计 GFF 文件解压后的文本大小：普通文件即文件大小，gzip 文件取尾部 ISIZE 与按压缩率估算值中的较大者。"""
+    file_size = os.path.getsize(gff_filepath)
+    if not gff_filepath.lower().endswith('.gz') or file_size < 18:
+        return file_size
+    with open(gff_filepath, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        isize = int.from_bytes(f.read(4), 'little')
+    return max(isize, file_size * GFF_GZIP_MIN_RATIO)
+
+
+def _iter_parsed_chunks(gff_filepath: str, id_regex: Optional[str], max_workers: int):
+    """按文件顺序产出解析结果；多进程时最多保留 2 倍工作进程数的待处理块，以限制内存占用。"""
+    chunks = _iter_text_chunks(gff_filepath)
+    if max_workers <= 1:
+        for text in chunks:
+            yield _parse_gene_chunk(text, id_regex)
+        return
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        for text in chunks:
+            pending.append(executor.submit(_parse_gene_chunk, text, id_regex))
+            if len(pending) >= max_workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def get_gff_db_manifest_path(db_path: str) -> str:
+    return db_path + GFF_DB_MANIFEST_SUFFIX
+
+
+def read_gff_db_manifest(db_path: str) -> Optional[Dict[str, Any]]:
+    manifest_path = get_gff_db_manifest_path(db_path)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_gff_db_manifest(db_path: str, manifest: Dict[str, Any]):
+    # 先写临时文件再替换，保证读取方永远不会看到写了一半的清单
+    manifest_path = get_gff_db_manifest_path(db_path)
+    tmp_path = f"{manifest_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_gff_db_staleness(db_path: str, gff_filepath: str, id_regex: Optional[str]) -> Optional[str]:
+    """
+    判断数据库是否仍与源 GFF 文件及构建参数一致。一致时返回 None，否则返回需要重建的原因。
+    源文件大小与修改时间相同则直接信任；仅修改时间变化时重新计算校验和，内容未变则只刷新清单中的指纹。
+    """
+    if not os.path.exists(db_path) or os.path.getsize(db_path) == 0:
+        return _("数据库不存在")
+    manifest = read_gff_db_manifest(db_path)
+    if not manifest:
+        return _("缺少构建清单")
+    if manifest.get('builder_version') != GFF_DB_BUILDER_VERSION:
+        return _("构建器版本已变化")
+    if manifest.get('id_regex') != id_regex:
+        return _("基因ID正则表达式已变化")
+
+    source = manifest.get('source', {})
+    fingerprint = get_file_fingerprint(gff_filepath)
+    if fingerprint['size'] != source.get('size'):
+        return _("源GFF文件已变化")
+    if fingerprint['mtime'] == source.get('mtime'):
+        return None
+
+    if get_file_checksum(gff_filepath) != source.get('sha256'):
+        return _("源GFF文件已变化")
+    source['mtime'] = fingerprint['mtime']
+    try:
+        _write_gff_db_manifest(db_path, manifest)
+    except OSError:
+        pass
+    return None
+
+
+def build_gff_database(
+        gff_filepath: str,
+        db_path: str,
+        id_regex: Optional[str] = None,
+        status_callback: Optional[Callable[[str, str], None]] = None,
+        max_workers: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    流式、多进程地将 GFF3 中的基因写入与 gffutils 兼容的 SQLite 数据库（同一套表结构，可直接用 FeatureDB 打开）。
+    - 工作进程并行解析文本块并批量应用 id_regex；
+    - 主进程在单个大事务中批量插入，所有索引在数据加载完成后再创建；
+    - 规范化后ID重复的基因，保留文件中最先出现的一条；
+    - 先写入临时文件，完成后原子替换目标数据库并写入构建清单，读取方不会看到构建到一半的数据库。
+    返回构建统计信息。
+    """
+    log = status_callback if status_callback else lambda msg, level="INFO": logger.info(msg)
+    if max_workers is None:
+        large_file = _estimate_text_size(gff_filepath) >= PARALLEL_MIN_BYTES
+        max_workers = min(4, max(1, (os.cpu_count() or 1) - 1)) if large_file else 1
+
+    # 在读取源文件之前记录指纹，构建期间源文件若被改动，下次检查时会被识别为过期
+    source_fingerprint = get_file_fingerprint(gff_filepath)
+    source_checksum = get_file_checksum(gff_filepath)
+
+    tmp_path = f"{db_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+    for path in (tmp_path, tmp_path + "-wal", tmp_path + "-shm"):
+        if os.path.exists(path):
+            os.remove(path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-262144")
+        # 与 gffutils.create_db 相同的表结构，主键在建表时即存在，其余索引待加载后创建
+        conn.executescript(gffutils_constants.SCHEMA)
+
+        directives: List[str] = []
+        n_lines, n_genes, n_malformed, n_unnamed = 0, 0, 0, 0
+        conn.execute("BEGIN")
+        for rows, chunk_directives, chunk_lines, chunk_malformed in _iter_parsed_chunks(gff_filepath, id_regex,
+                                                                                        max_workers):
+            for i, row in enumerate(rows):
+                if not row[0]:
+                    n_unnamed += 1
+                    rows[i] = (f"gene_{n_unnamed}",) + row[1:]
+            conn.executemany(INSERT_SQL, rows)
+            directives.extend(chunk_directives)
+            n_lines += chunk_lines
+            n_genes += len(rows)
+            n_malformed += chunk_malformed
+            log(_("已解析 {} 行，找到 {} 个基因...").format(n_lines, n_genes), "DEBUG")
+
+        conn.executemany("INSERT INTO directives VALUES (?)", ((d,) for d in directives))
+        conn.execute("INSERT INTO meta (version, dialect) VALUES (?, ?)",
+                     (gffutils_version, json.dumps(gffutils_constants.dialect, separators=(",", ":"))))
+        if n_unnamed:
+            conn.execute("INSERT OR REPLACE INTO autoincrements VALUES (?, ?)", ('gene', n_unnamed))
+        conn.commit()
+
+        log(_("正在创建数据库索引..."), "INFO")
+        conn.execute("CREATE INDEX relationsparent ON relations (parent)")
+        conn.execute("CREATE INDEX relationschild ON relations (child)")
+        conn.execute("CREATE INDEX featuretype ON features (featuretype)")
+        conn.execute("CREATE INDEX seqidstartend ON features (seqid, start, end)")
+        conn.execute("CREATE INDEX seqidstartendstrand ON features (seqid, start, end, strand)")
+        conn.execute("ANALYZE features")
+        conn.commit()
+
+        n_stored = conn.execute("SELECT COUNT(*) FROM features").fetchone()[0]
+        # 切回单文件日志模式，使数据库可以作为一个独立文件被移动和只读打开
+        conn.execute("PRAGMA journal_mode=DELETE")
+    except BaseException:
+        conn.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    conn.close()
+
+    os.replace(tmp_path, db_path)
+    _write_gff_db_manifest(db_path, {
+        'builder_version': GFF_DB_BUILDER_VERSION,
+        'gffutils_version': gffutils_version,
+        'id_regex': id_regex,
+        'source': {'path': os.path.abspath(gff_filepath), 'sha256': source_checksum, **source_fingerprint},
+        'stats': {'lines': n_lines, 'genes': n_stored, 'malformed': n_malformed},
+    })
+
+    if n_malformed:
+        log(_("警告: 跳过了 {} 行格式错误的基因记录。").format(n_malformed), "WARNING")
+    if n_genes > n_stored:
+        log(_("信息: {} 个基因在ID规范化后重复，仅保留首次出现的记录。").format(n_genes - n_stored), "INFO")
+    return {'lines': n_lines, 'genes': n_stored, 'duplicates': n_genes - n_stored, 'malformed': n_malformed}
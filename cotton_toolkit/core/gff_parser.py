@@ -1,14 +1,18 @@
 ﻿# cotton_toolkit/core/gff_parser.py
-import gzip
 import logging
 import os
 import re
-from typing import Dict, Any, Optional, Callable, List, Tuple, Iterator, Union
+from typing import Dict, Any, Optional, Callable, List, Tuple, Union
 
 import gffutils
+import numpy as np
 import pandas as pd
 from diskcache import Cache
 
+from .gff_db_builder import build_gff_database, get_gff_db_staleness
+from .gene_index import load_gene_index, fetch_genes_by_ids, GENE_COLUMNS
+from ..utils.id_normalizer import normalize_id, ID_MODE_FALLBACK
+
 # 国际化函数占位符
 try:
     import builtins
@@ -21,11 +25,11 @@ except (AttributeError, ImportError):
 logger = logging.getLogger("cotton_toolkit.gff_parser")
 
 
-def _find_full_seqid(db: gffutils.FeatureDB, chrom_part: str, log: Callable) -> Optional[str]:
+def _find_full_seqid(db: Union[gffutils.FeatureDB, List[str]], chrom_part: str, log: Callable) -> Optional[str]:
     """
-    使用正则表达式在数据库中查找完整的序列ID (seqid)。
+    使用正则表达式在数据库（或给定的序列ID列表）中查找完整的序列ID (seqid)。
     """
-    all_seqids = list(db.seqids())
+    all_seqids = list(db) if isinstance(db, list) else list(db.seqids())
     log(f"数据库中所有可用的序列ID: {all_seqids[:10]}...", "DEBUG")
 
     for seqid in all_seqids:
@@ -49,28 +53,6 @@ def _find_full_seqid(db: gffutils.FeatureDB, chrom_part: str, log: Callable) ->
     return None
 
 
-def _gff_gene_filter(gff_filepath: str) -> Iterator[Union[gffutils.feature.Feature, str]]:
-    """
-    一个生成器函数，用于逐行读取GFF文件并仅产出'gene'类型的特征。
-    """
-    is_gzipped = gff_filepath.endswith('.gz')
-    opener = gzip.open if is_gzipped else open
-    mode = 'rt' if is_gzipped else 'r'
-
-    logger.debug(_("Opening {}{}file for parsing: {}").format('gzipped ' if is_gzipped else '', '', gff_filepath))
-
-    with opener(gff_filepath, mode, encoding='utf-8', errors='ignore') as gff_file:
-        for line in gff_file:
-            if line.startswith('#'):
-                continue
-            columns = line.strip().split('\t')
-            if len(columns) > 2 and columns[2] == 'gene':
-                try:
-                    feature_obj = gffutils.feature.feature_from_line(line)
-                    yield feature_obj
-                except Exception as e:
-                    logger.warning(_("Skipping malformed GFF line: {} | Error: {}").format(line.strip(), e))
-
 def create_gff_database(
         gff_filepath: str,
         db_path: str,
@@ -80,12 +62,17 @@ def create_gff_database(
 ):
     """
     从 GFF3 文件创建 gffutils 数据库，并使用正则表达式规范化ID。
+    已有数据库会根据其构建清单（源文件指纹与校验和、ID正则、构建器版本）检查是否过期，过期时自动重建。
     """
     log = status_callback if status_callback else lambda msg, level: print(f"[{level}] {msg}")
 
-    if os.path.exists(db_path) and os.path.getsize(db_path) > 0 and not force:
-        log(_("数据库 '{}' 已存在且有效，直接使用。").format(os.path.basename(db_path)), "DEBUG")
-        return db_path
+    if not force:
+        stale_reason = get_gff_db_staleness(db_path, gff_filepath, id_regex)
+        if stale_reason is None:
+            log(_("数据库 '{}' 已存在且有效，直接使用。").format(os.path.basename(db_path)), "DEBUG")
+            return db_path
+        if os.path.exists(db_path):
+            log(_("数据库 '{}' 需要重建: {}").format(os.path.basename(db_path), stale_reason), "INFO")
 
     db_dir = os.path.dirname(db_path)
     if not os.path.exists(db_dir):
@@ -95,35 +82,13 @@ def create_gff_database(
         "INFO")
 
     try:
-        def id_spec_func(feature):
-            original_id = feature.attributes.get('ID', [None])[0]
-            if not original_id:
-                return None
-            return _apply_regex_to_id(original_id, id_regex) if id_regex else original_id
-
-        gene_iterator = _gff_gene_filter(gff_filepath)
-
-        gffutils.create_db(
-            gene_iterator,
-            dbfn=db_path,
-            force=force,
-            id_spec=id_spec_func,
-            keep_order=True,
-            merge_strategy="merge",
-            sort_attribute_values=True,
-            disable_infer_transcripts=True,
-            disable_infer_genes=True,
-        )
-        log(_("成功创建GFF数据库: {}").format(os.path.basename(db_path)), "INFO")
+        stats = build_gff_database(gff_filepath, db_path, id_regex=id_regex, status_callback=log)
+        log(_("成功创建GFF数据库: {} ({} 个基因)").format(os.path.basename(db_path), stats['genes']), "INFO")
         return db_path
 
     except Exception as e:
+        # 构建在临时文件中进行，失败时原有数据库保持不变
         log(_("错误: 创建GFF数据库 '{}' 失败: {}").format(os.path.basename(db_path), e), "ERROR")
-        if os.path.exists(db_path):
-            try:
-                os.remove(db_path)
-            except OSError:
-                pass
         raise
 
 
@@ -147,32 +112,28 @@ def _apply_regex_to_id(gene_id: str, regex_pattern: Optional[str]) -> str:
     """
     使用正则表达式从一个字符串中提取基因ID，并清除首尾空白。
     """
-    processed_id = str(gene_id).strip()
-    if not regex_pattern:
-        return processed_id
-    match = re.search(regex_pattern, processed_id)
-    return match.group(1) if match and match.groups() else processed_id
+    return normalize_id(gene_id, regex_pattern, ID_MODE_FALLBACK)
 
 
-def get_genes_in_region(
+def get_genes_in_regions(
         assembly_id: str,
         gff_filepath: str,
         db_storage_dir: str,
-        region: Tuple[str, int, int],
+        regions: List[Tuple[str, int, int]],
         force_db_creation: bool = False,
         status_callback: Optional[Callable[[str, str], None]] = None,
         gene_id_regex: Optional[str] = None,
         progress_callback: Optional[Callable[[int, str], None]] = None
-) -> List[Dict[str, Any]]:
+) -> pd.DataFrame:
     """
-    从GFF文件中查找位于特定染色体区域内的所有基因，并报告进度。
+    批量查找位于多个染色体区域内的基因，直接返回 DataFrame。
+    使用缓存在磁盘上的基因区间索引，每个区域只需两次二分查找；结果中的 'region' 列标明基因所属的输入区域。
     """
     log = status_callback if status_callback else lambda msg, level: print(f"[{level}] {msg}")
     progress = progress_callback if progress_callback else lambda p, m: None
+    empty_df = pd.DataFrame(columns=['region'] + GENE_COLUMNS)
 
     db_path = os.path.join(db_storage_dir, f"{assembly_id}_genes.db")
-    user_chrom_part, start, end = region
-
     try:
         progress(10, _("正在准备GFF数据库..."))
         created_db_path = create_gff_database(gff_filepath, db_path, force_db_creation, status_callback,
@@ -180,28 +141,56 @@ def get_genes_in_region(
         if not created_db_path:
             raise RuntimeError(_("无法获取或创建GFF数据库，无法查询区域基因。"))
 
-        progress(40, _("正在打开数据库并查找序列ID..."))
-        db = gffutils.FeatureDB(created_db_path, keep_order=True)
-        full_seqid = _find_full_seqid(db, user_chrom_part, log)
+        progress(40, _("正在加载基因区间索引..."))
+        gene_index = load_gene_index(created_db_path)
+
+        # 同一染色体名只解析一次
+        all_seqids = gene_index.get_seqids()
+        resolved_seqids: Dict[str, Optional[str]] = {}
+        resolved_regions = []
+        for chrom_part, start, end in regions:
+            if chrom_part not in resolved_seqids:
+                resolved_seqids[chrom_part] = _find_full_seqid(all_seqids, chrom_part, log)
+            resolved_regions.append((resolved_seqids[chrom_part], int(start), int(end)))
 
-        if not full_seqid:
+        if not any(seqid for seqid, _s, _e in resolved_regions):
             progress(100, _("在数据库中未找到匹配的染色体/序列。"))
-            return []
+            return empty_df
 
-        progress(60, _("正在查询区域: {}...").format(f"{full_seqid}:{start}-{end}"))
-        genes_in_region = list(db.region(region=(full_seqid, start, end), featuretype='gene'))
+        progress(60, _("正在查询 {} 个区域...").format(len(regions)))
+        region_indices, rows = gene_index.query_regions(resolved_regions)
 
         progress(80, _("正在提取基因详细信息..."))
-        results = [extract_gene_details(gene) for gene in genes_in_region]
-        log(_("在区域内共找到 {} 个基因。").format(len(results)), "INFO")
+        result_df = gene_index.to_frame(rows)
+        region_labels = np.array([f"{chrom}:{start}-{end}" for chrom, start, end in regions], dtype=object)
+        result_df.insert(0, 'region', region_labels[region_indices] if len(rows) else [])
+        log(_("在 {} 个区域内共找到 {} 个基因。").format(len(regions), len(result_df)), "INFO")
         progress(100, _("区域基因提取完成。"))
-        return results
+        return result_df
 
     except Exception as e:
         log(_("查询GFF区域时发生错误: {}").format(e), "ERROR")
         logger.exception(_("GFF区域查询失败的完整堆栈跟踪:"))
         progress(100, _("查询时发生错误。"))
-        return []
+        return empty_df
+
+
+def get_genes_in_region(
+        assembly_id: str,
+        gff_filepath: str,
+        db_storage_dir: str,
+        region: Tuple[str, int, int],
+        force_db_creation: bool = False,
+        status_callback: Optional[Callable[[str, str], None]] = None,
+        gene_id_regex: Optional[str] = None,
+        progress_callback: Optional[Callable[[int, str], None]] = None
+) -> List[Dict[str, Any]]:
+    """
+    从GFF文件中查找位于特定染色体区域内的所有基因，并报告进度。
+    """
+    result_df = get_genes_in_regions(assembly_id, gff_filepath, db_storage_dir, [region], force_db_creation,
+                                     status_callback, gene_id_regex, progress_callback)
+    return result_df.drop(columns=['region']).to_dict('records')
 
 
 def get_gene_info_by_ids(
@@ -227,37 +216,21 @@ def get_gene_info_by_ids(
         if not created_db_path:
             raise RuntimeError(_("无法获取或创建GFF数据库，无法查询基因ID。"))
 
-        progress(40, _("正在打开数据库..."))
-        db = gffutils.FeatureDB(created_db_path, keep_order=True)
-
         log(_("正在根据 {} 个ID查询基因信息...").format(len(gene_ids)), "INFO")
-        found_genes = []
-        not_found_ids = []
-        total_ids = len(gene_ids)
-
-        for i, gene_id in enumerate(gene_ids):
-            # 在循环内部报告进度
-            if i % 100 == 0 or i == total_ids - 1:  # 每处理100个或最后一个时更新进度
-                percentage = 40 + int(((i + 1) / total_ids) * 55)  # 进度从40%到95%
-                progress(percentage, f"{_('正在查询基因')} {i + 1}/{total_ids}")
-
-            try:
-                gene_feature = db[gene_id]
-                found_genes.append(extract_gene_details(gene_feature))
-            except gffutils.exceptions.FeatureNotFoundError:
-                not_found_ids.append(gene_id)
+        # 分块批量查询，进度从40%到95%
+        result_df, not_found_ids = fetch_genes_by_ids(
+            created_db_path, gene_ids, progress_callback=lambda p, m: progress(40 + int(p * 0.55), m))
 
         if not_found_ids:
             log(_("警告: {} 个基因ID未在GFF数据库中找到: {}{}").format(len(not_found_ids), ', '.join(not_found_ids[:5]),
                                                                        '...' if len(not_found_ids) > 5 else ''),
                 "WARNING")
 
-        if not found_genes:
+        if result_df.empty:
             progress(100, _("查询完成，未找到任何基因。"))
             return pd.DataFrame()
 
-        result_df = pd.DataFrame(found_genes)
-        log(_("成功查询到 {} 个基因的详细信息。").format(len(found_genes)), "INFO")
+        log(_("成功查询到 {} 个基因的详细信息。").format(len(result_df)), "INFO")
         progress(100, _("基因查询完成。"))
         return result_df
 
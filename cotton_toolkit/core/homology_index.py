@@ -0,0 +1,206 @@
+﻿# cotton_toolkit/core/homology_index.py
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ..utils.id_normalizer import normalize_id_series
+from .homology_store import HOMOLOGY_SOURCE_ATTR, get_homology_store_dir, get_homology_store_checksum, \
+    load_homology_store
+
+# 国际化函数占位符
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.homology_index")
+
+HOMOLOGY_INDEX_VERSION = 1
+
+# 进程内缓存: (存储目录, 列名, 正则, 分数列) -> HomologyIndex
+_INDEX_CACHE: Dict[Tuple[str, str, Optional[str], str], 'HomologyIndex'] = {}
+_INDEX_CACHE_LOCK = threading.Lock()
+
+
+class HomologyIndex:
+    """
+    同源表的“标准化查询ID -> 行号”索引（CSR 结构）。
+    - keys: 排序后的唯一标准化ID；
+    - indptr: keys[i] 对应的命中位于 rows[indptr[i]:indptr[i+1]]；
+    - rows: 同源表中的行号，每个ID内部已按分数从高到低排序。
+    查询 N 个基因的代价为 O(N·log K + 命中数)，与同源表的总行数无关。
+    """
+
+    def __init__(self, keys: np.ndarray, indptr: np.ndarray, rows: np.ndarray, n_rows: int,
+                 source_sha256: Optional[str] = None):
+        self.keys = keys
+        self.indptr = indptr
+        self.rows = rows
+        self.n_rows = n_rows
+        self.source_sha256 = source_sha256
+
+    @classmethod
+    def build(cls, homology_df: pd.DataFrame, column: str, regex_pattern: Optional[str],
+              score_column: str = 'Score') -> 'HomologyIndex':
+        normalized = normalize_id_series(homology_df[column], regex_pattern)
+        codes, keys = pd.factorize(normalized, sort=True)
+
+        if score_column in homology_df.columns:
+            scores = pd.to_numeric(homology_df[score_column], errors='coerce').fillna(-np.inf).to_numpy()
+        else:
+            scores = np.zeros(len(homology_df))
+        # 先按ID编码、再按分数降序排序
+        order = np.lexsort((-scores, codes))
+        counts = np.bincount(codes, minlength=len(keys))
+        indptr = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return cls(np.asarray(keys, dtype=str), indptr, order.astype(np.int64), len(homology_df))
+
+    def lookup(self, query_ids: Iterable[str]) -> np.ndarray:
+        """返回给定标准化ID在同源表中的全部行号（每个ID内按分数降序）。"""
+        queries = np.asarray(sorted(set(query_ids)), dtype=str)
+        if len(queries) == 0 or len(self.keys) == 0:
+            return np.array([], dtype=np.int64)
+        positions = np.searchsorted(self.keys, queries)
+        valid = positions < len(self.keys)
+        valid[valid] = self.keys[positions[valid]] == queries[valid]
+        found = positions[valid]
+        if len(found) == 0:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([self.rows[self.indptr[p]:self.indptr[p + 1]] for p in found])
+
+    def save(self, index_dir: str, meta: Dict):
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, "keys.npy"), self.keys)
+        np.save(os.path.join(index_dir, "indptr.npy"), self.indptr)
+        np.save(os.path.join(index_dir, "rows.npy"), self.rows)
+        meta_path = os.path.join(index_dir, "meta.json")
+        tmp_path = f"{meta_path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({**meta, 'n_rows': self.n_rows, 'index_version': HOMOLOGY_INDEX_VERSION}, f, indent=2)
+        os.replace(tmp_path, meta_path)
+
+    @classmethod
+    def load(cls, index_dir: str, expected_checksum: str) -> Optional['HomologyIndex']:
+        meta_path = os.path.join(index_dir, "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('index_version') != HOMOLOGY_INDEX_VERSION or meta.get('source_sha256') != expected_checksum:
+                return None
+            return cls(np.load(os.path.join(index_dir, "keys.npy"), mmap_mode='r'),
+                       np.load(os.path.join(index_dir, "indptr.npy"), mmap_mode='r'),
+                       np.load(os.path.join(index_dir, "rows.npy"), mmap_mode='r'),
+                       meta['n_rows'], source_sha256=expected_checksum)
+        except (OSError, ValueError, KeyError):
+            return None
+
+
+def _index_dir_name(column: str, regex_pattern: Optional[str], score_column: str) -> str:
+    digest = hashlib.sha1(f"{column}\0{regex_pattern or ''}\0{score_column}".encode('utf-8')).hexdigest()[:16]
+    return f"index_{digest}"
+
+
+def get_or_build_homology_index(
+        source_path: str,
+        homology_df: pd.DataFrame,
+        column: str,
+        regex_pattern: Optional[str],
+        score_column: str = 'Score'
+) -> Optional[HomologyIndex]:
+    """
+    获取（必要时构建并持久化）同源文件某一列上的索引。
+    索引保存在该文件的列式存储目录内，存储重建时会一并失效。
+    """
+    checksum = get_homology_store_checksum(source_path)
+    if checksum is None:
+        return None
+
+    store_dir = get_homology_store_dir(source_path)
+    cache_key = (store_dir, column, regex_pattern, score_column)
+    with _INDEX_CACHE_LOCK:
+        cached = _INDEX_CACHE.get(cache_key)
+        if cached is not None and cached.source_sha256 == checksum:
+            return cached
+
+        index_dir = os.path.join(store_dir, _index_dir_name(column, regex_pattern, score_column))
+        index = HomologyIndex.load(index_dir, checksum)
+        if index is None:
+            logger.info(_("正在为 {} 的列 '{}' 构建同源查询索引...").format(os.path.basename(source_path), column))
+            index = HomologyIndex.build(homology_df, column, regex_pattern, score_column)
+            index.source_sha256 = checksum
+            try:
+                index.save(index_dir, {'column': column, 'regex': regex_pattern, 'score_column': score_column,
+                                       'source_sha256': checksum})
+            except OSError as e:
+                logger.warning(_("保存同源索引失败，本次仅在内存中使用: {}").format(e))
+
+        _INDEX_CACHE[cache_key] = index
+        return index
+
+
+def get_homology_index_for_df(
+        homology_df: pd.DataFrame,
+        column: str,
+        regex_pattern: Optional[str],
+        score_column: str = 'Score'
+) -> Optional[HomologyIndex]:
+    """
+    为由 load_homology_table 加载的 DataFrame 获取索引。
+    DataFrame 不是来自列式存储、或行数与存储不一致时返回 None，调用方应回退到全表筛选。
+    """
+    source_path = homology_df.attrs.get(HOMOLOGY_SOURCE_ATTR)
+    if not source_path or column not in homology_df.columns or not os.path.exists(source_path):
+        return None
+    try:
+        index = get_or_build_homology_index(source_path, homology_df, column, regex_pattern, score_column)
+    except Exception as e:
+        logger.warning(_("获取同源索引失败，将回退到全表筛选: {}").format(e))
+        return None
+    if index is None or index.n_rows != len(homology_df):
+        return None
+    return index
+
+
+def prebuild_homology_indexes(
+        file_path: str,
+        query_id_regex: Optional[str],
+        match_id_regex: Optional[str],
+        homology_columns: Optional[Dict[str, str]] = None,
+        status_callback: Optional[Callable[[str, str], None]] = None
+) -> bool:
+    """
+    为同源文件的查询列与匹配列预先构建索引，分别服务于“源 -> 桥梁”和反向的“桥梁 -> 目标”两个方向。
+    需在列式存储构建完成后调用。
+    """
+    log = status_callback if status_callback else lambda msg, level="INFO": logger.info(msg)
+    columns = homology_columns or {}
+    query_col, match_col = columns.get('query', 'Query'), columns.get('match', 'Match')
+    score_col = columns.get('score', 'Score')
+
+    try:
+        homology_df = load_homology_store(file_path)
+        if homology_df is None:
+            log(_("WARNING: 同源列式存储不可用，跳过索引预构建: {}").format(os.path.basename(file_path)), "WARNING")
+            return False
+        homology_df.attrs[HOMOLOGY_SOURCE_ATTR] = os.path.abspath(file_path)
+        for column, regex_pattern in ((query_col, query_id_regex), (match_col, match_id_regex)):
+            if get_homology_index_for_df(homology_df, column, regex_pattern, score_col) is None:
+                log(_("WARNING: 未能为列 '{}' 构建同源索引。").format(column), "WARNING")
+                return False
+        log(_("INFO: 同源查询索引已就绪: {}").format(os.path.basename(file_path)), "INFO")
+        return True
+    except Exception as e:
+        log(_("ERROR: 预构建同源索引失败 '{}': {}").format(os.path.basename(file_path), e), "ERROR")
+        return False
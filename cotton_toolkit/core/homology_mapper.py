@@ -5,8 +5,12 @@ import pandas as pd
 from typing import List, Dict, Any, Tuple, Optional, Callable
 
 from .gff_parser import _apply_regex_to_id
+from .homology_index import get_homology_index_for_df
+from .homology_store import HOMOLOGY_SOURCE_ATTR
 from ..config.models import GenomeSourceItem  # 确保导入了 GenomeSourceItem
 from ..utils.gene_utils import parse_gene_id  # 确保导入了 parse_gene_id
+from ..utils.id_normalizer import normalize_id_series, load_or_normalize_column
+from ..utils.file_utils import read_delimited_file
 
 try:
     import builtins
@@ -17,6 +21,9 @@ except (AttributeError, ImportError):
 
 logger = logging.getLogger("cotton_toolkit.homology_mapper")
 
+# 拟南芥（桥梁物种）基因ID的默认提取规则
+DEFAULT_BRIDGE_ID_REGEX = r'(AT[1-5MC]G\d{5})'
+
 
 def select_best_homologs(
         homology_df: pd.DataFrame,
@@ -77,12 +84,26 @@ def load_and_map_homology(
         raise ValueError(
             _("配置错误: 在同源文件中找不到匹配列 '{}'。可用列: {}").format(match_col, list(homology_df.columns)))
 
-    df_copy = homology_df.copy()
-    df_copy[query_col] = df_copy[query_col].astype(str).apply(lambda x: _apply_regex_to_id(x, query_id_regex))
-    df_copy[match_col] = df_copy[match_col].astype(str).apply(lambda x: _apply_regex_to_id(x, match_id_regex))
+    # 有预建索引时只取出被查询基因的命中行，避免对整张同源表做正则标准化和筛选
+    homology_index = None
+    if query_gene_ids:
+        homology_index = get_homology_index_for_df(homology_df, query_col, query_id_regex,
+                                                   homology_columns.get('score', 'Score'))
+
+    if homology_index is not None:
+        processed_query_ids = {_apply_regex_to_id(gid, query_id_regex) for gid in query_gene_ids}
+        df_copy = homology_df.iloc[homology_index.lookup(processed_query_ids)].copy()
+        df_copy[query_col] = normalize_id_series(df_copy[query_col], query_id_regex)
+        df_copy[match_col] = normalize_id_series(df_copy[match_col], match_id_regex)
+    else:
+        # 全表标准化的结果按 (文件, 列, 正则) 缓存，重复运行时无需再做一遍正则匹配
+        source_path = homology_df.attrs.get(HOMOLOGY_SOURCE_ATTR)
+        df_copy = homology_df.copy()
+        df_copy[query_col] = load_or_normalize_column(source_path, query_col, homology_df[query_col], query_id_regex)
+        df_copy[match_col] = load_or_normalize_column(source_path, match_col, homology_df[match_col], match_id_regex)
 
     filtered_df = df_copy
-    if query_gene_ids:
+    if query_gene_ids and homology_index is None:
         processed_query_ids = {_apply_regex_to_id(gid, query_id_regex) for gid in query_gene_ids}
         filtered_df = df_copy[df_copy[query_col].isin(processed_query_ids)]
 
@@ -93,9 +114,8 @@ def load_and_map_homology(
     best_hits_df = select_best_homologs(filtered_df, query_col, match_col, criteria)
 
     homology_map: Dict[str, List[Dict[str, Any]]] = {}
-    for _A, row in best_hits_df.iterrows():
-        query_id = row[query_col]
-        homology_map.setdefault(query_id, []).append(row.to_dict())
+    for record in best_hits_df.to_dict('records'):
+        homology_map.setdefault(record[query_col], []).append(record)
 
     return homology_map
 
@@ -110,7 +130,7 @@ def create_homology_df(file_path: str) -> pd.DataFrame:
         raise FileNotFoundError(_("同源文件未找到: {}").format(file_path))
 
     if file_path.lower().endswith(".csv"):
-        return pd.read_csv(file_path)
+        return read_delimited_file(file_path, sep=',')
     elif file_path.lower().endswith((".xlsx", ".xls")):
         # 如果是Excel，用pandas读取
         return pd.read_excel(file_path, engine='openpyxl')
@@ -149,7 +169,7 @@ def map_genes_via_bridge(
                                                               'gene_id_regex') and bridge_genome_info.gene_id_regex:
         bridge_id_regex = bridge_genome_info.gene_id_regex
     if not bridge_id_regex:
-        bridge_id_regex = r'(AT[1-5MC]G\d{5})'
+        bridge_id_regex = DEFAULT_BRIDGE_ID_REGEX
 
     user_top_n = selection_criteria_s_to_b.get('top_n', 1)
 
@@ -0,0 +1,279 @@
+﻿# cotton_toolkit/core/homology_store.py
+
+import gzip
+import json
+import logging
+import os
+import shutil
+from typing import List, Dict, Any, Optional, Callable
+
+import numpy as np
+import pandas as pd
+
+from ..utils.file_utils import get_file_checksum, get_file_fingerprint, get_sidecar_cache_path, \
+    read_delimited_file, WHITESPACE_SEPARATOR
+
+# 国际化函数占位符
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.homology_store")
+
+# 存储格式版本号，格式变化时递增，旧的存储会被自动视为过期
+HOMOLOGY_STORE_VERSION = 1
+HOMOLOGY_STORE_SUFFIX = ".columnar"
+MANIFEST_FILENAME = "manifest.json"
+# 从存储加载的 DataFrame 会在 attrs 中记录源文件路径，供索引等功能定位存储目录
+HOMOLOGY_SOURCE_ATTR = "homology_source_path"
+HEADER_KEYWORDS = ['Query', 'Match', 'Score', 'Exp', 'PID', 'evalue', 'identity']
+# 文本同源文件中基因ID列始终按字符串读取，数值列交给解析引擎推断
+TEXT_ID_DTYPES = {'Query': str, 'Match': str}
+
+
+def _find_header_row(sheet_df: pd.DataFrame, keywords: List[str]) -> Optional[int]:
+    for i in range(min(3, len(sheet_df))):
+        row_values_str = ' '.join([str(v).lower() for v in sheet_df.iloc[i].values])
+        if any(keyword.lower() in row_values_str for keyword in keywords):
+            return i
+    return None
+
+
+def get_homology_store_dir(file_path: str) -> str:
+    """获取同源文件对应的列式存储目录。"""
+    return get_sidecar_cache_path(file_path, HOMOLOGY_STORE_SUFFIX)
+
+
+def parse_homology_file(file_path: str, progress_callback: Optional[Callable] = None) -> pd.DataFrame:
+    """
+    解析原始的同源文件（Excel 多工作表或空白分隔的文本，均支持 .gz 压缩）。
+    这是较慢的路径，正常情况下只在构建列式存储时执行一次。
+    """
+    progress = progress_callback if progress_callback else lambda p, m: None
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(_("同源文件未找到: {}").format(file_path))
+
+    lowered_path = file_path.lower()
+
+    progress(0, _("正在打开文件: {}...").format(os.path.basename(file_path)))
+    with open(file_path, 'rb') as f_raw:
+        is_gz = lowered_path.endswith('.gz')
+        file_obj = gzip.open(f_raw, 'rb') if is_gz else f_raw
+        try:
+            progress(20, _("正在解析文件结构..."))
+            if lowered_path.endswith(('.xlsx', '.xlsx.gz', '.xls', '.xls.gz')):
+                xls = pd.ExcelFile(file_obj)
+                all_sheets_data = []
+                num_sheets = len(xls.sheet_names)
+                for i, sheet_name in enumerate(xls.sheet_names):
+                    progress(20 + int(60 * (i / num_sheets)), _("正在处理工作表: {}...").format(sheet_name))
+                    preview_df = pd.read_excel(xls, sheet_name=sheet_name, header=None, nrows=5)
+                    header_row_index = _find_header_row(preview_df, HEADER_KEYWORDS)
+                    if header_row_index is not None:
+                        sheet_df = pd.read_excel(xls, sheet_name=sheet_name, header=header_row_index)
+                        sheet_df.dropna(how='all', inplace=True)
+                        all_sheets_data.append(sheet_df)
+                if not all_sheets_data:
+                    raise ValueError(_("在Excel文件的任何工作表中都未能找到有效的表头或数据。"))
+                progress(80, _("正在合并所有工作表..."))
+                return pd.concat(all_sheets_data, ignore_index=True)
+            else:
+                progress(50, _("正在读取文本数据..."))
+                return read_delimited_file(file_path, sep=WHITESPACE_SEPARATOR, comment='#', dtype=TEXT_ID_DTYPES)
+        except Exception as e:
+            logger.error(_("读取同源文件 '{}' 时出错: {}").format(file_path, e))
+            raise
+        finally:
+            progress(100, _("文件加载完成。"))
+            if is_gz:
+                file_obj.close()
+
+
+def _read_manifest(store_dir: str) -> Optional[Dict[str, Any]]:
+    manifest_path = os.path.join(store_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(store_dir: str, manifest: Dict[str, Any]):
+    # 先写临时文件再替换，保证读取方永远不会看到写了一半的清单
+    manifest_path = os.path.join(store_dir, MANIFEST_FILENAME)
+    tmp_path = f"{manifest_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def _is_manifest_current(file_path: str, store_dir: str, manifest: Optional[Dict[str, Any]]) -> bool:
+    """
+    判断存储是否与源文件一致。大小与修改时间相同则直接信任；
+    否则重新计算校验和，内容未变时仅刷新清单中的指纹。
+    """
+    if not manifest or manifest.get('store_version') != HOMOLOGY_STORE_VERSION:
+        return False
+
+    source = manifest.get('source', {})
+    fingerprint = get_file_fingerprint(file_path)
+    if fingerprint['size'] != source.get('size'):
+        return False
+    if fingerprint['mtime'] == source.get('mtime'):
+        return True
+
+    if get_file_checksum(file_path) != source.get('sha256'):
+        return False
+    source['mtime'] = fingerprint['mtime']
+    try:
+        _write_manifest(store_dir, manifest)
+    except OSError:
+        pass
+    return True
+
+
+def write_homology_store(df: pd.DataFrame, file_path: str, source_checksum: Optional[str] = None) -> str:
+    """
+    将解析好的同源表写入列式存储。
+    - 数值列保存为原生 dtype 的 .npy 文件；
+    - 文本列做字典编码（int32 编码 + 定长 Unicode 类别表），可用内存映射快速加载。
+    """
+    store_dir = get_homology_store_dir(file_path)
+    if os.path.isdir(store_dir):
+        shutil.rmtree(store_dir)
+    os.makedirs(store_dir, exist_ok=True)
+
+    columns_meta = []
+    for i, column in enumerate(df.columns):
+        series = df[column]
+        if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+            data_file = f"col_{i}.npy"
+            np.save(os.path.join(store_dir, data_file), series.to_numpy())
+            columns_meta.append({'name': str(column), 'kind': 'numeric', 'data': data_file})
+        else:
+            as_text = series.where(series.isna(), series.astype(str))
+            codes, uniques = pd.factorize(as_text, use_na_sentinel=True)
+            categories = np.asarray(uniques, dtype=str) if len(uniques) else np.array([], dtype='U1')
+            codes_file, categories_file = f"col_{i}.codes.npy", f"col_{i}.categories.npy"
+            np.save(os.path.join(store_dir, codes_file), codes.astype(np.int32))
+            np.save(os.path.join(store_dir, categories_file), categories)
+            columns_meta.append({'name': str(column), 'kind': 'text', 'codes': codes_file,
+                                 'categories': categories_file})
+
+    fingerprint = get_file_fingerprint(file_path)
+    manifest = {
+        'store_version': HOMOLOGY_STORE_VERSION,
+        'source': {
+            'name': os.path.basename(file_path),
+            'size': fingerprint['size'],
+            'mtime': fingerprint['mtime'],
+            'sha256': source_checksum or get_file_checksum(file_path),
+        },
+        'n_rows': int(len(df)),
+        'columns': columns_meta,
+    }
+    _write_manifest(store_dir, manifest)
+    return store_dir
+
+
+def _load_text_column(store_dir: str, meta: Dict[str, Any]) -> np.ndarray:
+    codes = np.load(os.path.join(store_dir, meta['codes']), mmap_mode='r')
+    categories = np.load(os.path.join(store_dir, meta['categories']), mmap_mode='r').astype(object)
+    if len(categories) == 0:
+        return np.full(len(codes), np.nan, dtype=object)
+    values = categories.take(np.maximum(codes, 0))
+    missing = codes < 0
+    if missing.any():
+        values[missing] = np.nan
+    return values
+
+
+def get_homology_store_checksum(file_path: str) -> Optional[str]:
+    """返回当前有效存储所对应的源文件校验和；存储缺失或过期时返回 None。"""
+    store_dir = get_homology_store_dir(file_path)
+    manifest = _read_manifest(store_dir)
+    if not _is_manifest_current(file_path, store_dir, manifest):
+        return None
+    return manifest['source']['sha256']
+
+
+def load_homology_store(file_path: str) -> Optional[pd.DataFrame]:
+    """从列式存储中加载同源表；存储不存在或已过期时返回 None。"""
+    store_dir = get_homology_store_dir(file_path)
+    manifest = _read_manifest(store_dir)
+    if not _is_manifest_current(file_path, store_dir, manifest):
+        return None
+
+    try:
+        data = {}
+        for meta in manifest['columns']:
+            if meta['kind'] == 'numeric':
+                data[meta['name']] = np.array(np.load(os.path.join(store_dir, meta['data']), mmap_mode='r'))
+            else:
+                data[meta['name']] = _load_text_column(store_dir, meta)
+        return pd.DataFrame(data, columns=[meta['name'] for meta in manifest['columns']])
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning(_("同源列式存储 '{}' 读取失败，将重新解析源文件: {}").format(store_dir, e))
+        return None
+
+
+def build_homology_store(
+        file_path: str,
+        force: bool = False,
+        status_callback: Optional[Callable[[str, str], None]] = None,
+        progress_callback: Optional[Callable[[int, str], None]] = None
+) -> Optional[str]:
+    """
+    为同源文件构建列式存储（若已是最新则直接返回）。供下载器的后处理步骤调用。
+    """
+    log = status_callback if status_callback else lambda msg, level="INFO": logger.info(msg)
+    progress = progress_callback if progress_callback else lambda p, m: None
+    store_dir = get_homology_store_dir(file_path)
+
+    try:
+        if not force and _is_manifest_current(file_path, store_dir, _read_manifest(store_dir)):
+            log(_("INFO: 同源列式存储已是最新，跳过构建: {}").format(os.path.basename(file_path)), "INFO")
+            progress(100, _("列式存储已是最新。"))
+            return store_dir
+
+        log(_("INFO: 正在为 {} 构建同源列式存储...").format(os.path.basename(file_path)), "INFO")
+        df = parse_homology_file(file_path, progress_callback=lambda p, m: progress(int(p * 0.9), m))
+        write_homology_store(df, file_path)
+        log(_("INFO: 同源列式存储构建完成: {} ({} 行)").format(os.path.basename(file_path), len(df)), "INFO")
+        progress(100, _("列式存储构建完成。"))
+        return store_dir
+    except Exception as e:
+        log(_("ERROR: 构建同源列式存储失败 '{}': {}").format(os.path.basename(file_path), e), "ERROR")
+        return None
+
+
+def load_homology_table(file_path: str, progress_callback: Optional[Callable] = None) -> pd.DataFrame:
+    """
+    加载同源表：优先读取列式存储，存储缺失或过期时解析源文件并顺带写入存储，供后续调用复用。
+    """
+    progress = progress_callback if progress_callback else lambda p, m: None
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(_("同源文件未找到: {}").format(file_path))
+
+    progress(0, _("正在检查同源列式存储..."))
+    df = load_homology_store(file_path)
+    if df is not None:
+        df.attrs[HOMOLOGY_SOURCE_ATTR] = os.path.abspath(file_path)
+        progress(100, _("已从列式存储加载 {} 行。").format(len(df)))
+        return df
+
+    df = parse_homology_file(file_path, progress_callback=lambda p, m: progress(int(p * 0.9), m))
+    try:
+        progress(90, _("正在写入同源列式存储..."))
+        write_homology_store(df, file_path)
+        df.attrs[HOMOLOGY_SOURCE_ATTR] = os.path.abspath(file_path)
+    except Exception as e:
+        logger.warning(_("写入同源列式存储失败，本次仍使用解析结果: {}").format(e))
+    progress(100, _("文件加载完成。"))
+    return df
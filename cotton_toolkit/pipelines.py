@@ -1,14 +1,14 @@
 ﻿# cotton_toolkit/pipelines.py
 
-import gzip
 import io
 import logging
+import multiprocessing
 import os
 import re
 import threading
 import time
 import traceback
-from concurrent.futures import as_completed, ThreadPoolExecutor
+from concurrent.futures import as_completed, ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from dataclasses import asdict
 from typing import List, Dict, Any, Optional, Callable, Tuple
 
@@ -18,15 +18,23 @@ from .config.loader import get_genome_data_sources, get_local_downloaded_file_pa
 from .config.models import (
     MainConfig, HomologySelectionCriteria, GenomeSourceItem
 )
+from .core.ai_engine import AIExecutionEngine
+from .core.ai_pool import AIProviderPool
 from .core.ai_wrapper import AIWrapper
 from .core.convertXlsx2csv import convert_excel_to_standard_csv
+from .core.download_engine import DownloadEngine
 from .core.downloader import download_genome_data
-from .core.gff_parser import get_genes_in_region, extract_gene_details, create_gff_database, get_gene_info_by_ids
+from .core.gff_parser import get_genes_in_region, get_genes_in_regions, extract_gene_details, create_gff_database, \
+    get_gene_info_by_ids
+from .core.bridge_map_store import get_bridge_map_key, get_bridge_map_path, get_bridge_map_inputs, \
+    is_bridge_map_current, lookup_bridge_map, build_bridge_map
 from .core.homology_mapper import map_genes_via_bridge
+from .core.homology_store import load_homology_table
 from .tools.annotator import Annotator
 from .tools.batch_ai_processor import process_single_csv_file
-from .tools.enrichment_analyzer import run_go_enrichment, run_kegg_enrichment
-from .tools.visualizer import plot_enrichment_bubble, plot_enrichment_bar, plot_enrichment_upset, plot_enrichment_cnet
+from .tools.bsa_analyzer import analyze_bsa_vcf
+from .tools.enrichment_analyzer import run_go_enrichment, run_kegg_enrichment, run_batch_enrichment
+from .tools.visualizer import render_plot_jobs
 from .utils.gene_utils import map_transcripts_to_genes
 
 # 【核心修改】使用更健壮的方式来设置翻译函数
@@ -38,56 +46,61 @@ except ImportError:
 
 logger = logging.getLogger("cotton_toolkit.pipelines")
 
-def _find_header_row(sheet_df: pd.DataFrame, keywords: List[str]) -> Optional[int]:
-    for i in range(min(3, len(sheet_df))):
-        row_values_str = ' '.join([str(v).lower() for v in sheet_df.iloc[i].values])
-        if any(keyword.lower() in row_values_str for keyword in keywords):
-            return i
-    return None
+HOMOLOGY_COLUMNS = {"query": "Query", "match": "Match", "evalue": "Exp", "score": "Score", "pid": "PID"}
+LOCUS_CONVERSION_CRITERIA = {"top_n": 1, "evalue_threshold": 1e-10}
 
+def create_homology_df(file_path: str, progress_callback: Optional[Callable] = None) -> pd.DataFrame:
+    """
+    加载同源数据表。优先使用已构建的列式存储（由下载器后处理或首次加载时自动生成），
+    只有在存储缺失或源文件发生变化时才重新解析原始的 Excel/文本文件。
+    """
+    return load_homology_table(file_path, progress_callback=progress_callback)
 
 
-def create_homology_df(file_path: str, progress_callback: Optional[Callable] = None) -> pd.DataFrame:
-    progress = progress_callback if progress_callback else lambda p, m: None
-    if not os.path.exists(file_path):
-        raise FileNotFoundError(_("同源文件未找到: {}").format(file_path))
 
-    lowered_path = file_path.lower()
-    header_keywords = ['Query', 'Match', 'Score', 'Exp', 'PID', 'evalue', 'identity']
+def _get_bridge_map_storage_dir(config: MainConfig) -> str:
+    base_dir = os.path.dirname(config.config_file_abs_path_) if config.config_file_abs_path_ else '.'
+    return os.path.join(base_dir, config.locus_conversion.bridge_map_storage_dir)
 
-    progress(0, _("正在打开文件: {}...").format(os.path.basename(file_path)))
-    with open(file_path, 'rb') as f_raw:
-        is_gz = lowered_path.endswith('.gz')
-        file_obj = gzip.open(f_raw, 'rb') if is_gz else f_raw
-        try:
-            progress(20, _("正在解析文件结构..."))
-            if lowered_path.endswith(('.xlsx', '.xlsx.gz', '.xls', '.xls.gz')):
-                xls = pd.ExcelFile(file_obj)
-                all_sheets_data = []
-                num_sheets = len(xls.sheet_names)
-                for i, sheet_name in enumerate(xls.sheet_names):
-                    progress(20 + int(60 * (i / num_sheets)), _("正在处理工作表: {}...").format(sheet_name))
-                    preview_df = pd.read_excel(xls, sheet_name=sheet_name, header=None, nrows=5)
-                    header_row_index = _find_header_row(preview_df, header_keywords)
-                    if header_row_index is not None:
-                        sheet_df = pd.read_excel(xls, sheet_name=sheet_name, header=header_row_index)
-                        sheet_df.dropna(how='all', inplace=True)
-                        all_sheets_data.append(sheet_df)
-                if not all_sheets_data:
-                    raise ValueError(_("在Excel文件的任何工作表中都未能找到有效的表头或数据。"))
-                progress(80, _("正在合并所有工作表..."))
-                return pd.concat(all_sheets_data, ignore_index=True)
-            else:
-                progress(50, _("正在读取文本数据..."))
-                return pd.read_csv(file_obj, sep=r'\s+', engine='python', comment='#')
-        except Exception as e:
-            logger.error(_("读取同源文件 '{}' 时出错: {}").format(file_path, e))
-            raise
-        finally:
-            progress(100, _("文件加载完成。"))
-            if is_gz:
-                file_obj.close()
 
+def _get_ai_cache_dir(config: MainConfig) -> str:
+    base_dir = os.path.dirname(config.config_file_abs_path_) if config.config_file_abs_path_ else '.'
+    return os.path.join(base_dir, config.batch_ai_processor.cache_dir)
+
+
+def _lookup_precomputed_bridge_map(
+        config: MainConfig,
+        source_assembly_id: str,
+        target_assembly_id: str,
+        s_to_b_homology_file: str,
+        b_to_t_homology_file: str,
+        selection_criteria_s_to_b: Dict[str, Any],
+        selection_criteria_b_to_t: Dict[str, Any],
+        source_genome_info: GenomeSourceItem,
+        target_genome_info: GenomeSourceItem,
+        bridge_genome_info: Optional[GenomeSourceItem],
+        source_gene_ids: List[str],
+        log: Callable
+) -> Optional[Tuple[pd.DataFrame, List[str]]]:
+    """
+    若该基因组对在当前筛选标准下已有最新的预计算映射表，则直接按基因ID查询，否则返回 None。
+    """
+    map_key = get_bridge_map_key(selection_criteria_s_to_b, selection_criteria_b_to_t, HOMOLOGY_COLUMNS,
+                                 source_genome_info, target_genome_info,
+                                 getattr(bridge_genome_info, 'gene_id_regex', None))
+    db_path = get_bridge_map_path(_get_bridge_map_storage_dir(config), source_assembly_id, target_assembly_id, map_key)
+    try:
+        result = lookup_bridge_map(db_path, get_bridge_map_inputs(s_to_b_homology_file, b_to_t_homology_file, map_key),
+                                   source_gene_ids, source_genome_info.gene_id_regex)
+    except Exception as e:
+        log(_("读取预计算映射表失败，将实时计算: {}").format(e), "WARNING")
+        return None
+
+    if result is not None:
+        log(_("使用预计算的映射表: {}").format(os.path.basename(db_path)), "INFO")
+        if result[1]:
+            log(_("信息: {} 个源基因未能找到符合条件的同源匹配。").format(len(result[1])), "INFO")
+    return result
 
 
 def _update_config_from_overrides(config_obj: Any, overrides: Optional[Dict[str, Any]]):
@@ -158,19 +171,10 @@ def run_homology_mapping(
         progress(30, _("步骤 3: 加载同源文件...")) # 更新进度
         s_to_b_homology_file = get_local_downloaded_file_path(config, source_genome_info, 'homology_ath')
         b_to_t_homology_file = get_local_downloaded_file_path(config, target_genome_info, 'homology_ath')
-        # 调用 create_homology_df 时传递 progress_callback，并计算更细致的进度
-        source_to_bridge_homology_df = create_homology_df(s_to_b_homology_file,
-                                                          progress_callback=lambda p, m: progress(30 + int(p * 0.3), _("加载源到桥梁文件: {}").format(m))) # 30%-60%
-        bridge_to_target_homology_df = create_homology_df(b_to_t_homology_file,
-                                                          progress_callback=lambda p, m: progress(60 + int(p * 0.2), _("加载桥梁到目标文件: {}").format(m))) # 60%-80%
 
-
-        log(_("步骤 4: 通过桥梁物种执行基因映射..."), "INFO")
         s2b_criteria = HomologySelectionCriteria()
         b2t_criteria = HomologySelectionCriteria()
-        homology_columns = {
-            "query": "Query", "match": "Match", "evalue": "Exp", "score": "Score", "pid": "PID"
-        }
+        homology_columns = dict(HOMOLOGY_COLUMNS)
 
         # 应用来自UI的覆盖参数
         s2b_dict = s2b_criteria.model_dump()
@@ -183,24 +187,39 @@ def run_homology_mapping(
                     if key in b2t_dict:
                         b2t_dict[key] = value
 
-        # map_genes_via_bridge 内部应该有自己的进度报告
-        mapped_df, failed_genes = map_genes_via_bridge(
-            source_gene_ids=source_gene_ids,
-            source_assembly_name=source_assembly_id,
-            target_assembly_name=target_assembly_id,
-            bridge_species_name=bridge_species_name,
-            source_to_bridge_homology_df=source_to_bridge_homology_df,
-            bridge_to_target_homology_df=bridge_to_target_homology_df,
-            selection_criteria_s_to_b=s2b_dict,
-            selection_criteria_b_to_t=b2t_dict,
-            homology_columns=homology_columns,
-            source_genome_info=source_genome_info,
-            target_genome_info=target_genome_info,
-            bridge_genome_info=bridge_genome_info,
-            status_callback=status_callback,
-            progress_callback=lambda p, m: progress(80 + int(p * 0.1), _("基因映射: {}").format(m)), # 80%-90%
-            cancel_event=cancel_event
-        )
+        # 已有预计算映射表时直接按基因ID查询，无需加载同源文件
+        precomputed = _lookup_precomputed_bridge_map(
+            config, source_assembly_id, target_assembly_id, s_to_b_homology_file, b_to_t_homology_file,
+            s2b_dict, b2t_dict, source_genome_info, target_genome_info, bridge_genome_info, source_gene_ids, log)
+        if precomputed is not None:
+            mapped_df, failed_genes = precomputed
+            progress(90, _("已从预计算映射表获取结果。"))
+        else:
+            # 调用 create_homology_df 时传递 progress_callback，并计算更细致的进度
+            source_to_bridge_homology_df = create_homology_df(s_to_b_homology_file,
+                                                              progress_callback=lambda p, m: progress(30 + int(p * 0.3), _("加载源到桥梁文件: {}").format(m))) # 30%-60%
+            bridge_to_target_homology_df = create_homology_df(b_to_t_homology_file,
+                                                              progress_callback=lambda p, m: progress(60 + int(p * 0.2), _("加载桥梁到目标文件: {}").format(m))) # 60%-80%
+
+            log(_("步骤 4: 通过桥梁物种执行基因映射..."), "INFO")
+            # map_genes_via_bridge 内部应该有自己的进度报告
+            mapped_df, failed_genes = map_genes_via_bridge(
+                source_gene_ids=source_gene_ids,
+                source_assembly_name=source_assembly_id,
+                target_assembly_name=target_assembly_id,
+                bridge_species_name=bridge_species_name,
+                source_to_bridge_homology_df=source_to_bridge_homology_df,
+                bridge_to_target_homology_df=bridge_to_target_homology_df,
+                selection_criteria_s_to_b=s2b_dict,
+                selection_criteria_b_to_t=b2t_dict,
+                homology_columns=homology_columns,
+                source_genome_info=source_genome_info,
+                target_genome_info=target_genome_info,
+                bridge_genome_info=bridge_genome_info,
+                status_callback=status_callback,
+                progress_callback=lambda p, m: progress(80 + int(p * 0.1), _("基因映射: {}").format(m)), # 80%-90%
+                cancel_event=cancel_event
+            )
 
         if cancel_event and cancel_event.is_set():
             log(_("INFO: 任务在基因映射阶段被用户取消。"), "INFO")
@@ -337,40 +356,48 @@ def run_locus_conversion(
             progress(100, _("任务终止：缺少同源文件。"))
             return None
 
-        progress(40, _("正在解析源到桥梁的同源文件..."))
-        source_to_bridge_homology_df = create_homology_df(s_to_b_homology_file,
-                                                          progress_callback=lambda p, m: progress(40 + int(p * 0.2), _("解析同源文件 (S->B): {}").format(m))) # 40%-60%
-        progress(60, _("正在解析桥梁到目标的同源文件..."))
-        bridge_to_target_homology_df = create_homology_df(b_to_t_homology_file,
-                                                          progress_callback=lambda p, m: progress(60 + int(p * 0.1), _("解析同源文件 (B->T): {}").format(m))) # 60%-70%
-
-        homology_columns = {"query": "Query", "match": "Match", "evalue": "Exp", "score": "Score", "pid": "PID"}
-        if homology_columns['query'] not in source_to_bridge_homology_df.columns:
-            raise ValueError(_("配置错误: 在同源文件中找不到查询列 '{}'。可用列: {}").format(homology_columns['query'],
-                                                                                            source_to_bridge_homology_df.columns.tolist()))
-
-
-        selection_criteria_s_to_b = {"top_n": 1, "evalue_threshold": 1e-10}
-        selection_criteria_b_to_t = {"top_n": 1, "evalue_threshold": 1e-10}
-
-        progress(75, _("正在执行核心同源映射..."))
-        mapped_df, failed_genes = map_genes_via_bridge(
-            source_gene_ids=source_gene_ids,
-            source_assembly_name=source_assembly_id,
-            target_assembly_name=target_assembly_id,
-            bridge_species_name=bridge_species_name,
-            source_to_bridge_homology_df=source_to_bridge_homology_df,
-            bridge_to_target_homology_df=bridge_to_target_homology_df,
-            selection_criteria_s_to_b=selection_criteria_s_to_b,
-            selection_criteria_b_to_t=selection_criteria_b_to_t,
-            homology_columns=homology_columns,
-            source_genome_info=source_genome_info,
-            target_genome_info=target_genome_info,
-            bridge_genome_info=bridge_genome_info,
-            status_callback=status_callback,
-            progress_callback=lambda p, m: progress(75 + int(p * 0.15), _("基因映射: {}").format(m)), # 75%-90%
-            cancel_event=kwargs.get('cancel_event')
-        )
+        selection_criteria_s_to_b = dict(LOCUS_CONVERSION_CRITERIA)
+        selection_criteria_b_to_t = dict(LOCUS_CONVERSION_CRITERIA)
+
+        # 已有预计算映射表时直接按基因ID查询，无需加载同源文件
+        precomputed = _lookup_precomputed_bridge_map(
+            config, source_assembly_id, target_assembly_id, s_to_b_homology_file, b_to_t_homology_file,
+            selection_criteria_s_to_b, selection_criteria_b_to_t, source_genome_info, target_genome_info,
+            bridge_genome_info, source_gene_ids, log)
+        if precomputed is not None:
+            mapped_df, failed_genes = precomputed
+            progress(90, _("已从预计算映射表获取结果。"))
+        else:
+            progress(40, _("正在解析源到桥梁的同源文件..."))
+            source_to_bridge_homology_df = create_homology_df(s_to_b_homology_file,
+                                                              progress_callback=lambda p, m: progress(40 + int(p * 0.2), _("解析同源文件 (S->B): {}").format(m))) # 40%-60%
+            progress(60, _("正在解析桥梁到目标的同源文件..."))
+            bridge_to_target_homology_df = create_homology_df(b_to_t_homology_file,
+                                                              progress_callback=lambda p, m: progress(60 + int(p * 0.1), _("解析同源文件 (B->T): {}").format(m))) # 60%-70%
+
+            homology_columns = dict(HOMOLOGY_COLUMNS)
+            if homology_columns['query'] not in source_to_bridge_homology_df.columns:
+                raise ValueError(_("配置错误: 在同源文件中找不到查询列 '{}'。可用列: {}").format(homology_columns['query'],
+                                                                                                source_to_bridge_homology_df.columns.tolist()))
+
+            progress(75, _("正在执行核心同源映射..."))
+            mapped_df, failed_genes = map_genes_via_bridge(
+                source_gene_ids=source_gene_ids,
+                source_assembly_name=source_assembly_id,
+                target_assembly_name=target_assembly_id,
+                bridge_species_name=bridge_species_name,
+                source_to_bridge_homology_df=source_to_bridge_homology_df,
+                bridge_to_target_homology_df=bridge_to_target_homology_df,
+                selection_criteria_s_to_b=selection_criteria_s_to_b,
+                selection_criteria_b_to_t=selection_criteria_b_to_t,
+                homology_columns=homology_columns,
+                source_genome_info=source_genome_info,
+                target_genome_info=target_genome_info,
+                bridge_genome_info=bridge_genome_info,
+                status_callback=status_callback,
+                progress_callback=lambda p, m: progress(75 + int(p * 0.15), _("基因映射: {}").format(m)), # 75%-90%
+                cancel_event=kwargs.get('cancel_event')
+            )
 
         if kwargs.get('cancel_event') and kwargs['cancel_event'].is_set():
             log(_("任务在同源映射阶段被用户取消。"), "INFO")
@@ -403,6 +430,95 @@ def run_locus_conversion(
         return None
 
 
+def run_build_bridge_maps(
+        config: MainConfig,
+        source_assembly_ids: Optional[List[str]] = None,
+        target_assembly_ids: Optional[List[str]] = None,
+        force: bool = False,
+        status_callback: Optional[Callable[[str, str], None]] = None,
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_event: Optional[threading.Event] = None
+) -> bool:
+    """
+    为基因组对预计算“源 -> 桥梁 -> 目标”的完整映射表，使同源映射与位点转换变为按基因ID的直接查询。
+    同时为同源映射的默认筛选标准和位点转换的筛选标准各构建一张表；只重建同源文件发生变化的基因组对。
+    """
+    log = status_callback if status_callback else lambda msg, level: print(f"[{level}] {msg}")
+    progress = progress_callback if progress_callback else lambda p, m: None
+
+    progress(0, _("开始预计算同源映射表..."))
+    genome_sources = get_genome_data_sources(config, logger_func=log)
+    if not genome_sources:
+        log(_("未能加载基因组源数据。"), "ERROR")
+        progress(100, _("任务终止：未能加载基因组源。"))
+        return False
+
+    bridge_genome_info = genome_sources.get("Arabidopsis_thaliana") or genome_sources.get("Arabidopsis thaliana")
+
+    homology_files = {}
+    for assembly_id, genome_info in genome_sources.items():
+        if not genome_info.is_cotton():
+            continue
+        homology_file = get_local_downloaded_file_path(config, genome_info, 'homology_ath')
+        if homology_file and os.path.exists(homology_file):
+            homology_files[assembly_id] = homology_file
+
+    default_criteria = HomologySelectionCriteria().model_dump()
+    criteria_profiles = [(default_criteria, default_criteria), (LOCUS_CONVERSION_CRITERIA, LOCUS_CONVERSION_CRITERIA)]
+    pairs = [(s, t) for s in homology_files for t in homology_files if s != t
+             and (not source_assembly_ids or s in source_assembly_ids)
+             and (not target_assembly_ids or t in target_assembly_ids)]
+    if not pairs:
+        log(_("没有可用于预计算的基因组对，请先下载相关基因组的同源文件。"), "WARNING")
+        progress(100, _("任务终止：无可用的基因组对。"))
+        return False
+
+    storage_dir = _get_bridge_map_storage_dir(config)
+    os.makedirs(storage_dir, exist_ok=True)
+    loaded_dfs: Dict[str, pd.DataFrame] = {}
+    total_tasks = len(pairs) * len(criteria_profiles)
+    built_count, skipped_count = 0, 0
+
+    for i, (source_id, target_id) in enumerate(pairs):
+        for j, (s2b_criteria, b2t_criteria) in enumerate(criteria_profiles):
+            if cancel_event and cancel_event.is_set():
+                log(_("任务被用户取消。"), "INFO")
+                progress(100, _("任务已取消。"))
+                return False
+
+            task_index = i * len(criteria_profiles) + j
+            task_progress = lambda p, m, base=task_index: progress(int((base + p / 100) / total_tasks * 95), m)
+            source_genome_info, target_genome_info = genome_sources[source_id], genome_sources[target_id]
+            map_key = get_bridge_map_key(s2b_criteria, b2t_criteria, HOMOLOGY_COLUMNS, source_genome_info,
+                                         target_genome_info, getattr(bridge_genome_info, 'gene_id_regex', None))
+            db_path = get_bridge_map_path(storage_dir, source_id, target_id, map_key)
+
+            if not force and is_bridge_map_current(
+                    db_path, get_bridge_map_inputs(homology_files[source_id], homology_files[target_id], map_key)):
+                skipped_count += 1
+                continue
+
+            for assembly_id in (source_id, target_id):
+                if assembly_id not in loaded_dfs:
+                    loaded_dfs[assembly_id] = create_homology_df(homology_files[assembly_id])
+            # 加载时会按需构建列式存储，因此要在加载后再读取输入的校验和
+            inputs = get_bridge_map_inputs(homology_files[source_id], homology_files[target_id], map_key)
+            if inputs is None:
+                log(_("无法确定 {} -> {} 的同源文件校验和，跳过。").format(source_id, target_id), "WARNING")
+                continue
+
+            log(_("正在预计算映射表: {} -> {}").format(source_id, target_id), "INFO")
+            if build_bridge_map(db_path, inputs, source_id, target_id, loaded_dfs[source_id], loaded_dfs[target_id],
+                                dict(s2b_criteria), dict(b2t_criteria), dict(HOMOLOGY_COLUMNS), source_genome_info,
+                                target_genome_info, bridge_genome_info, progress_callback=task_progress,
+                                cancel_event=cancel_event):
+                built_count += 1
+
+    log(_("映射表预计算完成：新建 {} 张，{} 张已是最新。").format(built_count, skipped_count), "INFO")
+    progress(100, _("映射表预计算完成。"))
+    return True
+
+
 def run_ai_task(
         config: MainConfig,
         input_file: str,
@@ -426,8 +542,9 @@ def run_ai_task(
     # AI客户端和服务商的初始化逻辑 (这部分不变)
     progress(5, _("正在解析AI服务配置..."))
     ai_cfg = config.ai_services
-    provider_name = cli_overrides.get('ai_provider') if cli_overrides else ai_cfg.default_provider
-    model_name = cli_overrides.get('ai_model') if cli_overrides else None
+    overrides = cli_overrides or {}
+    provider_name = overrides.get('ai_provider') or ai_cfg.default_provider
+    model_name = overrides.get('ai_model')
     provider_cfg_obj = ai_cfg.providers.get(provider_name)
     if not provider_cfg_obj:
         log(_("错误: 在配置中未找到AI服务商 '{}' 的设置。").format(provider_name), "ERROR");
@@ -435,7 +552,14 @@ def run_ai_task(
     if not model_name: model_name = provider_cfg_obj.model
     api_key = provider_cfg_obj.api_key
     base_url = provider_cfg_obj.base_url
-    if not api_key or "YOUR_API_KEY" in api_key:
+
+    # 显式指定了服务商或模型时（图形界面总是如此）只使用该服务商，但仍在它的多个 API Key 之间组成服务池；
+    # 否则使用配置的服务池，或默认服务商的多个 API Key
+    explicit_provider = bool(overrides.get('ai_provider') or overrides.get('ai_model'))
+    pool_providers = [] if explicit_provider else list(ai_cfg.pool_providers)
+    if not pool_providers and provider_cfg_obj.extra_api_keys:
+        pool_providers = [provider_name]
+    if not pool_providers and (not api_key or "YOUR_API_KEY" in api_key):
         log(_("错误: 请在配置文件中为服务商 '{}' 设置一个有效的API Key。").format(provider_name), "ERROR");
         return
 
@@ -443,9 +567,25 @@ def run_ai_task(
         exclude_none=True) if ai_cfg.use_proxy_for_ai and config.proxies else None
 
     progress(10, _("正在初始化AI客户端..."))
-    log(_("正在初始化AI客户端... 服务商: {}, 模型: {}").format(provider_name, model_name))
-    ai_client = AIWrapper(provider=provider_name, api_key=api_key, model=model_name, base_url=base_url,
-                          proxies=proxies_to_use, max_workers=config.batch_ai_processor.max_workers)
+    batch_cfg = config.batch_ai_processor
+    if pool_providers:
+        try:
+            ai_engine = AIProviderPool.from_config(ai_cfg, batch_cfg, pool_providers, proxies=proxies_to_use,
+                                                   status_callback=log,
+                                                   model_override=overrides.get('ai_model') if explicit_provider
+                                                   else None)
+        except ValueError as e:
+            log(_("错误: {}").format(e), "ERROR")
+            return
+        log(_("正在初始化AI服务池... 端点: {}").format(", ".join(e.name for e in ai_engine.endpoints)))
+        ai_client = ai_engine.endpoints[0].engine.client
+        max_concurrency = ai_engine.max_concurrency
+    else:
+        log(_("正在初始化AI客户端... 服务商: {}, 模型: {}").format(provider_name, model_name))
+        max_concurrency = provider_cfg_obj.max_concurrency or batch_cfg.max_workers
+        ai_client = AIWrapper(provider=provider_name, api_key=api_key, model=model_name, base_url=base_url,
+                              proxies=proxies_to_use, max_workers=max_concurrency)
+        ai_engine = AIExecutionEngine.from_config(ai_client, provider_cfg_obj, batch_cfg, status_callback=log)
 
     # 确定要使用的提示词 (这部分不变)
     prompt_to_use = custom_prompt_template or (
@@ -480,12 +620,24 @@ def run_ai_task(
         new_column_name=new_column,
         user_prompt_template=prompt_to_use,
         task_identifier=f"{os.path.basename(input_file)}_{task_type}",
-        max_row_workers=config.batch_ai_processor.max_workers,
+        max_row_workers=max_concurrency,
         status_callback=status_callback,
         progress_callback=lambda p, m: progress(15 + int(p * 0.8), _("AI处理: {}").format(m)),
         cancel_event=cancel_event,
-        output_csv_path=final_output_path  # 传递最终路径
+        engine=ai_engine,
+        output_csv_path=final_output_path,  # 传递最终路径
+        temperature=batch_cfg.temperature if overrides.get('temperature') is None else overrides['temperature'],
+        cache_directory=_get_ai_cache_dir(config),
+        cache_size_limit_mb=batch_cfg.cache_size_limit_mb,
+        cache_ttl_days=batch_cfg.cache_ttl_days,
+        max_rows_per_request=overrides.get('max_rows_per_request') or batch_cfg.max_rows_per_request,
+        max_tokens=batch_cfg.max_tokens,
+        chunk_rows=overrides.get('chunk_rows') or batch_cfg.chunk_rows
     )
+    if isinstance(ai_engine, AIProviderPool):
+        for stats in ai_engine.get_stats():
+            log(_("端点 {endpoint}: 请求 {requests} 次，失败 {failures} 次，平均延迟 {latency} 秒。").format(**stats),
+                "DEBUG")
 
     if cancel_event and cancel_event.is_set():
         log("INFO: 任务已被用户取消。", "INFO");
@@ -774,6 +926,100 @@ def run_gff_lookup(
     return True
 
 
+def run_bsa_analysis(
+        config: MainConfig,
+        vcf_path: str,
+        assembly_id: Optional[str] = None,
+        pool1_sample: Optional[str] = None,
+        pool2_sample: Optional[str] = None,
+        output_dir: Optional[str] = None,
+        cli_overrides: Optional[Dict[str, Any]] = None,
+        status_callback: Optional[Callable[[str, str], None]] = None,
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_event: Optional[threading.Event] = None
+) -> bool:
+    """
+    混池分离分析（BSA）流程：按 config.bsa_analyzer 的参数计算滑动窗口 Δ(SNP-index) 并找出候选区域；
+    提供 assembly_id 时，再用该基因组的GFF基因索引列出候选区域内的基因（bsa_candidate_genes.csv）。
+    """
+    log = status_callback if status_callback else lambda msg, level="INFO": print(f"[{level}] {msg}")
+    progress = progress_callback if progress_callback else lambda p, m: None
+
+    progress(0, _("BSA分析流程开始..."))
+    log(_("开始BSA分析流程..."), "INFO")
+
+    if not vcf_path or not os.path.exists(vcf_path):
+        log(_("错误: VCF文件不存在: {}").format(vcf_path), "ERROR")
+        progress(100, _("任务终止：输入文件缺失。"))
+        return False
+
+    bsa_cfg = config.bsa_analyzer.model_copy()
+    _update_config_from_overrides(bsa_cfg, cli_overrides)
+
+    if not output_dir:
+        project_root = '.'
+        if hasattr(config, 'config_file_abs_path_') and config.config_file_abs_path_:
+            project_root = os.path.dirname(config.config_file_abs_path_)
+        output_dir = os.path.join(project_root, bsa_cfg.output_dir_name)
+
+    # 注释候选区域需要GFF，先检查，避免耗时的计算完成后才发现缺少文件
+    gff_file_path = None
+    genome_info = None
+    if assembly_id:
+        genome_info = get_genome_data_sources(config, logger_func=log).get(assembly_id)
+        if not genome_info:
+            log(_("错误: 基因组 '{}' 未在基因组源列表中找到。").format(assembly_id), "ERROR")
+            progress(100, _("任务终止：基因组配置错误。"))
+            return False
+        gff_file_path = get_local_downloaded_file_path(config, genome_info, 'gff3')
+        if not gff_file_path or not os.path.exists(gff_file_path):
+            log(_("错误: 未找到基因组 '{}' 的GFF文件。请先下载数据。").format(assembly_id), "ERROR")
+            progress(100, _("任务终止：GFF文件缺失。"))
+            return False
+
+    results = analyze_bsa_vcf(
+        vcf_path=vcf_path, output_dir=output_dir,
+        window_size=bsa_cfg.window_size, step_size=bsa_cfg.step_size,
+        min_depth=bsa_cfg.min_depth, delta_threshold=bsa_cfg.delta_threshold,
+        pool1_sample=pool1_sample, pool2_sample=pool2_sample,
+        min_snps_per_window=bsa_cfg.min_snps_per_window, min_snp_index=bsa_cfg.min_snp_ratio,
+        max_workers=bsa_cfg.max_workers,
+        status_callback=log,
+        progress_callback=lambda p, m: progress(int(p * (0.85 if assembly_id else 1.0)), m),
+        cancel_event=cancel_event
+    )
+    if results is None:
+        if cancel_event and cancel_event.is_set():
+            progress(100, _("任务已取消。"))
+        else:
+            progress(100, _("任务终止：BSA分析失败。"))
+        return False
+
+    regions_df = results['regions']
+    if assembly_id and not regions_df.empty:
+        progress(85, _("正在查询候选区域内的基因..."))
+        gff_db_dir = config.locus_conversion.gff_db_storage_dir
+        os.makedirs(gff_db_dir, exist_ok=True)
+        regions = list(regions_df[['chrom', 'start', 'end']].itertuples(index=False, name=None))
+        genes_df = get_genes_in_regions(
+            assembly_id=assembly_id, gff_filepath=gff_file_path, db_storage_dir=gff_db_dir,
+            regions=regions, status_callback=log,
+            gene_id_regex=getattr(genome_info, 'gene_id_regex', None),
+            progress_callback=lambda p, m: progress(85 + int(p * 0.14), m)
+        )
+        genes_path = os.path.join(output_dir, "bsa_candidate_genes.csv")
+        try:
+            genes_df.to_csv(genes_path, index=False, encoding='utf-8-sig')
+        except Exception as e:
+            log(_("保存结果时出错: {}").format(e), "ERROR")
+            progress(100, _("任务终止：保存结果失败。"))
+            return False
+        log(_("候选区域内共有 {} 个基因，已保存到: {}").format(len(genes_df), genes_path), "INFO")
+
+    progress(100, _("BSA分析流程结束。"))
+    return True
+
+
 def run_download_pipeline(
         config: MainConfig,
         cli_overrides: Optional[Dict[str, Any]] = None,
@@ -845,7 +1091,9 @@ def run_download_pipeline(
     log(_("INFO: 准备下载 {} 个文件...").format(len(all_download_tasks)))
 
     successful_downloads, failed_downloads = 0, 0
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+    # 所有文件共享同一个下载引擎，从而复用同一个HTTP连接池
+    engine = DownloadEngine.from_config(downloader_cfg, proxies=proxies_to_use)
+    with engine, ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_task = {
             executor.submit(
                 download_genome_data,
@@ -858,6 +1106,7 @@ def run_download_pipeline(
                 proxies=proxies_to_use,
                 status_callback=log,
                 cancel_event=cancel_event,
+                engine=engine,
             ): task for task in all_download_tasks
         }
 
@@ -908,8 +1157,17 @@ def run_enrichment_pipeline(
         show_title: bool = True,
         width: float = 10,
         height: float = 8,
-        file_format: str = 'png'
+        file_format: str = 'png',
+        plot_workers: Optional[int] = None,
+        cnet_layout: str = 'auto',
+        write_matching_report: bool = True
 ) -> Optional[List[str]]:
+    """
+    执行富集分析并生成图表。图表在渲染阶段按 (命名空间, 图表类型) 分发到进程池并行绘制，
+    plot_workers 为并行进程数（默认按任务数与CPU核心数取较小值，1 表示在当前进程中依次绘制）。
+    cnet_layout 为网络图的布局引擎，见 plot_enrichment_cnet。
+    write_matching_report 为 False 时跳过 gene_matching_report.csv 的生成。
+    """
     log = lambda msg, level="INFO": status_callback(msg, level)
     progress = progress_callback if progress_callback else lambda p, m: None
 
@@ -950,6 +1208,7 @@ def run_enrichment_pipeline(
         # Assuming run_go_enrichment can take progress_callback
         enrichment_df = run_go_enrichment(study_gene_ids=study_gene_ids, go_annotation_path=gaf_path,
                                           output_dir=output_dir, status_callback=log, gene_id_regex=gene_id_regex,
+                                          genome_id=assembly_id, write_matching_report=write_matching_report,
                                           progress_callback=lambda p, m: progress(20 + int(p * 0.4), _("GO富集: {}").format(m))) # 20%-60%
 
     elif analysis_type == 'kegg':
@@ -962,6 +1221,7 @@ def run_enrichment_pipeline(
         # Assuming run_kegg_enrichment can take progress_callback
         enrichment_df = run_kegg_enrichment(study_gene_ids=study_gene_ids, kegg_pathways_path=pathways_path,
                                             output_dir=output_dir, status_callback=log, gene_id_regex=gene_id_regex,
+                                            genome_id=assembly_id, write_matching_report=write_matching_report,
                                             progress_callback=lambda p, m: progress(20 + int(p * 0.4), _("KEGG富集: {}").format(m))) # 20%-60%
 
 
@@ -982,92 +1242,42 @@ def run_enrichment_pipeline(
 
     progress(60, _("富集分析完成，正在生成图表..."))
 
-    generated_plots = []
-    total_plot_types = len(plot_types)
-    current_plot_index = 0
-
     plot_kwargs_common = {
         'top_n': top_n, 'sort_by': sort_by, 'show_title': show_title, 'width': width, 'height': height
     }
 
+    # 先按原有顺序收集所有 (子集, 图表类型) 的绘图任务，再统一交给渲染阶段
     if analysis_type == 'go' and 'Namespace' in enrichment_df.columns:
-        namespaces = enrichment_df['Namespace'].unique()
-        for ns in namespaces:
-            df_sub = enrichment_df[enrichment_df['Namespace'] == ns]
-            if df_sub.empty: continue
-
-            title_ns = f"GO Enrichment - {ns}"
-            file_prefix_ns = f"go_enrichment_{ns}"
-
-            if 'bubble' in plot_types:
-                progress_each_plot = (40 / total_plot_types) / len(namespaces) if total_plot_types > 0 else 0
-                current_plot_index += 1
-                progress(60 + int(progress_each_plot * (current_plot_index-1)), _("生成气泡图 ({})").format(ns))
-                output_path = os.path.join(output_dir, f"{file_prefix_ns}_bubble.{file_format}")
-                plot_path = plot_enrichment_bubble(enrichment_df=df_sub, output_path=output_path, title=title_ns,
-                                                   **plot_kwargs_common)
-                if plot_path: generated_plots.append(plot_path)
-
-            if 'bar' in plot_types:
-                progress_each_plot = (40 / total_plot_types) / len(namespaces) if total_plot_types > 0 else 0
-                current_plot_index += 1
-                progress(60 + int(progress_each_plot * (current_plot_index-1)), _("生成条形图 ({})").format(ns))
-                output_path = os.path.join(output_dir, f"{file_prefix_ns}_bar.{file_format}")
-                plot_path = plot_enrichment_bar(enrichment_df=df_sub, output_path=output_path, title=title_ns,
-                                                gene_log2fc_map=gene_log2fc_map, **plot_kwargs_common)
-                if plot_path: generated_plots.append(plot_path)
-
-            if 'upset' in plot_types:
-                progress_each_plot = (40 / total_plot_types) / len(namespaces) if total_plot_types > 0 else 0
-                current_plot_index += 1
-                progress(60 + int(progress_each_plot * (current_plot_index-1)), _("生成Upset图 ({})").format(ns))
-                output_path = os.path.join(output_dir, f"{file_prefix_ns}_upset.{file_format}")
-                plot_path = plot_enrichment_upset(enrichment_df=df_sub, output_path=output_path, top_n=top_n)
-                if plot_path: generated_plots.append(plot_path)
-
-            if 'cnet' in plot_types:
-                progress_each_plot = (40 / total_plot_types) / len(namespaces) if total_plot_types > 0 else 0
-                current_plot_index += 1
-                progress(60 + int(progress_each_plot * (current_plot_index-1)), _("生成网络图(Cnet) ({})").format(ns))
-                output_path = os.path.join(output_dir, f"{file_prefix_ns}_cnet.{file_format}")
-                plot_path = plot_enrichment_cnet(enrichment_df=df_sub, output_path=output_path, top_n=top_n,
-                                                 gene_log2fc_map=gene_log2fc_map)
-                if plot_path: generated_plots.append(plot_path)
-    else: # 非GO分析，不分命名空间
+        plot_groups = [(f"GO Enrichment - {ns}", f"go_enrichment_{ns}", f" ({ns})",
+                        enrichment_df[enrichment_df['Namespace'] == ns])
+                       for ns in enrichment_df['Namespace'].unique()]
+    else:  # 非GO分析，不分命名空间
+        plot_groups = [(f"{analysis_type.upper()} Enrichment", f"{analysis_type}_enrichment", "", enrichment_df)]
+
+    plot_labels = {'bubble': _("生成气泡图"), 'bar': _("生成条形图"), 'upset': _("生成Upset图"),
+                   'cnet': _("生成网络图(Cnet)")}
+    plot_jobs = []
+    for title, file_prefix, label_suffix, df_sub in plot_groups:
+        if df_sub.empty: continue
         for plot_type in plot_types:
-            progress_each_plot = (40 / total_plot_types) if total_plot_types > 0 else 0
-            current_plot_index += 1
-            current_progress_val = 60 + int(progress_each_plot * (current_plot_index-1))
-
-            title = f"{analysis_type.upper()} Enrichment"
-            file_prefix = f"{analysis_type}_enrichment"
-
+            if plot_type not in plot_labels: continue
+            output_path = os.path.join(output_dir, f"{file_prefix}_{plot_type}.{file_format}")
             if plot_type == 'bubble':
-                progress(current_progress_val, _("生成气泡图..."))
-                output_path = os.path.join(output_dir, f"{file_prefix}_bubble.{file_format}")
-                plot_path = plot_enrichment_bubble(enrichment_df=enrichment_df, output_path=output_path, title=title,
-                                                   **plot_kwargs_common)
-                if plot_path: generated_plots.append(plot_path)
-
+                plot_kwargs = dict(enrichment_df=df_sub, output_path=output_path, title=title, **plot_kwargs_common)
             elif plot_type == 'bar':
-                progress(current_progress_val, _("生成条形图..."))
-                output_path = os.path.join(output_dir, f"{file_prefix}_bar.{file_format}")
-                plot_path = plot_enrichment_bar(enrichment_df=enrichment_df, output_path=output_path, title=title,
-                                                gene_log2fc_map=gene_log2fc_map, **plot_kwargs_common)
-                if plot_path: generated_plots.append(plot_path)
-
+                plot_kwargs = dict(enrichment_df=df_sub, output_path=output_path, title=title,
+                                   gene_log2fc_map=gene_log2fc_map, **plot_kwargs_common)
             elif plot_type == 'upset':
-                progress(current_progress_val, _("生成Upset图..."))
-                output_path = os.path.join(output_dir, f"{file_prefix}_upset.{file_format}")
-                plot_path = plot_enrichment_upset(enrichment_df=enrichment_df, output_path=output_path, top_n=top_n)
-                if plot_path: generated_plots.append(plot_path)
-
-            elif plot_type == 'cnet':
-                progress(current_progress_val, _("生成网络图(Cnet)..."))
-                output_path = os.path.join(output_dir, f"{file_prefix}_cnet.{file_format}")
-                plot_path = plot_enrichment_cnet(enrichment_df=enrichment_df, output_path=output_path, top_n=top_n,
-                                                 gene_log2fc_map=gene_log2fc_map)
-                if plot_path: generated_plots.append(plot_path)
+                plot_kwargs = dict(enrichment_df=df_sub, output_path=output_path, top_n=top_n)
+            else:
+                plot_kwargs = dict(enrichment_df=df_sub, output_path=output_path, top_n=top_n,
+                                   gene_log2fc_map=gene_log2fc_map, layout=cnet_layout)
+            plot_jobs.append((plot_type, plot_kwargs, plot_labels[plot_type] + label_suffix))
+
+    plot_results = render_plot_jobs(plot_jobs, max_workers=plot_workers,
+                                    progress_callback=lambda p, m: progress(60 + int(p * 0.4), m),
+                                    cancel_event=cancel_event)
+    generated_plots = [plot_path for plot_path in plot_results if plot_path]
 
     progress(100, _("所有图表已生成。"))
     log(_("流程完成。在 '{}' 中成功生成 {} 个图表。").format(output_dir, len(generated_plots)), "INFO")
@@ -1075,14 +1285,97 @@ def run_enrichment_pipeline(
     return generated_plots
 
 
+# 批量富集分析时从目录中读取的基因列表文件类型
+GENE_LIST_EXTENSIONS = ('.txt', '.csv', '.tsv', '.list')
+
+
+def read_gene_list_dir(gene_lists_dir: str) -> Dict[str, List[str]]:
+    """读取目录中的每个基因列表文件（第一列为基因ID），以去掉扩展名的文件名作为基因集名称。"""
+    study_sets = {}
+    for file_name in sorted(os.listdir(gene_lists_dir)):
+        file_path = os.path.join(gene_lists_dir, file_name)
+        if not os.path.isfile(file_path) or not file_name.lower().endswith(GENE_LIST_EXTENSIONS):
+            continue
+        gene_ids = []
+        with open(file_path, 'r', encoding='utf-8-sig', errors='ignore') as f:
+            for line in f:
+                first_field = re.split(r'[\t,;]', line.strip(), maxsplit=1)[0].strip()
+                if first_field:
+                    gene_ids.append(first_field)
+        study_sets[os.path.splitext(file_name)[0]] = list(dict.fromkeys(gene_ids))
+    return study_sets
+
+
+def run_batch_enrichment_pipeline(
+        config: MainConfig,
+        assembly_id: str,
+        study_sets: Dict[str, List[str]],
+        analysis_type: str,
+        output_dir: str,
+        collapse_transcripts: bool = False,
+        max_workers: Optional[int] = None,
+        status_callback: Optional[Callable] = None,
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_event: Optional[threading.Event] = None
+) -> Optional[pd.DataFrame]:
+    """
+    对多个基因集（例如数百个差异表达基因簇）批量执行GO或KEGG富集分析。
+    背景只加载一次，不生成图表；每个基因集输出一个结果文件，另有一张合并长表。
+    """
+    log = status_callback if status_callback else lambda msg, level="INFO": print(f"[{level}] {msg}")
+    progress = progress_callback if progress_callback else lambda p, m: None
+
+    progress(0, _("批量富集分析流程启动。"))
+    if not study_sets:
+        log(_("ERROR: 未提供任何基因集。"), "ERROR")
+        progress(100, _("任务终止：无基因集。"))
+        return None
+
+    if collapse_transcripts:
+        study_sets = {name: map_transcripts_to_genes(gene_ids) for name, gene_ids in study_sets.items()}
+
+    genome_info = get_genome_data_sources(config, logger_func=log).get(assembly_id)
+    if not genome_info:
+        log(_("ERROR: 无法在配置中找到基因组 '{}'。").format(assembly_id), "ERROR")
+        progress(100, _("任务终止：基因组配置错误。"))
+        return None
+
+    file_key = {'go': 'GO', 'kegg': 'KEGG_pathways'}.get(analysis_type.lower())
+    if not file_key:
+        log(_("ERROR: 未知的分析类型 '{}'。").format(analysis_type), "ERROR")
+        progress(100, _("任务终止：分析类型未知。"))
+        return None
+    annotation_path = get_local_downloaded_file_path(config, genome_info, file_key)
+    if not annotation_path or not os.path.exists(annotation_path):
+        log(_("ERROR: 未找到 '{}' 的{}注释文件。请先下载数据。").format(assembly_id, analysis_type.upper()), "ERROR")
+        progress(100, _("任务终止：缺少注释文件。"))
+        return None
+
+    return run_batch_enrichment(
+        study_sets=study_sets, annotation_path=annotation_path, analysis_type=analysis_type.lower(),
+        output_dir=output_dir, status_callback=log, gene_id_regex=getattr(genome_info, 'gene_id_regex', None),
+        genome_id=assembly_id, max_workers=max_workers, progress_callback=progress, cancel_event=cancel_event)
+
+
+def _convert_annotation_file_worker(source: str, output: str, cancel_event) -> Tuple[bool, List[Tuple[str, str]]]:
+    """进程池任务：转换一个注释文件，日志先收集起来，由主进程按顺序输出。"""
+    messages = []
+    succeeded = convert_excel_to_standard_csv(source, output, status_callback=lambda msg, level="INFO": messages.append(
+        (msg, level)), cancel_event=cancel_event)
+    return succeeded, messages
 
 
 def run_preprocess_annotation_files(
         config: MainConfig,
         status_callback: Optional[Callable[[str, str], None]] = None,
         progress_callback: Optional[Callable[[int, str], None]] = None,
-        cancel_event: Optional[threading.Event] = None
+        cancel_event: Optional[threading.Event] = None,
+        max_workers: Optional[int] = None
 ) -> bool:
+    """
+    将所有已下载且尚未转换（或源文件更新过）的注释 Excel 文件转换为 CSV。
+    多个文件时在进程池中并行转换；每个文件都先写临时文件再原子替换，取消或失败时不会留下不完整的 CSV。
+    """
     log = status_callback if status_callback else lambda msg, level: print(f"[{level}] {msg}")
     progress = progress_callback if progress_callback else lambda p, m: None
 
@@ -1117,21 +1410,59 @@ def run_preprocess_annotation_files(
     total_tasks = len(tasks_to_run)
     progress(20, _("找到 {} 个文件需要进行预处理。").format(total_tasks))
     log(_("找到 {} 个文件需要进行预处理。").format(total_tasks), "INFO")
-    success_count = 0
 
-    for i, (source, output) in enumerate(tasks_to_run):
-        if cancel_event and cancel_event.is_set():
-            log(_("任务被用户取消。"), "INFO")
-            progress(100, _("任务已取消。"))
-            return False
+    workers = max_workers if max_workers is not None else max(1, (os.cpu_count() or 1) - 1)
+    workers = min(workers, total_tasks)
+    success_count = 0
+    completed = 0
 
+    def report(source: str, succeeded: bool):
+        nonlocal success_count, completed
+        completed += 1
+        success_count += int(succeeded)
         # 将进度映射到 20% 到 95% 之间
-        progress_percentage = 20 + int(((i + 1) / total_tasks) * 75)
-        progress(progress_percentage, _("正在转换: {} ({}/{})").format(os.path.basename(source), i + 1, total_tasks))
+        progress(20 + int((completed / total_tasks) * 75),
+                 _("已转换: {} ({}/{})").format(os.path.basename(source), completed, total_tasks))
 
-        # convert_excel_to_standard_csv 内部也应该有自己的进度回调，这里不再嵌套
-        if convert_excel_to_standard_csv(source, output, log):
-            success_count += 1
+    if workers <= 1:
+        for source, output in tasks_to_run:
+            if cancel_event and cancel_event.is_set():
+                log(_("任务被用户取消。"), "INFO")
+                progress(100, _("任务已取消。"))
+                return False
+            report(source, convert_excel_to_standard_csv(source, output, status_callback=log,
+                                                         cancel_event=cancel_event))
+    else:
+        log(_("使用 {} 个进程并行转换注释文件。").format(workers), "INFO")
+        # 工作进程无法访问主进程的 threading.Event，通过 Manager 共享一个事件，取消时由主进程转发
+        with multiprocessing.Manager() as manager, ProcessPoolExecutor(max_workers=workers) as executor:
+            shared_cancel = manager.Event()
+            future_to_source = {
+                executor.submit(_convert_annotation_file_worker, source, output, shared_cancel): source
+                for source, output in tasks_to_run
+            }
+            pending = set(future_to_source)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source = future_to_source[future]
+                    try:
+                        succeeded, messages = future.result()
+                    except Exception as e:
+                        succeeded, messages = False, [
+                            (_("转换 {} 的工作进程异常退出: {}").format(os.path.basename(source), e), "ERROR")]
+                    for message, level in messages:
+                        log(message, level)
+                    report(source, succeeded)
+                if pending and cancel_event and cancel_event.is_set():
+                    shared_cancel.set()
+                    for future in pending:
+                        future.cancel()
+                    # 等待正在运行的转换响应取消并清理各自的临时文件
+                    wait(pending)
+                    log(_("任务被用户取消。"), "INFO")
+                    progress(100, _("任务已取消。"))
+                    return False
 
     log(_("预处理完成。成功转换 {}/{} 个文件。").format(success_count, total_tasks), "INFO")
     progress(100, _("预处理完成。"))
@@ -2,13 +2,13 @@
 
 import logging
 import os
-import re
 import pandas as pd
 from typing import List, Dict, Optional, Callable
 
 from ..config.models import MainConfig, GenomeSourceItem
 from ..config.loader import get_local_downloaded_file_path
 from ..utils.file_utils import smart_load_file
+from ..utils.id_normalizer import normalize_id, load_or_normalize_column, ID_MODE_EXTRACT
 
 logger = logging.getLogger("cotton_toolkit.annotator")
 
@@ -44,6 +44,7 @@ class Annotator:
         self.log = status_callback if status_callback else lambda msg, level="INFO": logger.info(f"[{level}] {msg}")
         self.progress = progress_callback if progress_callback else lambda p, m: logger.info(f"[{p}%] {m}")
         self.db_cache: Dict[str, pd.DataFrame] = {}
+        self.db_source_paths: Dict[str, str] = {}
         self.custom_db_dir = custom_db_dir
         if self.custom_db_dir:
             self.log(_("INFO: 将优先使用自定义注释数据库目录: {}").format(self.custom_db_dir))
@@ -73,7 +74,8 @@ class Annotator:
             return None
 
         self.log(_("INFO: 正在加载预处理的注释文件: {}").format(os.path.basename(processed_csv_path)), "INFO")
-        df = smart_load_file(processed_csv_path, logger_func=self.log)
+        # 只用到前三列（Query/Match/Description），且都按文本读取
+        df = smart_load_file(processed_csv_path, logger_func=self.log, usecols=[0, 1, 2], dtype=str)
 
         if df is not None and not df.empty:
             # --- 最终解决方案：无论CSV表头是什么，都强制在内存中重命名 ---
@@ -86,6 +88,7 @@ class Annotator:
             self.log(_("DEBUG: 强制重命名后的列名: {}").format(df.columns.tolist()), "DEBUG")
 
             self.db_cache[db_key] = df
+            self.db_source_paths[db_key] = processed_csv_path
             return df
         else:
             self.log(_("ERROR: 无法加载文件或文件为空: {}。").format(processed_csv_path), "ERROR")
@@ -109,9 +112,8 @@ class Annotator:
 
         input_id_map = {}
         for original_id in gene_ids:
-            match = re.search(regex, original_id, re.IGNORECASE)
-            if match:
-                core_id = match.group(0).lower()
+            core_id = normalize_id(original_id, regex, ID_MODE_EXTRACT, ignore_case=True, lowercase=True)
+            if core_id is not None:
                 if core_id not in input_id_map:
                     input_id_map[core_id] = original_id
             else:
@@ -133,8 +135,11 @@ class Annotator:
             anno_df = self._load_annotation_db(db_key)
             if anno_df is None or anno_df.empty: continue
 
-            anno_df['Core_ID'] = anno_df['Query'].astype(str).str.extract(regex, flags=re.IGNORECASE,
-                                                                          expand=False).str.lower()
+            # 每个注释表的核心ID只计算一次，并按 (文件, 正则) 缓存到磁盘，供后续运行复用
+            if 'Core_ID' not in anno_df.columns:
+                anno_df['Core_ID'] = load_or_normalize_column(
+                    self.db_source_paths.get(db_key), 'Query', anno_df['Query'], regex, ID_MODE_EXTRACT,
+                    ignore_case=True, lowercase=True)
 
             matched_df = anno_df.dropna(subset=['Core_ID']).copy()
             matched_df = matched_df[matched_df['Core_ID'].isin(input_id_map.keys())]
@@ -1,14 +1,16 @@
 ﻿# cotton_toolkit/tools/batch_ai_processor.py
 
+import codecs
+import hashlib
+import json
 import os
 import threading
-import time
-from typing import Optional, Callable
+from typing import Optional, Callable, Dict, List, Any, Tuple
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from diskcache import Cache
-from functools import partial
-from ..core.ai_wrapper import AIWrapper
+from ..core.ai_engine import AIExecutionEngine, AICancelled, estimate_tokens, is_retryable_error
+from ..core.ai_wrapper import AIWrapper, AIServiceError, DEFAULT_TEMPERATURE
+from ..utils.file_utils import get_file_fingerprint
 
 # --- 国际化和日志设置 ---
 try:
@@ -20,84 +22,159 @@ except (AttributeError, ImportError):
         return text
 
 # --- 全局变量 ---
-CACHE_DIRECTORY_BASE = "tmp/.ai_cache"
-client_global: 'AIWrapper'
-
-
-def _prepare_cache(task_identifier: str, log: Callable) -> Optional[Cache]:
-    cache_directory = f"{CACHE_DIRECTORY_BASE}_{task_identifier}"
+# 所有任务共用一个按内容寻址的缓存：同样的提示词、模型、温度和文本只会调用一次AI
+DEFAULT_CACHE_DIRECTORY = os.path.join("tmp", ".ai_cache")
+DEFAULT_CACHE_SIZE_LIMIT_MB = 512
+# 缓存键格式版本号，键的组成变化时递增
+CACHE_KEY_VERSION = 1
+# 打包模式：多行文本以 JSON 数组放入同一个请求，模型按 id 返回每一行的结果
+PACKED_PROMPT_TEMPLATE = """{instructions}
+
+The input is a JSON array of objects with an "id" and a "text" field. Apply the instructions above to each "text" independently.
+Return ONLY a JSON array of objects, one per input item, each with the same "id" and a "result" field containing the output for that text. Do not add any other commentary.
+
+Input:
+{items}"""
+PACKED_TEXT_PLACEHOLDER = '[the "text" of each input item]'
+# 估算打包请求大小时，每行的固定开销（JSON 结构与 id）及输出相对输入的 token 倍数
+PACKED_ROW_OVERHEAD_TOKENS = 10
+PACKED_OUTPUT_TOKEN_FACTOR = 2
+# 流式模式：已完成的分块先追加到 <输出>.partial，进度记录在 <输出>.ai_checkpoint.json
+PARTIAL_SUFFIX = ".partial"
+CHECKPOINT_SUFFIX = ".ai_checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+
+def _prepare_cache(cache_directory: str, size_limit_mb: int, log: Callable) -> Optional[Cache]:
+    """打开全局AI缓存。超过大小上限时按最近最少使用淘汰。"""
     try:
         os.makedirs(cache_directory, exist_ok=True)
-        cache = Cache(cache_directory)
-        log(_("任务 '{}' 的缓存目录: {}").format(task_identifier, os.path.abspath(cache_directory)), "DEBUG")
+        cache = Cache(cache_directory, size_limit=int(size_limit_mb * 1024 * 1024),
+                      eviction_policy='least-recently-used')
+        log(_("AI缓存目录: {}").format(os.path.abspath(cache_directory)), "DEBUG")
         return cache
     except Exception as e:
         log(_("错误: 无法创建缓存目录 {}: {}").format(cache_directory, e), "ERROR")
         return None
 
 
-def _process_text_with_ai(
-        text_to_process: str,
-        cache: Cache,
-        user_prompt_template: str,
-        task_identifier: str,
-        status_callback: Callable,
-        retries: int = 3,
-        delay: int = 5,
-        cancel_event: Optional[threading.Event] = None,
-) -> str:
-    """
-    使用 AIWrapper.process() 处理文本。
-    """
-    # 在函数开头就检查一次
-    if cancel_event and cancel_event.is_set():
-        return "PROCESSING_CANCELLED"
-
-    if not text_to_process or not isinstance(text_to_process, str) or not text_to_process.strip():
-        return ""
+def _hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
-    cache_key = f"{task_identifier}::{user_prompt_template}::{text_to_process}"
 
-    cached_result = cache.get(cache_key)
-    if cached_result is not None:
-        return cached_result
+def get_ai_cache_key(cache_identity: Tuple[str, str], user_prompt_template: str, temperature: float, text: str) -> str:
+    """缓存键 = 提示词哈希 + 服务商/模型 + 温度 + 文本哈希，与任务名和文件无关，可跨任务复用。"""
+    provider, model = cache_identity
+    return "v{}:{}:{}:{}:{}:{}".format(CACHE_KEY_VERSION, provider, model, temperature,
+                                       _hash_text(user_prompt_template), _hash_text(text))
 
-    for attempt in range(retries):
-        # 在每次尝试前都检查
-        if cancel_event and cancel_event.is_set():
-            return "PROCESSING_CANCELLED"
 
+def _build_packs(texts: List[str], max_rows: int, max_tokens: int, instruction_tokens: int = 0) -> List[List[str]]:
+    """
+    按行数上限与 max_tokens 预算（指令、各行输入与预计输出之和）把文本依次分组，超出预算的单行文本独立成组。
+    instruction_tokens 为每个请求都要携带的指令部分，先从预算中扣除。
+    """
+    max_tokens = max_tokens - instruction_tokens
+    packs, current, current_tokens = [], [], 0
+    for text in texts:
+        row_tokens = (estimate_tokens(text) + PACKED_ROW_OVERHEAD_TOKENS) * PACKED_OUTPUT_TOKEN_FACTOR
+        if current and (len(current) >= max_rows or current_tokens + row_tokens > max_tokens):
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += row_tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+def _build_packed_prompt(user_prompt_template: str, texts: List[str]) -> str:
+    items = json.dumps([{"id": i, "text": text} for i, text in enumerate(texts)], ensure_ascii=False)
+    instructions = user_prompt_template.format(text=PACKED_TEXT_PLACEHOLDER).strip()
+    return PACKED_PROMPT_TEMPLATE.format(instructions=instructions, items=items)
+
+
+def _parse_packed_response(response: str, count: int) -> Dict[int, str]:
+    """从模型回复中解析 JSON 数组（允许外层包裹 Markdown 代码块），返回通过校验的 id -> 结果。"""
+    start, end = response.find('['), response.rfind(']')
+    if start < 0 or end <= start:
+        return {}
+    try:
+        items = json.loads(response[start:end + 1])
+    except ValueError:
+        return {}
+    if not isinstance(items, list):
+        return {}
+
+    results = {}
+    for item in items:
+        if not isinstance(item, dict) or not isinstance(item.get('result'), str):
+            continue
         try:
-            global client_global
-            processed_text = client_global.process(
-                text=text_to_process,
-                custom_prompt_template=user_prompt_template
-            )
-
-            if processed_text:
-                if processed_text.startswith('"') and processed_text.endswith('"'):
-                    processed_text = processed_text[1:-1]
-                cache.set(cache_key, processed_text)
-                return processed_text
-            cache.set(cache_key, "")
-            return ""
-        except Exception as e:
-            status_callback(_("API调用错误: {}。在 {}秒 后重试 {}/{}。").format(e, delay, attempt + 1, retries),
-                            "WARNING")
-
-            if attempt < retries - 1:
-                # 在长时间等待前再次检查
-                if cancel_event and cancel_event.is_set():
-                    return "PROCESSING_CANCELLED"
-                time.sleep(delay)
-            else:
-                status_callback(
-                    _("警告: 经过 {} 次尝试后，文本 '{}' 处理失败。").format(retries, text_to_process[:50] + '...'),
-                    "ERROR")
-                return f"PROCESSING_ERROR: {e}"
+            row_id = int(item.get('id'))
+        except (TypeError, ValueError):
+            continue
+        if 0 <= row_id < count:
+            results[row_id] = item['result']
+    return results
 
-    # 如果所有重试都失败，也返回错误
-    return _("PROCESSING_ERROR: Max retries reached")
+
+def _process_packed(
+        texts: List[str],
+        user_prompt_template: str,
+        engine: AIExecutionEngine,
+        record_result: Callable[[str, object], None],
+        status_callback: Callable,
+        cancel_event: Optional[threading.Event],
+        temperature: float,
+        max_rows: int,
+        max_tokens: int
+):
+    """
+    打包处理：每个请求包含多行文本。回复未通过校验（无法解析或缺少部分 id）或请求失败时，
+    已通过校验的行直接采用，其余的行对半拆分后重新打包，直到单行时退回普通的逐行请求。
+    """
+    packs = _build_packs(texts, max_rows, max_tokens,
+                         instruction_tokens=estimate_tokens(_build_packed_prompt(user_prompt_template, [])))
+    status_callback(_("打包模式: {} 个文本合并为 {} 个请求。").format(len(texts), len(packs)), "INFO")
+
+    while packs:
+        multi_packs = [pack for pack in packs if len(pack) > 1]
+        singles = [pack[0] for pack in packs if len(pack) == 1]
+        retry_packs = []
+
+        def on_pack_result(position: int, response):
+            pack = multi_packs[position]
+            # 取消，或不可重试的错误（鉴权失败、请求无效等）：拆分重发也不会成功，整组直接记为失败
+            if isinstance(response, AICancelled) or (
+                    isinstance(response, AIServiceError) and not is_retryable_error(response)):
+                for text in pack:
+                    record_result(text, response)
+                return
+            parsed = {} if isinstance(response, Exception) else _parse_packed_response(response, len(pack))
+            for row_id, result in parsed.items():
+                record_result(pack[row_id], result)
+            missing = [text for row_id, text in enumerate(pack) if row_id not in parsed]
+            if missing:
+                status_callback(_("打包请求中有 {}/{} 行未返回有效结果，将拆分后重试。").format(
+                    len(missing), len(pack)), "WARNING")
+                middle = (len(missing) + 1) // 2
+                retry_packs.extend(part for part in (missing[:middle], missing[middle:]) if part)
+
+        if multi_packs:
+            engine.map([_build_packed_prompt(user_prompt_template, pack) for pack in multi_packs], "{text}",
+                       cancel_event=cancel_event, on_result=on_pack_result, temperature=temperature)
+        if singles:
+            engine.map(singles, user_prompt_template, cancel_event=cancel_event,
+                       on_result=lambda position, result: record_result(singles[position], result),
+                       temperature=temperature)
+        packs = retry_packs
+
+
+def _clean_ai_output(processed_text: str) -> str:
+    if processed_text and processed_text.startswith('"') and processed_text.endswith('"'):
+        processed_text = processed_text[1:-1]
+    return processed_text or ""
 
 
 def _process_dataframe_column(
@@ -106,61 +183,75 @@ def _process_dataframe_column(
         source_column_name: str,
         new_column_name: str,
         user_prompt_template: str,
-        task_identifier: str,
-        max_row_workers: int,
+        engine: AIExecutionEngine,
         status_callback: Callable,
         progress_callback: Callable,
-        cancel_event: Optional[threading.Event] = None
+        cancel_event: Optional[threading.Event] = None,
+        temperature: float = DEFAULT_TEMPERATURE,
+        cache_ttl_seconds: Optional[float] = None,
+        max_rows_per_request: int = 1,
+        max_tokens: int = 4096
 ) -> pd.DataFrame:
-    """在DataFrame的指定源列上运行AI处理，并将结果添加到新列。"""
+    """
+    在DataFrame的指定源列上运行AI处理，并将结果添加到新列。
+    相同的文本只处理一次：先去重并查询缓存，剩余的唯一文本交给 engine（负责并发、限流与重试），结果再分发回所有行。
+    max_rows_per_request 大于 1 时启用打包模式，多行文本合并为一个请求。
+    """
     df = df_input.copy()
 
     if source_column_name not in df.columns:
         status_callback(_("警告: 列 '{}' 在DataFrame中未找到。").format(source_column_name), "WARNING")
         return df
 
-    texts_to_process = df[source_column_name].tolist()
-    process_func_for_row = partial(
-        _process_text_with_ai,
-        cache=cache,
-        user_prompt_template=user_prompt_template,
-        task_identifier=task_identifier,
-        status_callback=status_callback,
-        cancel_event=cancel_event
-    )
-
-    items_to_process = [str(text_data) if pd.notna(text_data) else "" for text_data in texts_to_process]
+    items_to_process = [str(text_data) if pd.notna(text_data) else "" for text_data in df[source_column_name]]
     total_items = len(items_to_process)
-    results_list = [None] * total_items
-
-    if max_row_workers > 1 and total_items > 1:
-        with ThreadPoolExecutor(max_workers=max_row_workers) as executor:
-            future_to_index = {executor.submit(process_func_for_row, item): i for i, item in
-                               enumerate(items_to_process)}
-            for i, future in enumerate(as_completed(future_to_index)):
-                # 在处理每个完成的任务前，检查是否需要取消
-                if cancel_event and cancel_event.is_set():
-                    status_callback("任务已被用户取消。", "INFO")
-                    # 取消所有还未开始的 future
-                    for f in future_to_index:
-                        f.cancel()
-                    break  # 跳出循环
-
-                original_index = future_to_index[future]
-                try:
-                    results_list[original_index] = future.result()
-                except Exception as exc:
-                    results_list[original_index] = f"ERROR: {exc}"
-
-                progress_callback(int((i + 1) * 100 / total_items), f"{_('正在处理行')} {i + 1}/{total_items}")
-    else:
-        for i, text_data in enumerate(items_to_process):
-            # 单线程模式下同样检查
-            if cancel_event and cancel_event.is_set():
-                status_callback("任务已被用户取消。", "INFO")
-                break
-            results_list[i] = process_func_for_row(text_data)
-            progress_callback(int((i + 1) * 100 / total_items), f"{_('正在处理行')} {i + 1}/{total_items}")
+
+    # 唯一文本 -> 使用该文本的行号；空文本直接得到空结果
+    rows_by_text: Dict[str, List[int]] = {}
+    for i, text in enumerate(items_to_process):
+        if text.strip():
+            rows_by_text.setdefault(text, []).append(i)
+    results_by_text: Dict[str, str] = {}
+    cache_keys = {text: get_ai_cache_key(engine.cache_identity, user_prompt_template, temperature, text)
+                  for text in rows_by_text}
+    for text, key in cache_keys.items():
+        cached_result = cache.get(key)
+        if cached_result is not None:
+            results_by_text[text] = cached_result
+    pending_texts = [text for text in rows_by_text if text not in results_by_text]
+
+    completed = total_items - sum(len(rows_by_text[text]) for text in pending_texts)
+    status_callback(_("共 {} 行，{} 个不同的文本，其中 {} 个需要调用AI。").format(
+        total_items, len(rows_by_text), len(pending_texts)), "INFO")
+    if completed:
+        progress_callback(int(completed * 100 / total_items), f"{_('正在处理行')} {completed}/{total_items}")
+
+    def record_result(text: str, result):
+        nonlocal completed
+        if isinstance(result, AICancelled):
+            results_by_text[text] = "PROCESSING_CANCELLED"
+        elif isinstance(result, Exception):
+            status_callback(_("警告: 经过 {} 次尝试后，文本 '{}' 处理失败。").format(
+                engine.max_retries + 1, text[:50] + '...'), "ERROR")
+            results_by_text[text] = f"PROCESSING_ERROR: {result}"
+        else:
+            results_by_text[text] = _clean_ai_output(result)
+            cache.set(cache_keys[text], results_by_text[text], expire=cache_ttl_seconds)
+        completed += len(rows_by_text[text])
+        progress_callback(int(completed * 100 / total_items), f"{_('正在处理行')} {completed}/{total_items}")
+
+    if pending_texts and max_rows_per_request > 1:
+        _process_packed(pending_texts, user_prompt_template, engine, record_result, status_callback, cancel_event,
+                        temperature, max_rows_per_request, max_tokens)
+    elif pending_texts:
+        engine.map(pending_texts, user_prompt_template, cancel_event=cancel_event,
+                   on_result=lambda position, result: record_result(pending_texts[position], result),
+                   temperature=temperature)
+    if pending_texts:
+        if cancel_event and cancel_event.is_set():
+            status_callback(_("任务已被用户取消。"), "INFO")
+
+    results_list = [results_by_text.get(text, "") for text in items_to_process]
 
     try:
         # 获取源列的索引位置
@@ -176,6 +267,14 @@ def _process_dataframe_column(
     return df
 
 
+def _read_csv_with_fallback(filepath: str, status_callback: Callable, **kwargs) -> pd.DataFrame:
+    try:
+        return pd.read_csv(filepath, sep=',', encoding='utf-8', **kwargs)
+    except UnicodeDecodeError:
+        status_callback(_("文件 {} UTF-8解码失败，尝试GBK...").format(os.path.basename(filepath)), "INFO")
+        return pd.read_csv(filepath, sep=',', encoding='gbk', **kwargs)
+
+
 def _process_csv_file(
         filepath: str,
         target_output_path: str,
@@ -183,19 +282,15 @@ def _process_csv_file(
         source_column_name: str,
         new_column_name: str,
         user_prompt_template: str,
-        task_identifier: str,
-        max_row_workers: int,
+        engine: AIExecutionEngine,
         status_callback: Callable,
         progress_callback: Callable,
-        cancel_event: Optional[threading.Event] = None
+        cancel_event: Optional[threading.Event] = None,
+        **column_options
 ):
-    """处理单个CSV文件。"""
+    """处理单个CSV文件。column_options 原样传给 _process_dataframe_column。"""
     try:
-        try:
-            df = pd.read_csv(filepath, sep=',', encoding='utf-8')
-        except UnicodeDecodeError:
-            status_callback(_("文件 {} UTF-8解码失败，尝试GBK...").format(os.path.basename(filepath)), "INFO")
-            df = pd.read_csv(filepath, sep=',', encoding='gbk')
+        df = _read_csv_with_fallback(filepath, status_callback)
 
         if source_column_name not in df.columns:
             status_callback(
@@ -205,9 +300,8 @@ def _process_csv_file(
 
         df_processed = _process_dataframe_column(
             df, cache, source_column_name, new_column_name,
-            user_prompt_template, task_identifier,
-            max_row_workers, status_callback, progress_callback,
-            cancel_event=cancel_event
+            user_prompt_template, engine, status_callback, progress_callback,
+            cancel_event=cancel_event, **column_options
         )
 
         os.makedirs(os.path.dirname(target_output_path), exist_ok=True)
@@ -221,6 +315,140 @@ def _process_csv_file(
         status_callback(_("处理文件 {} 时发生严重错误: {}").format(os.path.basename(filepath), e), "ERROR")
 
 
+def _detect_csv_encoding(filepath: str, block_size: int = 1024 * 1024) -> str:
+    """逐块增量解码整个文件判断是否为 UTF-8，否则按 GBK 处理（与整表读取时的回退顺序一致），内存占用与文件大小无关。"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                decoder.decode(block)
+            decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return 'gbk'
+    return 'utf-8'
+
+
+def _read_checkpoint(checkpoint_path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_checkpoint(checkpoint_path: str, checkpoint: Dict[str, Any]):
+    # 先写临时文件再替换，保证断点文件本身不会写了一半
+    tmp_path = f"{checkpoint_path}.tmp-{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _process_csv_file_streaming(
+        filepath: str,
+        target_output_path: str,
+        cache: Cache,
+        source_column_name: str,
+        new_column_name: str,
+        user_prompt_template: str,
+        engine: AIExecutionEngine,
+        status_callback: Callable,
+        progress_callback: Callable,
+        chunk_rows: int,
+        cancel_event: Optional[threading.Event] = None,
+        **column_options
+):
+    """
+    流式处理单个CSV文件：按 chunk_rows 行分块读取，每块处理完成后按行序追加到 <输出>.partial，并更新断点文件。
+    中断（崩溃或取消）后再次运行同一任务时，从断点继续，已完成的行不会再读取或查询缓存；全部完成后才替换为最终输出文件。
+    所有单元格按原始文本读写，不做类型推断，避免不同分块推断出不同的类型。
+    """
+    partial_path = target_output_path + PARTIAL_SUFFIX
+    checkpoint_path = target_output_path + CHECKPOINT_SUFFIX
+    try:
+        encoding = _detect_csv_encoding(filepath)
+        read_options = dict(sep=',', encoding=encoding, dtype=str, keep_default_na=False)
+        header = pd.read_csv(filepath, nrows=0, **read_options).columns
+        if source_column_name not in header:
+            status_callback(
+                _("警告: 列 '{}' 在 {} 中未找到。跳过。").format(source_column_name, os.path.basename(filepath)),
+                "WARNING")
+            return
+        total_rows = sum(len(chunk) for chunk in
+                         pd.read_csv(filepath, usecols=[source_column_name], chunksize=chunk_rows, **read_options))
+
+        # 断点只有在输入文件、列与提示词等任务参数都未变化时才有效
+        task_signature = {
+            'version': CHECKPOINT_VERSION,
+            'input': os.path.abspath(filepath),
+            'input_fingerprint': get_file_fingerprint(filepath),
+            'source_column': source_column_name,
+            'new_column': new_column_name,
+            'prompt_sha256': _hash_text(user_prompt_template),
+            'provider': engine.cache_identity[0],
+            'model': engine.cache_identity[1],
+            'chunk_rows': chunk_rows,
+        }
+        checkpoint = _read_checkpoint(checkpoint_path)
+        rows_done, output_bytes = 0, 0
+        if checkpoint and checkpoint.get('task') == task_signature and os.path.exists(partial_path) and \
+                os.path.getsize(partial_path) >= checkpoint.get('output_bytes', 0):
+            rows_done, output_bytes = checkpoint['rows_done'], checkpoint['output_bytes']
+            status_callback(_("发现断点，从第 {}/{} 行继续处理。").format(rows_done, total_rows), "INFO")
+
+        os.makedirs(os.path.dirname(os.path.abspath(target_output_path)), exist_ok=True)
+        # 截掉断点之后可能写了一半的内容；从头开始时清空旧的部分输出
+        with open(partial_path, 'ab') as f:
+            f.truncate(output_bytes)
+
+        # 分块大小固定（属于任务参数），已完成的行恰好是前若干个完整分块；按块跳过而不是按行号跳过，
+        # 因为带引号的字段可能跨越多行
+        chunks_done = rows_done // chunk_rows
+        reader = pd.read_csv(filepath, chunksize=chunk_rows, **read_options)
+        with open(partial_path, 'a', encoding='utf-8-sig', newline='') as out:
+            for chunk_index, chunk in enumerate(reader):
+                if chunk_index < chunks_done:
+                    continue
+                if cancel_event and cancel_event.is_set():
+                    break
+                chunk_start = rows_done
+                chunk_progress = lambda p, m: progress_callback(
+                    int((chunk_start + p / 100 * len(chunk)) * 100 / max(total_rows, 1)),
+                    _("正在处理行 {}/{}").format(min(chunk_start + int(p / 100 * len(chunk)), total_rows), total_rows))
+                processed = _process_dataframe_column(
+                    chunk, cache, source_column_name, new_column_name, user_prompt_template, engine,
+                    status_callback, chunk_progress, cancel_event=cancel_event, **column_options)
+                if cancel_event and cancel_event.is_set():
+                    # 本块可能含有被取消的行，不写入，下次从本块开始
+                    break
+                processed.to_csv(out, index=False, header=rows_done == 0)
+                out.flush()
+                os.fsync(out.fileno())
+                rows_done += len(chunk)
+                _write_checkpoint(checkpoint_path, {'task': task_signature, 'rows_done': rows_done,
+                                                    'output_bytes': out.buffer.tell()})
+
+        if cancel_event and cancel_event.is_set():
+            status_callback(_("任务已取消，已完成 {}/{} 行，再次运行同一任务将从断点继续。").format(
+                rows_done, total_rows), "INFO")
+            return
+
+        if rows_done == 0:
+            # 只有表头、没有数据行：与整表模式一样输出带新列的表头
+            empty_df = pd.DataFrame(columns=header)
+            empty_df.insert(header.get_loc(source_column_name) + 1, new_column_name, [])
+            empty_df.to_csv(partial_path, index=False, encoding='utf-8-sig')
+        os.replace(partial_path, target_output_path)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        status_callback(
+            _("文件 {} 已处理并保存到: {}").format(os.path.basename(filepath), os.path.basename(target_output_path)),
+            "INFO")
+
+    except Exception as e:
+        status_callback(_("处理文件 {} 时发生严重错误: {}").format(os.path.basename(filepath), e), "ERROR")
+
+
 def process_single_csv_file(
         client: 'AIWrapper',
         input_csv_path: str,
@@ -233,16 +461,29 @@ def process_single_csv_file(
         status_callback: Optional[Callable] = None,
         progress_callback: Optional[Callable] = None,
         output_csv_path: Optional[str] = None,
-        cancel_event: Optional[threading.Event] = None
+        cancel_event: Optional[threading.Event] = None,
+        engine: Optional[AIExecutionEngine] = None,
+        temperature: float = DEFAULT_TEMPERATURE,
+        cache_directory: Optional[str] = None,
+        cache_size_limit_mb: int = DEFAULT_CACHE_SIZE_LIMIT_MB,
+        cache_ttl_days: Optional[float] = None,
+        max_rows_per_request: int = 1,
+        max_tokens: int = 4096,
+        chunk_rows: int = 0
 ):
-    """针对单个CSV文件进行分析处理。"""
-    global client_global
-    client_global = client
-
+    """
+    针对单个CSV文件进行分析处理。
+    engine 为带限流与重试策略的执行引擎；未提供时用 client 创建一个并发数为 max_row_workers、不限速的引擎。
+    结果缓存在 cache_directory（默认 tmp/.ai_cache）的全局缓存中，超过 cache_ttl_days 天的结果会过期，None 表示永不过期。
+    max_rows_per_request 大于 1 时，多行文本按 max_tokens 预算打包为一个请求。
+    chunk_rows 大于 0 时使用流式模式：按块读取与写出，并支持断点续跑。
+    """
     log = status_callback if status_callback else print
+    if engine is None:
+        engine = AIExecutionEngine(client, max_concurrency=max_row_workers, status_callback=log)
     progress = progress_callback if progress_callback else lambda p, m: None
 
-    cache = _prepare_cache(task_identifier, log)
+    cache = _prepare_cache(cache_directory or DEFAULT_CACHE_DIRECTORY, cache_size_limit_mb, log)
     if cache is None:
         log(_("错误: 任务 '{}' 的缓存初始化失败，处理中止。").format(task_identifier), "ERROR")
         return
@@ -258,20 +499,28 @@ def process_single_csv_file(
 
     log(_("处理单个CSV文件: {}").format(os.path.abspath(input_csv_path)), "INFO")
 
-    _process_csv_file(
+    column_options = dict(
+        temperature=temperature,
+        cache_ttl_seconds=cache_ttl_days * 86400 if cache_ttl_days else None,
+        max_rows_per_request=max_rows_per_request,
+        max_tokens=max_tokens
+    )
+    file_kwargs = dict(
         filepath=input_csv_path,
         target_output_path=actual_target_output_path,
         cache=cache,
         source_column_name=source_column_name,
         new_column_name=new_column_name,
         user_prompt_template=user_prompt_template,
-        task_identifier=task_identifier,
-        max_row_workers=max_row_workers,
+        engine=engine,
         status_callback=log,
         progress_callback=progress,
         cancel_event=cancel_event
-
     )
+    if chunk_rows and chunk_rows > 0:
+        _process_csv_file_streaming(chunk_rows=chunk_rows, **file_kwargs, **column_options)
+    else:
+        _process_csv_file(**file_kwargs, **column_options)
 
     cache.close()
     log(_("任务 '{}' 的磁盘缓存已关闭。").format(task_identifier), "DEBUG")
\ No newline at end of file
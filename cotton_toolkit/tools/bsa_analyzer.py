@@ -0,0 +1,346 @@
+﻿# cotton_toolkit/tools/bsa_analyzer.py
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Dict, Optional, Callable, Tuple
+
+import numpy as np
+import pandas as pd
+
+# --- 国际化和日志设置 ---
+try:
+    import builtins
+
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+logger = logging.getLogger("cotton_toolkit.bsa_analyzer")
+
+# 每次从 VCF 读取的行数：内存占用只与这个值有关，与 VCF 总位点数无关
+VCF_CHUNK_ROWS = 200_000
+# 窗口内至少要有这么多个合格 SNP，才计算该窗口的 SNP-index
+DEFAULT_MIN_SNPS_PER_WINDOW = 10
+# 位点过滤的默认值：两个混池的 SNP-index 都低于该值的位点多为测序或比对错误，不参与计算（QTL-seq 的常规过滤）
+DEFAULT_MIN_SNP_INDEX = 0.3
+
+# VCF 固定列：CHROM, POS, REF, ALT, FORMAT
+VCF_CHROM_COL, VCF_POS_COL, VCF_REF_COL, VCF_ALT_COL, VCF_FORMAT_COL = 0, 1, 3, 4, 8
+VCF_FIRST_SAMPLE_COL = 9
+
+# 临时文件中每个合格位点的记录：位置与两个混池的 REF/ALT 读数
+SITE_DTYPE = np.dtype([('pos', '<i8'), ('ref1', '<i4'), ('alt1', '<i4'), ('ref2', '<i4'), ('alt2', '<i4')])
+
+WINDOW_COLUMNS = ['chrom', 'start', 'end', 'n_snps', 'snp_index_pool1', 'snp_index_pool2', 'delta_snp_index']
+REGION_COLUMNS = ['chrom', 'start', 'end', 'n_windows', 'max_abs_delta', 'mean_delta']
+
+
+def _open_vcf_binary(vcf_path: str):
+    """
+    以二进制方式打开 VCF（按文件头魔数识别 gzip/bgzip），返回 (底层文件, 读取流)。
+    底层文件的 tell() 相对于文件大小即为读取进度。
+    """
+    raw = open(vcf_path, 'rb')
+    magic = raw.read(2)
+    raw.seek(0)
+    stream = gzip.GzipFile(fileobj=raw) if magic == b'\x1f\x8b' else raw
+    return raw, stream
+
+
+def _read_vcf_header(stream) -> List[str]:
+    """跳过 ## 元信息行并读取 #CHROM 表头行，返回样本名列表；读取流停在第一条数据行之前。"""
+    for raw_line in stream:
+        line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
+        if line.startswith('##'):
+            continue
+        if line.startswith('#CHROM'):
+            return line.split('\t')[VCF_FIRST_SAMPLE_COL:]
+        break
+    raise ValueError(_("VCF文件缺少 #CHROM 表头行。"))
+
+
+def read_vcf_samples(vcf_path: str) -> List[str]:
+    """返回 VCF 中的样本名列表。"""
+    raw, stream = _open_vcf_binary(vcf_path)
+    with raw, stream:
+        return _read_vcf_header(stream)
+
+
+def _resolve_pool_samples(samples: List[str], pool1_sample: Optional[str],
+                          pool2_sample: Optional[str]) -> Tuple[int, int]:
+    """将两个混池的样本名解析为样本序号；未指定时依次使用 VCF 中的前两个样本。"""
+    if len(samples) < 2:
+        raise ValueError(_("VCF文件中至少需要两个样本（两个混池），实际只有 {} 个。").format(len(samples)))
+    indices = []
+    for name, default_index in ((pool1_sample, 0), (pool2_sample, 1)):
+        if not name:
+            indices.append(default_index)
+        elif name in samples:
+            indices.append(samples.index(name))
+        else:
+            raise ValueError(_("VCF文件中未找到样本 '{}'。可用样本: {}").format(name, ", ".join(samples)))
+    if indices[0] == indices[1]:
+        raise ValueError(_("两个混池不能是同一个样本。"))
+    return indices[0], indices[1]
+
+
+def _extract_allele_depths(chunk: pd.DataFrame, sample_cols: Tuple[int, int]) -> pd.DataFrame:
+    """
+    从一块 VCF 数据中提取两个混池在双等位 SNP 上的 REF/ALT 读数（FORMAT 中的 AD 字段）。
+    FORMAT 在整个文件中通常只有少数几种，按 FORMAT 分组后每个样本只需一次正则提取。
+    """
+    ref, alt = chunk[VCF_REF_COL], chunk[VCF_ALT_COL]
+    is_snp = (ref.str.len() == 1) & (alt.str.len() == 1) & alt.str.upper().isin(list('ACGT'))
+    chunk = chunk[is_snp]
+
+    parts = []
+    for format_str, group in chunk.groupby(VCF_FORMAT_COL, sort=False):
+        keys = format_str.split(':')
+        if 'AD' not in keys:
+            continue
+        # AD 是第 k 个字段时，跳过前 k 个以冒号结尾的字段后匹配 "REF读数,ALT读数"
+        pattern = r'^(?:[^:]*:){%d}(\d+),(\d+)' % keys.index('AD')
+        depths = {'chrom': group[VCF_CHROM_COL], 'pos': group[VCF_POS_COL]}
+        for pool, col in enumerate(sample_cols, start=1):
+            extracted = group[col].str.extract(pattern)
+            depths[f'ref{pool}'] = extracted[0]
+            depths[f'alt{pool}'] = extracted[1]
+        parts.append(pd.DataFrame(depths))
+
+    if not parts:
+        return pd.DataFrame(columns=['chrom'] + list(SITE_DTYPE.names))
+    # 缺失的 AD（如 "./.:."）在提取后为 NaN，整行丢弃
+    result = pd.concat(parts).dropna()
+    for name in SITE_DTYPE.names:
+        result[name] = pd.to_numeric(result[name], errors='coerce')
+    return result.dropna()
+
+
+def _spill_sites(sites: pd.DataFrame, temp_dir: str, chrom_files: Dict[str, str]):
+    """把一块合格位点按染色体追加写入临时二进制文件，chrom_files 记录染色体（按首次出现顺序）到文件的映射。"""
+    for chrom, group in sites.groupby('chrom', sort=False):
+        path = chrom_files.get(chrom)
+        if path is None:
+            path = os.path.join(temp_dir, f"chrom_{len(chrom_files)}.bin")
+            chrom_files[chrom] = path
+        records = np.empty(len(group), dtype=SITE_DTYPE)
+        for name in SITE_DTYPE.names:
+            records[name] = group[name].to_numpy()
+        with open(path, 'ab') as f:
+            records.tofile(f)
+
+
+def compute_sliding_windows(
+        positions: np.ndarray,
+        pool1_index: np.ndarray,
+        pool2_index: np.ndarray,
+        window_size: int,
+        step_size: int,
+        min_snps: int = DEFAULT_MIN_SNPS_PER_WINDOW
+) -> Dict[str, np.ndarray]:
+    """
+    对一条染色体上按位置排序的位点计算滑动窗口统计量。
+    窗口为 [start, start + window_size - 1]（1-based，闭区间），start 从 1 开始每次前进 step_size。
+    每个窗口的位点范围由两次 searchsorted 得到，均值由前缀和相减得到，总耗时为 O(位点数 + 窗口数·log 位点数)。
+    位点数少于 min_snps 的窗口，各项均值为 NaN。
+    """
+    if len(positions) == 0:
+        return {name: np.array([]) for name in WINDOW_COLUMNS[1:]}
+
+    starts = np.arange(1, int(positions[-1]) + 1, step_size, dtype=np.int64)
+    ends = starts + window_size - 1
+    lo = np.searchsorted(positions, starts, side='left')
+    hi = np.searchsorted(positions, ends, side='right')
+    counts = hi - lo
+    enough = counts >= max(1, min_snps)
+
+    def window_mean(values: np.ndarray) -> np.ndarray:
+        prefix = np.concatenate(([0.0], np.cumsum(values, dtype=np.float64)))
+        means = np.full(len(starts), np.nan)
+        means[enough] = (prefix[hi[enough]] - prefix[lo[enough]]) / counts[enough]
+        return means
+
+    return {
+        'start': starts,
+        'end': ends,
+        'n_snps': counts,
+        'snp_index_pool1': window_mean(pool1_index),
+        'snp_index_pool2': window_mean(pool2_index),
+        'delta_snp_index': window_mean(pool2_index - pool1_index),
+    }
+
+
+def _compute_chromosome_windows(site_file: str, chrom: str, window_size: int, step_size: int,
+                                min_snps: int, min_snp_index: float) -> pd.DataFrame:
+    """进程池任务：读取一条染色体的临时位点文件，计算各位点 SNP-index 与滑动窗口统计量。"""
+    sites = np.fromfile(site_file, dtype=SITE_DTYPE)
+    positions = sites['pos']
+    if len(positions) > 1 and np.any(positions[1:] < positions[:-1]):
+        sites = sites[np.argsort(positions, kind='stable')]
+        positions = sites['pos']
+
+    depth1 = sites['ref1'] + sites['alt1']
+    depth2 = sites['ref2'] + sites['alt2']
+    pool1_index = sites['alt1'] / depth1
+    pool2_index = sites['alt2'] / depth2
+    informative = (pool1_index >= min_snp_index) | (pool2_index >= min_snp_index)
+
+    windows = compute_sliding_windows(positions[informative], pool1_index[informative],
+                                      pool2_index[informative], window_size, step_size, min_snps)
+    result = pd.DataFrame(windows)
+    result.insert(0, 'chrom', chrom)
+    return result[WINDOW_COLUMNS]
+
+
+def find_candidate_regions(windows_df: pd.DataFrame, delta_threshold: float) -> pd.DataFrame:
+    """
+    选出 |Δ(SNP-index)| 不低于阈值的窗口，并把同一染色体上相互重叠或首尾相接的窗口合并为候选区域。
+    """
+    passing = windows_df[windows_df['delta_snp_index'].abs() >= delta_threshold]
+    if passing.empty:
+        return pd.DataFrame(columns=REGION_COLUMNS)
+
+    passing = passing.sort_values(['chrom', 'start'], kind='stable').reset_index(drop=True)
+    # 同一染色体上，窗口起点超过此前所有窗口的最远终点 + 1 时开始一个新区域
+    previous_end = passing.groupby('chrom', sort=False)['end'].cummax().groupby(passing['chrom']).shift()
+    new_region = previous_end.isna() | (passing['start'] > previous_end + 1)
+    region_id = new_region.cumsum()
+
+    passing = passing.assign(abs_delta=passing['delta_snp_index'].abs())
+    regions = passing.groupby(region_id, sort=False).agg(
+        chrom=('chrom', 'first'), start=('start', 'min'), end=('end', 'max'),
+        n_windows=('start', 'size'), max_abs_delta=('abs_delta', 'max'), mean_delta=('delta_snp_index', 'mean'))
+    return regions.reset_index(drop=True)[REGION_COLUMNS]
+
+
+def _write_csv_atomic(df: pd.DataFrame, output_path: str):
+    temp_path = output_path + ".tmp"
+    df.to_csv(temp_path, index=False, encoding='utf-8-sig')
+    os.replace(temp_path, output_path)
+
+
+def analyze_bsa_vcf(
+        vcf_path: str,
+        output_dir: str,
+        window_size: int,
+        step_size: int,
+        min_depth: int,
+        delta_threshold: float,
+        pool1_sample: Optional[str] = None,
+        pool2_sample: Optional[str] = None,
+        min_snps_per_window: int = DEFAULT_MIN_SNPS_PER_WINDOW,
+        min_snp_index: float = DEFAULT_MIN_SNP_INDEX,
+        max_workers: int = 1,
+        status_callback: Optional[Callable[[str, str], None]] = None,
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_event: Optional[threading.Event] = None
+) -> Optional[Dict[str, pd.DataFrame]]:
+    """
+    混池分离分析（BSA）：计算两个混池的 SNP-index 与 Δ(SNP-index) = 混池2 - 混池1 的滑动窗口统计量并找出候选区域。
+
+    1. 分块流式读取 VCF（支持 bgzip/gzip），只保留两个混池读深都不低于 min_depth 的双等位 SNP，
+       并按染色体追加写入临时文件，内存占用与 VCF 大小无关；
+    2. 去掉两个混池 SNP-index 都低于 min_snp_index 的位点，在进程池中按染色体并行计算滑动窗口（NumPy 向量化）；
+    3. 合并 |Δ(SNP-index)| >= delta_threshold 的窗口为候选区域。
+
+    结果写入 output_dir 下的 bsa_windows.csv 与 bsa_candidate_regions.csv。
+    :return: {'windows': 窗口表, 'regions': 候选区域表}；出错或被取消时返回 None。
+    """
+    log = status_callback if status_callback else lambda msg, level="INFO": logger.info(f"[{level}] {msg}")
+    progress = progress_callback if progress_callback else lambda p, m: None
+    cancelled = lambda: bool(cancel_event and cancel_event.is_set())
+
+    if window_size <= 0 or step_size <= 0:
+        log(_("错误: 窗口大小与步长必须为正整数。"), "ERROR")
+        return None
+    # 读深为 0 的位点无法计算 SNP-index
+    min_depth = max(1, min_depth)
+
+    temp_dir = tempfile.mkdtemp(prefix="bsa_sites_")
+    try:
+        # --- 1. 流式读取 VCF ---
+        progress(0, _("正在读取VCF文件..."))
+        raw, stream = _open_vcf_binary(vcf_path)
+        chrom_files: Dict[str, str] = {}
+        total_sites = kept_sites = 0
+        with raw, stream:
+            samples = _read_vcf_header(stream)
+            pool1_col, pool2_col = (VCF_FIRST_SAMPLE_COL + i for i in
+                                    _resolve_pool_samples(samples, pool1_sample, pool2_sample))
+            log(_("混池1: {}，混池2: {}。").format(samples[pool1_col - VCF_FIRST_SAMPLE_COL],
+                                             samples[pool2_col - VCF_FIRST_SAMPLE_COL]), "INFO")
+
+            file_size = max(1, os.path.getsize(vcf_path))
+            reader = pd.read_csv(stream, sep='\t', header=None, dtype=str, chunksize=VCF_CHUNK_ROWS,
+                                 usecols=[VCF_CHROM_COL, VCF_POS_COL, VCF_REF_COL, VCF_ALT_COL, VCF_FORMAT_COL,
+                                          pool1_col, pool2_col])
+            for chunk in reader:
+                if cancelled():
+                    log(_("任务被用户取消。"), "INFO")
+                    return None
+                total_sites += len(chunk)
+                sites = _extract_allele_depths(chunk, (pool1_col, pool2_col))
+                sites = sites[((sites['ref1'] + sites['alt1']) >= min_depth) &
+                              ((sites['ref2'] + sites['alt2']) >= min_depth)]
+                kept_sites += len(sites)
+                _spill_sites(sites, temp_dir, chrom_files)
+                progress(int(raw.tell() / file_size * 60),
+                         _("已读取 {} 个位点，保留 {} 个。").format(total_sites, kept_sites))
+
+        log(_("VCF读取完成：共 {} 个位点，{} 个双等位SNP通过读深过滤，分布在 {} 条序列上。").format(
+            total_sites, kept_sites, len(chrom_files)), "INFO")
+        if not chrom_files:
+            log(_("没有通过过滤的SNP位点，请检查VCF是否包含AD字段或降低最小读深。"), "WARNING")
+            return None
+
+        # --- 2. 按染色体并行计算滑动窗口 ---
+        workers = max(1, min(max_workers, len(chrom_files)))
+        log(_("使用 {} 个进程计算 {} 条序列的滑动窗口（窗口 {} bp，步长 {} bp）。").format(
+            workers, len(chrom_files), window_size, step_size), "INFO")
+        chrom_windows: Dict[str, pd.DataFrame] = {}
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            future_to_chrom = {
+                executor.submit(_compute_chromosome_windows, path, chrom, window_size, step_size,
+                                min_snps_per_window, min_snp_index): chrom
+                for chrom, path in chrom_files.items()
+            }
+            pending = set(future_to_chrom)
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    chrom_windows[future_to_chrom[future]] = future.result()
+                    progress(60 + int(len(chrom_windows) / len(chrom_files) * 30),
+                             _("已完成 {}/{} 条序列的窗口计算。").format(len(chrom_windows), len(chrom_files)))
+                if pending and cancelled():
+                    for future in pending:
+                        future.cancel()
+                    log(_("任务被用户取消。"), "INFO")
+                    return None
+
+        # 按染色体在 VCF 中出现的顺序输出
+        windows_df = pd.concat([chrom_windows[chrom] for chrom in chrom_files], ignore_index=True)
+
+        # --- 3. 候选区域 ---
+        progress(92, _("正在合并候选区域..."))
+        regions_df = find_candidate_regions(windows_df, delta_threshold)
+        log(_("共 {} 个窗口，找到 {} 个 |Δ(SNP-index)| >= {} 的候选区域。").format(
+            len(windows_df), len(regions_df), delta_threshold), "INFO")
+
+        os.makedirs(output_dir, exist_ok=True)
+        _write_csv_atomic(windows_df, os.path.join(output_dir, "bsa_windows.csv"))
+        _write_csv_atomic(regions_df, os.path.join(output_dir, "bsa_candidate_regions.csv"))
+        log(_("BSA结果已保存到: {}").format(output_dir), "INFO")
+        progress(100, _("BSA分析完成。"))
+        return {'windows': windows_df, 'regions': regions_df}
+
+    except Exception as e:
+        log(_("BSA分析过程中发生错误: {}").format(e), "ERROR")
+        logger.exception(_("BSA分析失败的完整堆栈跟踪:"))
+        return None
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
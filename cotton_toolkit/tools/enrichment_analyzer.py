@@ -1,13 +1,17 @@
 ﻿# cotton_toolkit/tools/enrichment_analyzer.py
 import os
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import numpy as np
 import pandas as pd
-from scipy.stats import hypergeom
 from statsmodels.stats.multitest import multipletests
-from typing import List, Optional, Callable
+from typing import List, Dict, Optional, Callable
 
 from .data_loader import load_annotation_data
+from .enrichment_engine import EnrichmentBackground, load_enrichment_background, get_enrichment_background_dir, \
+    test_study_sets_from_cache, GENE_LIST_COLUMN, BACKGROUND_MANIFEST_FILENAME
 from ..core.convertXlsx2csv import convert_excel_to_standard_csv
-from ..utils.file_utils import prepare_input_file
 from ..utils.gene_utils import normalize_gene_ids
 
 try:
@@ -16,23 +20,59 @@ except ImportError:
     _ = lambda text: str(text)
 
 
+def write_gene_matching_report(
+        study_gene_ids: List[str],
+        study_ids_normalized: pd.Series,
+        gene_annotations: Dict[str, str],
+        output_dir: str
+) -> str:
+    """
+    生成基因匹配报告 gene_matching_report.csv：每个规范化ID一行（合并其全部原始ID），
+    规范化失败的原始ID各占一行。只使用 groupby/map 等整列操作，耗时与输入基因数成线性关系。
+
+    :param gene_annotations: 背景中找到的基因 -> 注释摘要，见 EnrichmentBackground.get_gene_annotations。
+    :return: 报告文件路径。
+    """
+    norm_to_orig_df = pd.DataFrame(
+        {'Original_ID': study_gene_ids, 'Normalized_ID': study_ids_normalized}).drop_duplicates()
+    normalized_df = norm_to_orig_df.dropna(subset=['Normalized_ID'])
+
+    report_df = normalized_df.groupby('Normalized_ID', sort=False)['Original_ID'].agg(';'.join).reset_index()
+    report_df = report_df[['Original_ID', 'Normalized_ID']]
+    matched = report_df['Normalized_ID'].isin(gene_annotations.keys()).to_numpy()
+    report_df['Status'] = np.where(matched, _("匹配成功 (Matched)"), _("匹配失败 (Failed)"))
+    report_df['Reason'] = np.where(matched, _("在背景中找到，已用于分析"), _("基因ID不在背景注释中"))
+    report_df['Annotations'] = np.where(matched, report_df['Normalized_ID'].map(gene_annotations).fillna(
+        _("在背景中但无注释条目")), "N/A")
+
+    failed_df = norm_to_orig_df.loc[norm_to_orig_df['Normalized_ID'].isnull(), ['Original_ID']].assign(
+        Normalized_ID='N/A', Status='匹配失败 (Failed)', Reason='基因ID标准化失败', Annotations='N/A')
+    report_df = pd.concat([report_df, failed_df], ignore_index=True)
+
+    report_path = os.path.join(output_dir, "gene_matching_report.csv")
+    report_df.to_csv(report_path, index=False, encoding='utf-8-sig')
+    return report_path
+
+
 def _perform_hypergeometric_test(
         study_gene_ids: List[str],
-        background_df: pd.DataFrame,
+        background: EnrichmentBackground,
         status_callback: Callable,
         output_dir: str,
         gene_id_regex: Optional[str] = None,
         alpha: float = 0.05,
-        progress_callback: Optional[Callable[[int, str], None]] = None
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        write_matching_report: bool = True
 ) -> Optional[pd.DataFrame]:
     """
     一个通用的、执行超几何检验的核心函数，并支持进度报告。
 
     :param study_gene_ids: 用户输入的研究基因列表。
-    :param background_df: 一个包含 ['GeneID', 'TermID', 'Description'] 列的DataFrame，代表全基因组的注释背景。
+    :param background: 预编译的全基因组注释背景（基因ID已按 gene_id_regex 规范化）。
     :param status_callback: 用于记录日志的回调函数。
     :param alpha: 显著性水平阈值。
     :param progress_callback: 用于报告进度的回调函数。
+    :param write_matching_report: 是否输出 gene_matching_report.csv；只需要统计结果时可关闭。
     :return: 包含富集结果的DataFrame。
     """
     log = status_callback
@@ -41,95 +81,38 @@ def _perform_hypergeometric_test(
     progress(5, _("正在准备富集分析背景数据..."))
     log("INFO: 正在准备富集分析背景数据...")
 
-    original_input_set = set(study_gene_ids)
-    background_gene_id_col = 'GeneID'
     study_ids_normalized = pd.Series(study_gene_ids, name="norm")
     if gene_id_regex:
-        background_df['GeneID_norm'] = normalize_gene_ids(background_df['GeneID'], gene_id_regex)
         study_ids_series = pd.Series(study_gene_ids, name="orig")
         study_ids_normalized = normalize_gene_ids(study_ids_series, gene_id_regex)
-        background_df.dropna(subset=['GeneID_norm'], inplace=True)
-        background_gene_id_col = 'GeneID_norm'
-
-    study_gene_ids_set = set(study_ids_normalized.dropna())
-    background_genes_set = set(background_df[background_gene_id_col].unique())
 
-    study_genes_in_pop = study_gene_ids_set.intersection(background_genes_set)
-    M = len(background_genes_set)
+    study_rows = background.get_gene_rows(study_ids_normalized.dropna())
+    study_genes_in_pop = set(str(gene_id) for gene_id in background.gene_ids[study_rows])
     N = len(study_genes_in_pop)
 
-    progress(15, _("正在生成基因匹配报告..."))
-    try:
-        background_df['Description'] = background_df['Description'].astype(str)
-        gene_to_terms_map = background_df.groupby(background_gene_id_col).apply(
-            lambda df_group: '; '.join(df_group['TermID'] + ' (' + df_group['Description'] + ')')
-        ).to_dict()
-
-        report_data = []
-        norm_to_orig_df = pd.DataFrame(
-            {'Original_ID': study_gene_ids, 'Normalized_ID': study_ids_normalized}).drop_duplicates()
-        all_normalized_genes = norm_to_orig_df['Normalized_ID'].dropna().unique()
-
-        for norm_gene in all_normalized_genes:
-            orig_ids = ";".join(norm_to_orig_df[norm_to_orig_df['Normalized_ID'] == norm_gene]['Original_ID'])
-            annotations = "N/A"
-            if norm_gene in study_genes_in_pop:
-                status, reason = _("匹配成功 (Matched)"), _("在背景中找到，已用于分析")
-                annotations = gene_to_terms_map.get(norm_gene, _("在背景中但无注释条目"))
-            else:
-                status, reason = _("匹配失败 (Failed)"), _("基因ID不在背景注释中")
-            report_data.append({'Original_ID': orig_ids, 'Normalized_ID': norm_gene, 'Status': status, 'Reason': reason,
-                                'Annotations': annotations})
-
-        failed_norm_ids = norm_to_orig_df[norm_to_orig_df['Normalized_ID'].isnull()]['Original_ID']
-        for failed_id in failed_norm_ids:
-            report_data.append({'Original_ID': failed_id, 'Normalized_ID': 'N/A', 'Status': '匹配失败 (Failed)',
-                                'Reason': '基因ID标准化失败', 'Annotations': 'N/A'})
-
-        report_df = pd.DataFrame(report_data)
-        report_path = os.path.join(output_dir, "gene_matching_report.csv")
-        report_df.to_csv(report_path, index=False, encoding='utf-8-sig')
-
-        log(_("INFO: 详细注释报告已保存至: {}").format(os.path.basename(report_path)))
-    except Exception as e:
-        log(_("WARNING: 创建基因匹配报告时发生错误: {}").format(e))
+    os.makedirs(output_dir, exist_ok=True)
+    if write_matching_report:
+        progress(15, _("正在生成基因匹配报告..."))
+        try:
+            report_path = write_gene_matching_report(study_gene_ids, study_ids_normalized,
+                                                     background.get_gene_annotations(study_rows), output_dir)
+            log(_("INFO: 详细注释报告已保存至: {}").format(os.path.basename(report_path)))
+        except Exception as e:
+            log(_("WARNING: 创建基因匹配报告时发生错误: {}").format(e))
 
     if N == 0:
         log(_("WARNING: 经过标准化和背景过滤后，没有有效的基因用于富集分析。"))
         progress(100, _("任务终止：无有效基因。"))
         return None
 
-    results = []
-    term_counts = background_df.groupby('TermID')[background_gene_id_col].nunique()
-    term_id_to_name = background_df.drop_duplicates(subset=['TermID']).set_index('TermID')['Description']
-
-    total_terms = len(term_counts)
     progress(20, _("开始超几何检验..."))
+    results_df = background.test(study_genes_in_pop)
 
-    for i, (term_id, n) in enumerate(term_counts.items()):
-        # 在循环中更新进度 (从20%到80%)
-        if i % 50 == 0 or i == total_terms - 1:
-            progress(20 + int(((i + 1) / total_terms) * 60), f"{_('正在计算富集项')} {i + 1}/{total_terms}")
-
-        genes_in_term = set(background_df[background_df['TermID'] == term_id][background_gene_id_col])
-        k_genes_norm = study_genes_in_pop.intersection(genes_in_term)
-        k = len(k_genes_norm)
-
-        if k > 0:
-            p_value = hypergeom.sf(k - 1, M, n, N)
-            rich_factor = k / n if n > 0 else 0
-            results.append({'TermID': term_id, 'Description': term_id_to_name.get(term_id, ''),
-                            'Namespace': background_df.loc[background_df['TermID'] == term_id, 'Namespace'].iloc[0],
-                            'p_value': p_value, 'GeneRatio': f"{k}/{N}", 'BgRatio': f"{n}/{M}",
-                            'Genes': ";".join(sorted(list(k_genes_norm))), 'GeneNumber': k, 'RichFactor': rich_factor})
-
-    if not results:
+    if results_df.empty:
         log(_("WARNING: 分析未产生任何结果。"))
         progress(100, _("任务完成：无结果。"))
         return None
 
-    results_df = pd.DataFrame(results)
-
     progress(85, _("正在进行多重检验校正..."))
     p_values = results_df['p_value'].dropna()
     if p_values.empty:
@@ -164,48 +147,42 @@ def run_go_enrichment(
         status_callback: Callable,
         output_dir: str,
         gene_id_regex: Optional[str] = None,
-        progress_callback: Optional[Callable[[int, str], None]] = None
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        genome_id: Optional[str] = None,
+        write_matching_report: bool = True
 ) -> Optional[pd.DataFrame]:
     """
     执行GO富集分析，并传递进度回调。
+    背景数据按基因组缓存在注释文件旁，不同输出目录与多次运行之间共享。
+    write_matching_report 为 False 时不输出基因匹配报告。
     """
     log = status_callback
     progress = progress_callback if progress_callback else lambda p, m: None
 
     progress(0, _("准备GO富集分析..."))
-    cache_dir = os.path.join(output_dir, '.cache')
-    prepared_go_path = prepare_input_file(go_annotation_path, status_callback, cache_dir)
-
-    if not prepared_go_path:
-        log(_("GO注释文件准备失败，富集分析终止。"), "ERROR")
-        progress(100, _("任务终止：GO文件准备失败。"))
-        return None
-
-    progress(10, _("加载GO背景数据..."))
-    log(_("正在加载处理后的GO注释背景数据..."), "INFO")
+    log(_("正在加载GO注释背景数据..."), "INFO")
     try:
-        background_df = pd.read_csv(prepared_go_path)
-        if not background_df.empty:
-            rename_map = {}
-            if len(background_df.columns) > 0: rename_map[background_df.columns[0]] = 'GeneID'
-            if len(background_df.columns) > 1: rename_map[background_df.columns[1]] = 'TermID'
-            if len(background_df.columns) > 2: rename_map[background_df.columns[2]] = 'Description'
-            if len(background_df.columns) > 3: rename_map[background_df.columns[3]] = 'Namespace'
-            background_df.rename(columns=rename_map, inplace=True)
-            if 'Namespace' not in background_df.columns:
-                background_df['Namespace'] = 'GO'
+        background = load_enrichment_background(go_annotation_path, 'GO', gene_id_regex=gene_id_regex,
+                                                genome_id=genome_id, status_callback=log)
     except Exception as e:
         log(_("读取或重命名GO背景文件失败: {}").format(e), "ERROR")
         progress(100, _("任务终止：读取GO背景失败。"))
         return None
 
+    if background is None:
+        log(_("GO注释文件准备失败，富集分析终止。"), "ERROR")
+        progress(100, _("任务终止：GO文件准备失败。"))
+        return None
+
+    progress(10, _("GO背景数据已就绪。"))
     return _perform_hypergeometric_test(
         study_gene_ids,
-        background_df,
+        background,
         status_callback,
         output_dir,
         gene_id_regex=gene_id_regex,
-        progress_callback=progress  # 将回调函数传递下去
+        progress_callback=progress,  # 将回调函数传递下去
+        write_matching_report=write_matching_report
     )
 
 
@@ -216,35 +193,24 @@ def run_kegg_enrichment(
         status_callback: Optional[Callable] = print,
         gene_id_regex: Optional[str] = None,
         progress_callback: Optional[Callable[[int, str], None]] = None,
+        genome_id: Optional[str] = None,
+        write_matching_report: bool = True,
         **kwargs
 ) -> Optional[pd.DataFrame]:
     """
     执行KEGG富集分析, 与GO分析流程统一，并传递进度回调。
+    write_matching_report 为 False 时不输出基因匹配报告。
     """
     log = status_callback
     progress = progress_callback if progress_callback else lambda p, m: None
 
     try:
         progress(0, _("准备KEGG富集分析..."))
-        cache_dir = os.path.join(output_dir, '.cache')
-        prepared_kegg_path = prepare_input_file(kegg_pathways_path, log, cache_dir)
-
-        if not prepared_kegg_path:
+        background = load_enrichment_background(kegg_pathways_path, 'KEGG', gene_id_regex=gene_id_regex,
+                                                genome_id=genome_id, status_callback=log)
+        if background is None:
             raise ValueError(_("KEGG注释文件准备失败。"))
-
-        progress(10, _("加载KEGG背景数据..."))
-        background_df = pd.read_csv(prepared_kegg_path)
-        if background_df is None or background_df.empty:
-            raise ValueError(_("加载的KEGG注释文件为空或格式不正确。"))
-
-        rename_map = {}
-        if len(background_df.columns) > 0: rename_map[background_df.columns[0]] = 'GeneID'
-        if len(background_df.columns) > 1: rename_map[background_df.columns[1]] = 'TermID'
-        if len(background_df.columns) > 2: rename_map[background_df.columns[2]] = 'Description'
-        background_df.rename(columns=rename_map, inplace=True)
-
-        if 'Namespace' not in background_df.columns:
-            background_df['Namespace'] = 'KEGG'
+        progress(10, _("KEGG背景数据已就绪。"))
 
     except Exception as e:
         log(_("ERROR: 准备KEGG背景文件时出错: {}").format(e))
@@ -253,9 +219,156 @@ def run_kegg_enrichment(
 
     return _perform_hypergeometric_test(
         study_gene_ids,
-        background_df,
+        background,
         log,
         output_dir,
         gene_id_regex=gene_id_regex,
-        progress_callback=progress  # 将回调函数传递下去
-    )
\ No newline at end of file
+        progress_callback=progress,  # 将回调函数传递下去
+        write_matching_report=write_matching_report
+    )
+
+
+def _make_file_stems(names: List[str]) -> Dict[str, str]:
+    """
+    基因集名称 -> 结果文件名前缀。替换非法字符后不同名称可能得到相同前缀（如 'a b' 与 'a_b'），
+    重名时依次加 _2、_3 后缀（不区分大小写，兼容 Windows 文件系统）。
+    """
+    stems, used = {}, set()
+    for name in names:
+        base = re.sub(r'[\\/*?:"<>|\s]', "_", str(name)) or "gene_list"
+        stem, counter = base, 1
+        while stem.lower() in used:
+            counter += 1
+            stem = f"{base}_{counter}"
+        used.add(stem.lower())
+        stems[name] = stem
+    return stems
+
+
+def _finalize_enrichment_chunk(chunk_df: pd.DataFrame, output_dir: str, analysis_type: str,
+                               alpha: float, file_stems: Dict[str, str]) -> pd.DataFrame:
+    """对一个分块内的每个基因集分别做 FDR 校正，并以 file_stems 中的文件名前缀写出各自的结果文件。"""
+    if chunk_df.empty:
+        return chunk_df
+    chunk_df['FDR'] = chunk_df.groupby(GENE_LIST_COLUMN, sort=False)['p_value'].transform(
+        lambda p_values: multipletests(p_values, alpha=alpha, method='fdr_bh')[1])
+    chunk_df = chunk_df.sort_values(by=[GENE_LIST_COLUMN, 'p_value'], kind='mergesort').reset_index(drop=True)
+    for name, list_df in chunk_df.groupby(GENE_LIST_COLUMN, sort=False):
+        list_df.drop(columns=[GENE_LIST_COLUMN]).to_csv(
+            os.path.join(output_dir, f"{file_stems[name]}_{analysis_type.lower()}_enrichment.csv"), index=False,
+            encoding='utf-8-sig')
+    return chunk_df
+
+
+def _run_enrichment_chunk_from_cache(cache_dir: str, study_sets: Dict[str, List[str]], output_dir: str,
+                                     analysis_type: str, alpha: float, file_stems: Dict[str, str]) -> pd.DataFrame:
+    """进程池任务：检验一个分块的基因集并写出结果，结果文件的写入也在工作进程中并行完成。"""
+    return _finalize_enrichment_chunk(test_study_sets_from_cache(cache_dir, study_sets), output_dir, analysis_type,
+                                      alpha, file_stems)
+
+
+def run_batch_enrichment(
+        study_sets: Dict[str, List[str]],
+        annotation_path: str,
+        analysis_type: str,
+        output_dir: str,
+        status_callback: Optional[Callable] = print,
+        gene_id_regex: Optional[str] = None,
+        genome_id: Optional[str] = None,
+        alpha: float = 0.05,
+        max_workers: Optional[int] = None,
+        sets_per_task: int = 50,
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_event: Optional[threading.Event] = None
+) -> Optional[pd.DataFrame]:
+    """
+    批量富集分析：背景只加载一次，所有基因集按分块（每块 sets_per_task 个）一起检验。
+    多个分块时交给进程池，工作进程以内存映射方式直接读取背景缓存。
+    每个基因集各自做 FDR 校正并单独输出结果文件，另外输出一张包含全部基因集的长表。
+
+    :param study_sets: 基因集名称 -> 基因ID列表。
+    :param analysis_type: 'go' 或 'kegg'。
+    :return: 合并后的长表（首列为基因集名称），失败时返回 None。
+    """
+    log = status_callback
+    progress = progress_callback if progress_callback else lambda p, m: None
+
+    progress(0, _("正在加载富集分析背景..."))
+    try:
+        background = load_enrichment_background(annotation_path, analysis_type, gene_id_regex=gene_id_regex,
+                                                genome_id=genome_id, status_callback=log)
+    except Exception as e:
+        log(_("ERROR: 准备{}背景文件时出错: {}").format(analysis_type.upper(), e), "ERROR")
+        background = None
+    if background is None:
+        progress(100, _("任务终止：准备背景失败。"))
+        return None
+
+    progress(10, _("正在标准化 {} 个基因集的基因ID...").format(len(study_sets)))
+    normalized_sets = {}
+    for name, gene_ids in study_sets.items():
+        ids = pd.Series(list(gene_ids), name="orig", dtype=object)
+        if gene_id_regex:
+            ids = normalize_gene_ids(ids, gene_id_regex)
+        normalized_sets[name] = ids.dropna().astype(str).tolist()
+
+    names = list(normalized_sets.keys())
+    # 文件名前缀必须在分块前统一分配，重名的基因集可能落在不同分块（不同进程）中
+    file_stems = _make_file_stems(names)
+    chunks = [{name: normalized_sets[name] for name in names[i:i + sets_per_task]}
+              for i in range(0, len(names), sets_per_task)]
+    cache_dir = get_enrichment_background_dir(annotation_path, analysis_type, genome_id, gene_id_regex)
+    workers = max_workers if max_workers is not None else max(1, (os.cpu_count() or 1) - 1)
+    use_pool = workers > 1 and len(chunks) > 1 and \
+        os.path.exists(os.path.join(cache_dir, BACKGROUND_MANIFEST_FILENAME))
+    os.makedirs(output_dir, exist_ok=True)
+
+    results = [None] * len(chunks)
+    log(_("INFO: 开始批量富集分析: {} 个基因集，{} 个分块。").format(len(names), len(chunks)), "INFO")
+    if use_pool:
+        with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            future_to_index = {
+                executor.submit(_run_enrichment_chunk_from_cache, cache_dir, chunk, output_dir, analysis_type,
+                                alpha, file_stems): i
+                for i, chunk in enumerate(chunks)
+            }
+            pending = set(future_to_index)
+            completed = 0
+            while pending:
+                done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[future_to_index[future]] = future.result()
+                    completed += 1
+                    progress(10 + int(completed / len(chunks) * 75),
+                             _("正在检验基因集分块 {}/{}").format(completed, len(chunks)))
+                if pending and cancel_event and cancel_event.is_set():
+                    for future in pending:
+                        future.cancel()
+                    log(_("INFO: 批量富集分析已被取消。"), "INFO")
+                    return None
+    else:
+        for i, chunk in enumerate(chunks):
+            if cancel_event and cancel_event.is_set():
+                log(_("INFO: 批量富集分析已被取消。"), "INFO")
+                return None
+            results[i] = _finalize_enrichment_chunk(background.test_many(chunk), output_dir, analysis_type, alpha,
+                                                    file_stems)
+            progress(10 + int((i + 1) / len(chunks) * 75), _("正在检验基因集分块 {}/{}").format(i + 1, len(chunks)))
+
+    combined_df = pd.concat([df for df in results if not df.empty], ignore_index=True) \
+        if any(not df.empty for df in results) else pd.DataFrame()
+    if combined_df.empty:
+        log(_("WARNING: 所有基因集的富集分析均未产生任何结果。"), "WARNING")
+        progress(100, _("任务完成：无结果。"))
+        return combined_df
+
+    progress(90, _("正在保存合并结果..."))
+    combined_path = os.path.join(output_dir, f"{analysis_type.lower()}_enrichment_combined.csv")
+    combined_df.to_csv(combined_path, index=False, encoding='utf-8-sig')
+
+    n_without_results = len(names) - combined_df[GENE_LIST_COLUMN].nunique()
+    if n_without_results:
+        log(_("WARNING: {} 个基因集没有任何基因落在背景注释中，未生成结果文件。").format(n_without_results), "WARNING")
+    log(_("SUCCESS: 批量富集分析完成，合并结果已保存至: {}").format(os.path.basename(combined_path)), "INFO")
+    progress(100, _("批量富集分析完成。"))
+    return combined_df
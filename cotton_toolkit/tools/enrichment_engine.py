@@ -0,0 +1,325 @@
+﻿# cotton_toolkit/tools/enrichment_engine.py
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.stats import hypergeom
+
+from ..utils.file_utils import prepare_input_file, get_file_checksum, get_file_fingerprint, \
+    get_sidecar_cache_dir, get_sidecar_cache_path
+from ..utils.id_normalizer import normalize_id_series, ID_MODE_EXTRACT
+
+logger = logging.getLogger("cotton_toolkit.enrichment_engine")
+
+
+try:
+    import builtins
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+
+# 预编译背景的格式版本号，构建规则或文件布局变化时递增
+ENRICHMENT_BACKGROUND_VERSION = 1
+BACKGROUND_MANIFEST_FILENAME = "manifest.json"
+_BACKGROUND_ARRAYS = ['gene_ids', 'term_ids', 'descriptions', 'namespaces', 'indptr', 'indices']
+
+GENE_LIST_COLUMN = 'GeneList'
+ENRICHMENT_RESULT_COLUMNS = ['TermID', 'Description', 'Namespace', 'p_value', 'GeneRatio', 'BgRatio', 'Genes',
+                             'GeneNumber', 'RichFactor']
+
+
+class EnrichmentBackground:
+    """
+    富集分析背景：基因 × 条目（GO Term / KEGG 通路）的稀疏关联矩阵。
+    - gene_ids: 排序后的唯一背景基因ID，对应矩阵的行；
+    - term_ids / descriptions / namespaces: 按 TermID 排序的条目信息，对应矩阵的列；
+    - matrix: CSC 格式的 0/1 矩阵，同一 (基因, 条目) 只计一次；
+    - term_sizes: 每个条目包含的背景基因数 n。
+    构建一次后，任意研究基因集的检验只需对矩阵做一次行切片，并对所有条目一次性向量化地计算 hypergeom.sf。
+    """
+
+    def __init__(self, gene_ids: np.ndarray, term_ids: np.ndarray, descriptions: np.ndarray,
+                 namespaces: np.ndarray, matrix: sparse.csc_matrix):
+        self.gene_ids = gene_ids
+        self.term_ids = term_ids
+        self.descriptions = descriptions
+        self.namespaces = namespaces
+        self.matrix = matrix
+        self.term_sizes = np.diff(matrix.indptr).astype(np.int64)
+        self._row_matrix: Optional[sparse.csr_matrix] = None
+
+    @classmethod
+    def from_dataframe(cls, background_df: pd.DataFrame, gene_column: str = 'GeneID') -> 'EnrichmentBackground':
+        """
+        从包含 [gene_column, 'TermID', 'Description', 'Namespace'] 列的背景表构建。
+        条目的描述与命名空间取该条目在表中首次出现的那一行。
+        """
+        genes = background_df[gene_column]
+        valid_genes = genes.notna().to_numpy()
+        gene_codes, gene_ids = pd.factorize(genes[valid_genes], sort=True)
+
+        terms = background_df['TermID']
+        first_rows = background_df[terms.notna()].drop_duplicates(subset=['TermID'])
+        term_codes, term_ids = pd.factorize(terms[valid_genes], sort=True)
+        first_rows = first_rows.set_index('TermID').reindex(term_ids)
+
+        has_term = term_codes >= 0
+        matrix = sparse.csc_matrix(
+            (np.ones(int(has_term.sum()), dtype=np.int32), (gene_codes[has_term], term_codes[has_term])),
+            shape=(len(gene_ids), len(term_ids)))
+        # 重复的 (基因, 条目) 在构建时被累加，这里统一压回 0/1
+        matrix.sum_duplicates()
+        matrix.data[:] = 1
+        matrix.sort_indices()
+
+        namespaces = first_rows['Namespace'] if 'Namespace' in first_rows.columns \
+            else pd.Series('', index=first_rows.index)
+        return cls(np.asarray(gene_ids, dtype=str), np.asarray(term_ids, dtype=str),
+                   first_rows['Description'].astype(str).to_numpy(dtype=str), namespaces.astype(str).to_numpy(dtype=str),
+                   matrix)
+
+    def save(self, cache_dir: str, manifest: Dict[str, Any]):
+        """以定长 Unicode / 整数 .npy 文件保存，清单最后写入，读取方只信任有清单的目录。"""
+        if os.path.isdir(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        arrays = {'gene_ids': self.gene_ids, 'term_ids': self.term_ids, 'descriptions': self.descriptions,
+                  'namespaces': self.namespaces, 'indptr': self.matrix.indptr, 'indices': self.matrix.indices}
+        for name, array in arrays.items():
+            np.save(os.path.join(cache_dir, f"{name}.npy"), np.asarray(array))
+        manifest_path = os.path.join(cache_dir, BACKGROUND_MANIFEST_FILENAME)
+        tmp_path = f"{manifest_path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({**manifest, 'version': ENRICHMENT_BACKGROUND_VERSION, 'n_genes': self.n_genes,
+                       'n_terms': int(len(self.term_ids))}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+
+    @classmethod
+    def load(cls, cache_dir: str) -> 'EnrichmentBackground':
+        """以内存映射方式加载 save 写出的背景，文本数组同样按需从磁盘读取。"""
+        arrays = {name: np.load(os.path.join(cache_dir, f"{name}.npy"), mmap_mode='r') for name in _BACKGROUND_ARRAYS}
+        indices = arrays['indices']
+        matrix = sparse.csc_matrix((np.ones(len(indices), dtype=np.int32), indices, arrays['indptr']),
+                                   shape=(len(arrays['gene_ids']), len(arrays['term_ids'])))
+        return cls(arrays['gene_ids'], arrays['term_ids'], arrays['descriptions'], arrays['namespaces'], matrix)
+
+    @property
+    def n_genes(self) -> int:
+        return len(self.gene_ids)
+
+    def get_gene_rows(self, gene_ids: Iterable[str]) -> np.ndarray:
+        """返回给定基因ID在背景中的行号（已排序、去重），不在背景中的ID被忽略。"""
+        queries = np.unique(np.asarray([str(gid) for gid in gene_ids], dtype=str))
+        if len(queries) == 0 or self.n_genes == 0:
+            return np.array([], dtype=np.int64)
+        positions = np.searchsorted(self.gene_ids, queries)
+        valid = positions < self.n_genes
+        valid[valid] = self.gene_ids[positions[valid]] == queries[valid]
+        return positions[valid].astype(np.int64)
+
+    @property
+    def row_matrix(self) -> sparse.csr_matrix:
+        """按基因（行）存储的同一矩阵，用于按基因切片；首次访问时转换并缓存。"""
+        if self._row_matrix is None:
+            self._row_matrix = sparse.csr_matrix(self.matrix)
+            self._row_matrix.sort_indices()
+        return self._row_matrix
+
+    def get_gene_annotations(self, gene_rows: np.ndarray) -> Dict[str, str]:
+        """返回给定行号的基因 -> 'TermID (Description); ...' 形式的注释摘要，用于基因匹配报告。"""
+        row_matrix = self.row_matrix[gene_rows]
+        labels = np.char.add(np.char.add(np.asarray(self.term_ids, dtype=str), ' ('),
+                             np.char.add(np.asarray(self.descriptions, dtype=str), ')'))
+        indptr, indices = row_matrix.indptr, row_matrix.indices
+        return {str(self.gene_ids[row]): '; '.join(labels[indices[indptr[i]:indptr[i + 1]]])
+                for i, row in enumerate(gene_rows)}
+
+    def test(self, study_gene_ids: Iterable[str]) -> pd.DataFrame:
+        """
+        对一个研究基因集执行所有条目的超几何检验（单侧，富集方向）。
+        仅返回至少包含一个研究基因的条目；列与 ENRICHMENT_RESULT_COLUMNS 一致，按 TermID 排序。
+        """
+        return self.test_many({'': study_gene_ids}).drop(columns=[GENE_LIST_COLUMN])
+
+    def test_many(self, study_sets: Dict[str, Iterable[str]]) -> pd.DataFrame:
+        """
+        一次性检验多个研究基因集，返回长表（首列 GENE_LIST_COLUMN 为基因集名称，其余列同 test）。
+        所有基因集组成一个 基因集 × 基因 的稀疏矩阵，与背景矩阵相乘即得到全部 (基因集, 条目) 的 k；
+        hypergeom.sf 只对唯一的 (k, n, N) 组合调用一次。
+        """
+        names = list(study_sets.keys())
+        study_rows = [self.get_gene_rows(gene_ids) for gene_ids in study_sets.values()]
+        study_sizes = np.array([len(rows) for rows in study_rows], dtype=np.int64)
+        M = self.n_genes
+        if not names or study_sizes.sum() == 0:
+            return pd.DataFrame(columns=[GENE_LIST_COLUMN] + ENRICHMENT_RESULT_COLUMNS)
+
+        indicator = sparse.csr_matrix(
+            (np.ones(int(study_sizes.sum()), dtype=np.int32), np.concatenate(study_rows),
+             np.concatenate([[0], np.cumsum(study_sizes)])), shape=(len(names), M))
+        hits = sparse.coo_matrix(indicator @ self.matrix)
+        order = np.lexsort((hits.col, hits.row))
+        list_index, term_index = hits.row[order], hits.col[order]
+        k = hits.data[order].astype(np.int64)
+        n = self.term_sizes[term_index]
+        N = study_sizes[list_index]
+
+        # 大背景下单次 hypergeom.sf 的代价不低，而 (k, n, N) 组合高度重复，只对唯一组合求值
+        # (k, n, N) 均不超过背景基因数，编码为单个整数后去重
+        base = M + 1
+        keys, inverse = np.unique((k * base + n) * base + N, return_inverse=True)
+        unique_N, unique_kn = keys % base, keys // base
+        p_values = hypergeom.sf(unique_kn // base - 1, M, unique_kn % base, unique_N)[inverse.reshape(-1)]
+
+        genes = []
+        list_bounds = np.searchsorted(list_index, np.arange(len(names) + 1))
+        for i in range(len(names)):
+            if list_bounds[i] == list_bounds[i + 1]:
+                continue
+            # 每个基因集只切出自身的行，列内的行号即命中的基因（按ID排序）
+            sub_matrix = self.row_matrix[study_rows[i]].tocsc()
+            sub_matrix.sort_indices()
+            sub_genes = self.gene_ids[study_rows[i]]
+            indptr, indices = sub_matrix.indptr, sub_matrix.indices
+            genes.extend(";".join(sub_genes[indices[indptr[t]:indptr[t + 1]]])
+                         for t in term_index[list_bounds[i]:list_bounds[i + 1]])
+
+        return pd.DataFrame({
+            GENE_LIST_COLUMN: np.asarray(names, dtype=object)[list_index],
+            'TermID': self.term_ids[term_index],
+            'Description': self.descriptions[term_index],
+            'Namespace': self.namespaces[term_index],
+            'p_value': p_values,
+            'GeneRatio': [f"{ki}/{Ni}" for ki, Ni in zip(k, N)],
+            'BgRatio': [f"{ni}/{M}" for ni in n],
+            'Genes': genes,
+            'GeneNumber': k,
+            'RichFactor': np.where(n > 0, k / np.maximum(n, 1), 0.0),
+        }, columns=[GENE_LIST_COLUMN] + ENRICHMENT_RESULT_COLUMNS)
+
+
+# 工作进程内缓存: 背景缓存目录 -> EnrichmentBackground，同一进程处理多个分块时只加载一次
+_WORKER_BACKGROUNDS: Dict[str, EnrichmentBackground] = {}
+
+
+def test_study_sets_from_cache(cache_dir: str, study_sets: Dict[str, List[str]]) -> pd.DataFrame:
+    """供进程池调用：从背景缓存目录（内存映射）加载背景并检验一批基因集。"""
+    background = _WORKER_BACKGROUNDS.get(cache_dir)
+    if background is None:
+        background = EnrichmentBackground.load(cache_dir)
+        _WORKER_BACKGROUNDS[cache_dir] = background
+    return background.test_many(study_sets)
+
+def _read_background_manifest(cache_dir: str) -> Optional[Dict[str, Any]]:
+    manifest_path = os.path.join(cache_dir, BACKGROUND_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _is_background_current(annotation_path: str, cache_dir: str, manifest: Optional[Dict[str, Any]]) -> bool:
+    """与同源列式存储相同的判断规则：大小与修改时间相同则直接信任，否则比较校验和。"""
+    if not manifest or manifest.get('version') != ENRICHMENT_BACKGROUND_VERSION:
+        return False
+    source = manifest.get('source', {})
+    fingerprint = get_file_fingerprint(annotation_path)
+    if fingerprint['size'] != source.get('size'):
+        return False
+    if fingerprint['mtime'] == source.get('mtime'):
+        return True
+    if get_file_checksum(annotation_path) != source.get('sha256'):
+        return False
+    source['mtime'] = fingerprint['mtime']
+    try:
+        manifest_path = os.path.join(cache_dir, BACKGROUND_MANIFEST_FILENAME)
+        tmp_path = f"{manifest_path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, manifest_path)
+    except OSError:
+        pass
+    return True
+
+
+def get_enrichment_background_dir(annotation_path: str, annotation_type: str, genome_id: Optional[str],
+                                  gene_id_regex: Optional[str]) -> str:
+    """预编译背景存放在注释文件旁的 .fcgt_cache 目录，所有输出目录、GUI 与命令行共用同一份。"""
+    key = f"{genome_id or ''}\0{annotation_type.upper()}\0{gene_id_regex or ''}\0{ENRICHMENT_BACKGROUND_VERSION}"
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    return get_sidecar_cache_path(annotation_path, f".{annotation_type.lower()}_bg_{digest}")
+
+
+def _read_background_table(prepared_path: str, annotation_type: str) -> pd.DataFrame:
+    """读取标准化后的注释CSV，按列位置重命名为 GeneID / TermID / Description (/ Namespace)。"""
+    background_df = pd.read_csv(prepared_path)
+    if background_df.empty:
+        raise ValueError(_("加载的{}注释文件为空或格式不正确。").format(annotation_type.upper()))
+    standard_names = ['GeneID', 'TermID', 'Description']
+    if annotation_type.upper() == 'GO':
+        standard_names.append('Namespace')
+    rename_map = {column: name for column, name in zip(background_df.columns, standard_names)}
+    background_df.rename(columns=rename_map, inplace=True)
+    if 'Namespace' not in background_df.columns:
+        background_df['Namespace'] = annotation_type.upper()
+    return background_df
+
+
+def load_enrichment_background(
+        annotation_path: str,
+        annotation_type: str,
+        gene_id_regex: Optional[str] = None,
+        genome_id: Optional[str] = None,
+        status_callback: Optional[Callable[[str, str], None]] = None
+) -> Optional[EnrichmentBackground]:
+    """
+    获取某个注释文件的富集分析背景，按 (基因组, 注释类型, 文件校验和, ID正则) 缓存。
+    缓存有效时直接内存映射加载；否则标准化注释文件、规范化基因ID、构建关联矩阵并写入缓存。
+    失败时返回 None。
+    """
+    log = status_callback if status_callback else lambda msg, level="INFO": logger.info(msg)
+    cache_dir = get_enrichment_background_dir(annotation_path, annotation_type, genome_id, gene_id_regex)
+
+    if _is_background_current(annotation_path, cache_dir, _read_background_manifest(cache_dir)):
+        try:
+            background = EnrichmentBackground.load(cache_dir)
+            log(_("INFO: 使用已缓存的{}富集背景: {} 个基因。").format(annotation_type.upper(), background.n_genes), "INFO")
+            return background
+        except (OSError, ValueError, KeyError) as e:
+            log(_("WARNING: 读取富集背景缓存失败，将重新构建: {}").format(e), "WARNING")
+
+    # 在读取源文件之前记录指纹与校验和，构建期间文件若被替换，下次会被识别为过期
+    fingerprint = get_file_fingerprint(annotation_path)
+    checksum = get_file_checksum(annotation_path)
+    prepared_path = prepare_input_file(annotation_path, log, get_sidecar_cache_dir(annotation_path))
+    if not prepared_path:
+        return None
+
+    background_df = _read_background_table(prepared_path, annotation_type)
+    gene_column = 'GeneID'
+    if gene_id_regex:
+        background_df['GeneID_norm'] = normalize_id_series(background_df['GeneID'], gene_id_regex, ID_MODE_EXTRACT)
+        background_df.dropna(subset=['GeneID_norm'], inplace=True)
+        gene_column = 'GeneID_norm'
+
+    background = EnrichmentBackground.from_dataframe(background_df, gene_column)
+    try:
+        background.save(cache_dir, {
+            'genome_id': genome_id, 'annotation_type': annotation_type.upper(), 'gene_id_regex': gene_id_regex,
+            'source': {'name': os.path.basename(annotation_path), 'sha256': checksum, **fingerprint},
+        })
+    except OSError as e:
+        log(_("WARNING: 保存富集背景缓存失败，本次仅在内存中使用: {}").format(e), "WARNING")
+    return background
@@ -2,14 +2,26 @@
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
+import matplotlib
+from matplotlib import style as mpl_style
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.cm import ScalarMappable
+from matplotlib.collections import LineCollection
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
 import networkx as nx
 from upsetplot import from_contents, UpSet
-from typing import List, Optional, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Dict, Any, Callable, Tuple
+import hashlib
+import json
 import os
+import threading
 import textwrap
 import re  # 【新增】导入re模块
 
+from ..utils.file_utils import get_sidecar_cache_dir
+
 try:
     import builtins
 
@@ -20,6 +32,14 @@ except (AttributeError, ImportError):
 
 
 # ------------------- 通用绘图函数 -------------------
+# 所有图表都直接使用 Figure + Agg 画布的面向对象接口，不依赖 pyplot 的全局状态，
+# 因此可以安全地在工作进程（或后台线程）中并行绘制。
+
+
+def _new_figure(figsize: Tuple[float, float]) -> Figure:
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
 
 def plot_enrichment_bubble(
         enrichment_df: pd.DataFrame,
@@ -36,7 +56,6 @@ def plot_enrichment_bubble(
         return None
 
     df = enrichment_df.copy()
-    fig, ax = None, None  # 初始化 fig 和 ax
 
     try:
         actual_sort_by_col = None
@@ -95,43 +114,41 @@ def plot_enrichment_bubble(
 
         df = df.iloc[::-1]
 
-        plt.style.use('seaborn-v0_8-paper')
-        fig, ax = plt.subplots(figsize=(width, height))  # fig 和 ax 在这里被赋值
-
-        scaling_factor = 25
-        scatter = ax.scatter(
-            x=df['RichFactor'],
-            y=df['Description'],
-            s=df['GeneNumber'] * scaling_factor,
-            c=df[actual_sort_by_col],
-            cmap='viridis_r',
-            alpha=0.7,
-            edgecolors="black",
-            linewidth=0.5
-        )
-
-        cbar = plt.colorbar(scatter, ax=ax, pad=0.08)
-        cbar.set_label(actual_sort_by_col, rotation=270, labelpad=15)
-
-        ax.set_xlabel("Rich Factor")
-        ax.set_ylabel("Term Description")
-        ax.grid(True, linestyle='--', alpha=0.6)
-
-        y_labels = [textwrap.fill(label, width=50, break_long_words=False) for label in df['Description']]
-        ax.set_yticklabels(y_labels)
-
-        if show_title:
-            plt.title(title, fontsize=16, fontweight='bold')
-
-        fig.tight_layout()
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
+        with mpl_style.context('seaborn-v0_8-paper'):
+            fig = _new_figure((width, height))
+            ax = fig.subplots()
+
+            scaling_factor = 25
+            scatter = ax.scatter(
+                x=df['RichFactor'],
+                y=df['Description'],
+                s=df['GeneNumber'] * scaling_factor,
+                c=df[actual_sort_by_col],
+                cmap='viridis_r',
+                alpha=0.7,
+                edgecolors="black",
+                linewidth=0.5
+            )
+
+            cbar = fig.colorbar(scatter, ax=ax, pad=0.08)
+            cbar.set_label(actual_sort_by_col, rotation=270, labelpad=15)
+
+            ax.set_xlabel("Rich Factor")
+            ax.set_ylabel("Term Description")
+            ax.grid(True, linestyle='--', alpha=0.6)
+
+            y_labels = [textwrap.fill(label, width=50, break_long_words=False) for label in df['Description']]
+            ax.set_yticklabels(y_labels)
+
+            if show_title:
+                ax.set_title(title, fontsize=16, fontweight='bold')
+
+            fig.tight_layout()
+            fig.savefig(output_path, dpi=300, bbox_inches='tight')
         return output_path
     except Exception as e:
         print(_("Error plotting bubble chart: {}").format(e))
         return None
-    finally:  # 确保在任何情况下都关闭图形
-        if fig is not None:
-            plt.close(fig)
 
 
 def plot_enrichment_bar(
@@ -148,7 +165,6 @@ def plot_enrichment_bar(
     if enrichment_df is None or enrichment_df.empty:
         print(_("Warning: Enrichment DataFrame is empty for bar plot."))
         return None
-    fig, ax = None, None  # 初始化 fig 和 ax
     try:
         df_plot = enrichment_df.copy()
 
@@ -220,41 +236,39 @@ def plot_enrichment_bar(
             df_plot['avg_log2FC'] = avg_fc_list
             use_log2fc_color = True
 
-        plt.style.use('seaborn-v0_8-talk')
-        fig, ax = plt.subplots(figsize=(width, height))  # fig 和 ax 在这里被赋值
-
-        y_pos = range(len(df_plot))
-
-        if use_log2fc_color:
-            norm = plt.Normalize(df_plot['avg_log2FC'].min(), df_plot['avg_log2FC'].max())
-            cmap = plt.get_cmap('coolwarm')
-            colors = cmap(norm(df_plot['avg_log2FC']))
-            bars = ax.barh(y_pos, -np.log10(df_plot['FDR']), align='center', color=colors)
-            sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
-            sm.set_array([])
-            cbar = fig.colorbar(sm, ax=ax)
-            cbar.set_label('Average log2FC')
-        else:
-            bars = ax.barh(y_pos, -np.log10(df_plot['FDR']), align='center', color='skyblue')
+        with mpl_style.context('seaborn-v0_8-talk'):
+            fig = _new_figure((width, height))
+            ax = fig.subplots()
+
+            y_pos = range(len(df_plot))
+
+            if use_log2fc_color:
+                norm = Normalize(df_plot['avg_log2FC'].min(), df_plot['avg_log2FC'].max())
+                cmap = matplotlib.colormaps['coolwarm']
+                colors = cmap(norm(df_plot['avg_log2FC']))
+                bars = ax.barh(y_pos, -np.log10(df_plot['FDR']), align='center', color=colors)
+                sm = ScalarMappable(cmap=cmap, norm=norm)
+                sm.set_array([])
+                cbar = fig.colorbar(sm, ax=ax)
+                cbar.set_label('Average log2FC')
+            else:
+                bars = ax.barh(y_pos, -np.log10(df_plot['FDR']), align='center', color='skyblue')
 
-        ax.set_yticks(y_pos)
-        ax.set_yticklabels(df_plot['Description'], fontsize=12)
-        ax.invert_yaxis()
-        ax.set_xlabel('-log10(FDR)', fontsize=14)
+            ax.set_yticks(y_pos)
+            ax.set_yticklabels(df_plot['Description'], fontsize=12)
+            ax.invert_yaxis()
+            ax.set_xlabel('-log10(FDR)', fontsize=14)
 
-        if show_title:
-            plot_title = title if title else "Enrichment Analysis Bar Plot"
-            ax.set_title(plot_title, fontsize=16, weight='bold')
+            if show_title:
+                plot_title = title if title else "Enrichment Analysis Bar Plot"
+                ax.set_title(plot_title, fontsize=16, weight='bold')
 
-        plt.tight_layout()
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
+            fig.tight_layout()
+            fig.savefig(output_path, dpi=300, bbox_inches='tight')
         return output_path
     except Exception as e:
         print(_("Error plotting bar chart: {}").format(e))
         return None
-    finally:  # 确保在任何情况下都关闭图形
-        if fig is not None:
-            plt.close(fig)
 
 
 def plot_enrichment_upset(
@@ -265,7 +279,6 @@ def plot_enrichment_upset(
     if enrichment_df is None or enrichment_df.empty:
         print(_("Warning: Enrichment DataFrame is empty for upset plot."))
         return None
-    fig = None  # 初始化 fig
     try:
         required_cols = ['FDR', 'Description', 'Genes']
         if not all(col in enrichment_df.columns for col in required_cols):
@@ -284,35 +297,223 @@ def plot_enrichment_upset(
         gene_sets = {row['Description']: set(row['Genes'].split(';')) for index, row in df_plot.iterrows()}
         upset_data = from_contents(gene_sets)
 
-        plt.style.use('seaborn-v0_8-whitegrid')
-        fig = plt.figure(figsize=(12, 7))  # fig 在这里被赋值
+        with mpl_style.context('seaborn-v0_8-whitegrid'):
+            fig = _new_figure((12, 7))
 
-        upset = UpSet(upset_data, orientation='horizontal', sort_by='degree')
-        upset.plot(fig=fig)
+            upset = UpSet(upset_data, orientation='horizontal', sort_by='degree')
+            upset.plot(fig=fig)
 
-        plt.suptitle("Gene Overlap in Enriched Terms", fontsize=16, y=0.98)
-        fig.tight_layout(rect=[0, 0, 1, 0.95])
+            fig.suptitle("Gene Overlap in Enriched Terms", fontsize=16, y=0.98)
+            fig.tight_layout(rect=[0, 0, 1, 0.95])
 
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
+            fig.savefig(output_path, dpi=300, bbox_inches='tight')
         return output_path
     except Exception as e:
         print(_("Error plotting upset chart: {}").format(e))
         return None
-    finally:  # 确保在任何情况下都关闭图形
-        if fig is not None:
-            plt.close(fig)
+
+
+# ------------------- 基因-概念网络 (cnet) -------------------
+
+# 布局缓存的格式版本号，布局算法变化时递增，旧缓存会被自动忽略
+CNET_LAYOUT_VERSION = 1
+CNET_LAYOUTS = ('auto', 'spring', 'grouped')
+# 'auto' 模式下，节点数不超过此值时沿用完整图上的 spring 布局，超过后改用按基因分组的布局
+CNET_SPRING_MAX_NODES = 300
+# 每个条目默认最多单独绘制的基因数，其余基因聚合为一个 "+N genes" 节点
+CNET_MAX_GENES_PER_TERM = 100
+# 基因节点多于此值时只标注条目与聚合节点
+CNET_MAX_GENE_LABELS = 200
+
+# 进程内布局缓存: 布局标识 -> (节点名列表, 坐标数组)
+_CNET_LAYOUT_CACHE: Dict[str, Tuple[List[str], np.ndarray]] = {}
+_CNET_LAYOUT_CACHE_LOCK = threading.Lock()
+
+
+def _build_cnet_edges(df_plot: pd.DataFrame, max_genes_per_term: Optional[int]) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """
+    向量化地将 Genes 列拆分为去重后的 (Term, Gene) 边表，保持条目与基因首次出现的顺序。
+    max_genes_per_term 生效时，每个条目优先保留被多个条目共享的基因，其余基因聚合为一个节点。
+    返回 (边表, 聚合节点 -> 显示标签)。
+    """
+    edges = pd.DataFrame({'Term': df_plot['Description'].astype(str).to_numpy(),
+                          'Gene': df_plot['Genes'].astype(str).str.split(';').to_numpy()}).explode('Gene')
+    edges['Gene'] = edges['Gene'].str.strip().str.replace(r'\.\d+$', '', regex=True)
+    edges = edges[edges['Gene'].notna() & (edges['Gene'] != '')].drop_duplicates().reset_index(drop=True)
+
+    aggregated_labels: Dict[str, str] = {}
+    if not max_genes_per_term or edges.empty:
+        return edges, aggregated_labels
+
+    # 按 (共享条目数降序, 基因ID) 为每个条目内的基因排名，排名只依赖条目-基因集合，与颜色无关
+    shared_counts = edges['Gene'].map(edges['Gene'].value_counts())
+    ranked = edges.assign(_shared=-shared_counts).sort_values(['_shared', 'Gene'], kind='mergesort')
+    rank = ranked.groupby('Term', sort=False).cumcount().reindex(edges.index)
+    keep = rank < max_genes_per_term
+    if keep.all():
+        return edges, aggregated_labels
+
+    dropped_counts = (~keep).groupby(edges['Term'], sort=False).sum()
+    kept = edges[keep]
+    aggregate_rows = []
+    for term, n_dropped in dropped_counts[dropped_counts > 0].items():
+        node_name = f"+{n_dropped} genes [{term}]"
+        aggregated_labels[node_name] = f"+{n_dropped} genes"
+        aggregate_rows.append({'Term': term, 'Gene': node_name})
+    # 聚合节点紧跟在所属条目的最后一个保留基因之后
+    aggregate_df = pd.DataFrame(aggregate_rows)
+    term_order = {term: i for i, term in enumerate(edges['Term'].unique())}
+    combined = pd.concat([kept.assign(_agg=0), aggregate_df.assign(_agg=1)], ignore_index=True)
+    combined['_term_order'] = combined['Term'].map(term_order)
+    combined = combined.sort_values(['_term_order', '_agg'], kind='mergesort')
+    return combined[['Term', 'Gene']].reset_index(drop=True), aggregated_labels
+
+
+def _get_cnet_nodes(edges: pd.DataFrame) -> Tuple[List[str], List[str]]:
+    """按“条目, 其基因...”的首次出现顺序返回 (全部节点, 条目节点)。"""
+    terms = edges['Term'].unique().tolist()
+    sequence: List[str] = []
+    for term, genes in edges.groupby('Term', sort=False)['Gene']:
+        sequence.append(term)
+        sequence.extend(genes.tolist())
+    return list(dict.fromkeys(sequence)), terms
+
+
+def _spring_cnet_layout(nodes: List[str], edges: pd.DataFrame) -> np.ndarray:
+    """在完整图上做 spring 布局（与早期版本的结果一致），适合小网络。"""
+    graph = nx.Graph()
+    graph.add_nodes_from(nodes)
+    graph.add_edges_from(zip(edges['Term'], edges['Gene']))
+    pos = nx.spring_layout(graph, k=0.8, iterations=50, seed=42)
+    return np.array([pos[node] for node in nodes], dtype=float)
+
+
+def _grouped_cnet_layout(nodes: List[str], terms: List[str], edges: pd.DataFrame) -> np.ndarray:
+    """
+    按基因分组的布局：连接到完全相同条目集合的基因在力导向布局中是等价的，
+    因此只对“条目 + 基因组”构成的小型商图做力导向布局，再把每组基因按向日葵螺旋排布在组中心周围。
+    计算量取决于不同条目组合的数量，而不是基因数量。
+    """
+    term_codes = {term: i for i, term in enumerate(terms)}
+    gene_edges = edges.assign(_code=edges['Term'].map(term_codes)).sort_values('_code', kind='mergesort')
+    signatures = gene_edges.groupby('Gene', sort=False)['_code'].agg(tuple)
+    group_codes, group_signatures = pd.factorize(signatures, sort=True)
+    group_sizes = np.bincount(group_codes, minlength=len(group_signatures))
+
+    quotient = nx.Graph()
+    quotient.add_nodes_from(range(len(terms)))
+    group_offset = len(terms)
+    for group_index, signature in enumerate(group_signatures):
+        quotient.add_node(group_offset + group_index)
+        weight = float(np.sqrt(group_sizes[group_index]))
+        quotient.add_edges_from((group_offset + group_index, code, {'weight': weight}) for code in signature)
+    quotient_pos = nx.spring_layout(quotient, k=1.0 / np.sqrt(max(quotient.number_of_nodes(), 1)),
+                                    iterations=100, weight='weight', seed=42)
+    centers = np.array([quotient_pos[i] for i in range(quotient.number_of_nodes())], dtype=float)
+
+    # 每组基因排布在半径与 sqrt(组大小) 成正比的圆盘内
+    gene_group = pd.Series(group_codes, index=signatures.index)
+    node_index = {node: i for i, node in enumerate(nodes)}
+    xy = np.zeros((len(nodes), 2), dtype=float)
+    xy[[node_index[term] for term in terms]] = centers[:len(terms)]
+
+    spacing = 0.6 / np.sqrt(max(len(nodes), 1))
+    golden_angle = np.pi * (3 - np.sqrt(5))
+    gene_rows = np.array([node_index[gene] for gene in gene_group.index], dtype=np.int64)
+    order = np.argsort(gene_group.to_numpy(), kind='stable')
+    sorted_groups = gene_group.to_numpy()[order]
+    group_starts = np.searchsorted(sorted_groups, np.arange(len(group_signatures)))
+    within = np.arange(len(order)) - group_starts[sorted_groups]
+    sizes = group_sizes[sorted_groups]
+    radius = spacing * np.sqrt(sizes) * np.sqrt((within + 0.5) / sizes)
+    theta = within * golden_angle
+    offsets = np.column_stack([radius * np.cos(theta), radius * np.sin(theta)])
+    xy[gene_rows[order]] = centers[group_offset + sorted_groups] + offsets
+    return xy
+
+
+def _load_cnet_layout(cache_path: Optional[str], layout_key: str, nodes: List[str]) -> Optional[np.ndarray]:
+    with _CNET_LAYOUT_CACHE_LOCK:
+        cached = _CNET_LAYOUT_CACHE.get(layout_key)
+    if cached is not None and cached[0] == nodes:
+        return cached[1]
+    if not cache_path or not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as data:
+            if data['nodes'].tolist() != nodes:
+                return None
+            xy = data['xy']
+    except (OSError, ValueError, KeyError):
+        return None
+    with _CNET_LAYOUT_CACHE_LOCK:
+        _CNET_LAYOUT_CACHE[layout_key] = (nodes, xy)
+    return xy
+
+
+def _save_cnet_layout(cache_path: Optional[str], layout_key: str, nodes: List[str], xy: np.ndarray):
+    with _CNET_LAYOUT_CACHE_LOCK:
+        _CNET_LAYOUT_CACHE[layout_key] = (nodes, xy)
+    if not cache_path:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.tmp-{os.getpid()}-{threading.get_ident()}.npz"
+        np.savez(tmp_path, nodes=np.array(nodes, dtype=str), xy=xy)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        print(_("Warning: Failed to save cnet layout cache: {}").format(e))
+
+
+def compute_cnet_layout(
+        edges: pd.DataFrame,
+        layout: str = 'auto',
+        cache_dir: Optional[str] = None
+) -> Tuple[List[str], List[str], np.ndarray]:
+    """
+    计算 cnet 网络的节点坐标，返回 (全部节点, 条目节点, 坐标数组)。
+    布局以 (布局引擎, 条目-基因边表) 为标识缓存在内存和 cache_dir 中，
+    因此只更换颜色或 log2FC 映射重新绘制时不会重复计算布局。
+    """
+    if layout not in CNET_LAYOUTS:
+        raise ValueError(_("未知的网络图布局: {}，可选: {}").format(layout, ", ".join(CNET_LAYOUTS)))
+    nodes, terms = _get_cnet_nodes(edges)
+    if layout == 'auto':
+        layout = 'spring' if len(nodes) <= CNET_SPRING_MAX_NODES else 'grouped'
+
+    payload = json.dumps({'version': CNET_LAYOUT_VERSION, 'layout': layout,
+                          'edges': edges[['Term', 'Gene']].to_numpy().tolist()}, ensure_ascii=False)
+    layout_key = hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+    cache_path = os.path.join(cache_dir, f"cnet_layout_{layout_key}.npz") if cache_dir else None
+
+    xy = _load_cnet_layout(cache_path, layout_key, nodes)
+    if xy is None:
+        if layout == 'spring':
+            xy = _spring_cnet_layout(nodes, edges)
+        else:
+            xy = _grouped_cnet_layout(nodes, terms, edges)
+        _save_cnet_layout(cache_path, layout_key, nodes, xy)
+    return nodes, terms, xy
 
 
 def plot_enrichment_cnet(
         enrichment_df: pd.DataFrame,
         output_path: str,
         top_n: int = 5,
-        gene_log2fc_map: Optional[Dict[str, float]] = None
+        gene_log2fc_map: Optional[Dict[str, float]] = None,
+        layout: str = 'auto',
+        max_genes_per_term: Optional[int] = CNET_MAX_GENES_PER_TERM,
+        use_layout_cache: bool = True
 ) -> Optional[str]:
+    """
+    绘制基因-概念网络图。
+    layout: 'spring' 为完整图上的 spring 布局；'grouped' 为按条目组合分组的布局，适合上千个基因的大网络；
+    'auto' 根据节点数自动选择。max_genes_per_term 为每个条目单独绘制的基因上限（None 表示不限制）。
+    布局会缓存到输出目录的 .fcgt_cache 中（use_layout_cache=False 时仅在进程内缓存）。
+    """
     if enrichment_df is None or enrichment_df.empty:
         print(_("Warning: Enrichment DataFrame is empty for cnet plot."))
         return None
-    fig, ax = None, None  # 初始化 fig 和 ax
     try:
         required_cols = ['FDR', 'Description', 'Genes']
         if not all(col in enrichment_df.columns for col in required_cols):
@@ -327,62 +528,115 @@ def plot_enrichment_cnet(
             print("Warning: DataFrame is empty after sorting and head for cnet plot.")
             return None
 
-        G = nx.Graph()
-        gene_nodes = set()
-
-        for _c, row in df_plot.iterrows():
-            term_id = row['Description']
-            genes = str(row['Genes']).split(';')
-            G.add_node(term_id, node_type='term')
-            for gene in genes:
-                clean_gene = re.sub(r'\.\d+$', '', gene.strip())  # 这里会用到re
-                if clean_gene and clean_gene not in gene_nodes:
-                    G.add_node(clean_gene, node_type='gene')
-                    gene_nodes.add(clean_gene)
-                if clean_gene:
-                    G.add_edge(term_id, clean_gene)
-
-        node_colors = []
-        node_sizes = []
-        term_color = 'skyblue'
-
-        fc_colors = {}
-        if gene_log2fc_map:
-            valid_fc_values = [gene_log2fc_map.get(node) for node in gene_nodes if
-                               gene_log2fc_map.get(node) is not None]
-            if valid_fc_values:
-                norm = plt.Normalize(min(valid_fc_values), max(valid_fc_values))
-                cmap = plt.get_cmap('coolwarm')
-                for node in gene_nodes:
-                    fc_colors[node] = cmap(norm(gene_log2fc_map.get(node, 0)))
-
-        for node in G.nodes():
-            if G.nodes[node]['node_type'] == 'term':
-                node_colors.append(term_color)
-                node_sizes.append(G.degree(node) * 100)
-            else:
-                node_sizes.append(150)
-                if node in fc_colors:
-                    node_colors.append(fc_colors[node])
-                else:
-                    node_colors.append('lightgreen')
-
-        plt.style.use('default')
-        fig, ax = plt.subplots(figsize=(12, 12))  # fig 和 ax 在这里被赋值
+        edges, aggregated_labels = _build_cnet_edges(df_plot, max_genes_per_term)
+        if edges.empty:
+            print(_("Warning: No genes found in the top terms for cnet plot."))
+            return None
 
-        pos = nx.spring_layout(G, k=0.8, iterations=50, seed=42)
+        cache_dir = get_sidecar_cache_dir(output_path) if use_layout_cache else None
+        nodes, terms, xy = compute_cnet_layout(edges, layout=layout, cache_dir=cache_dir)
 
-        nx.draw(G, pos, ax=ax, with_labels=True, node_color=node_colors, node_size=node_sizes,
-                font_size=9, font_weight='bold', edge_color='grey', alpha=0.8)
+        node_series = pd.Series(nodes)
+        is_term = node_series.isin(terms).to_numpy()
+        is_aggregate = node_series.isin(list(aggregated_labels)).to_numpy()
+        is_gene = ~is_term & ~is_aggregate
+        degrees = pd.concat([edges['Term'], edges['Gene']]).value_counts().reindex(nodes).fillna(0).to_numpy()
 
-        ax.set_title("Gene-Concept Network", fontsize=16, weight='bold')
+        # 大网络按节点数缩小节点，避免互相遮挡
+        scale = min(1.0, np.sqrt(CNET_SPRING_MAX_NODES / len(nodes)))
+        node_sizes = np.where(is_term, degrees * 100 * scale, np.where(is_aggregate, 300.0, 150.0 * scale))
 
-        fig.tight_layout()
-        plt.savefig(output_path, dpi=300, bbox_inches='tight')
+        node_colors = np.empty(len(nodes), dtype=object)
+        node_colors[is_term] = 'skyblue'
+        node_colors[is_aggregate] = 'lightgrey'
+        gene_colors = ['lightgreen'] * int(is_gene.sum())
+        if gene_log2fc_map:
+            fc_values = node_series[is_gene].map(gene_log2fc_map)
+            valid_fc_values = fc_values.dropna()
+            if not valid_fc_values.empty:
+                norm = Normalize(valid_fc_values.min(), valid_fc_values.max())
+                cmap = matplotlib.colormaps['coolwarm']
+                gene_colors = [tuple(rgba) for rgba in cmap(norm(fc_values.fillna(0).to_numpy(dtype=float)))]
+        for i, color in zip(np.flatnonzero(is_gene), gene_colors):
+            node_colors[i] = color
+
+        label_mask = ~is_gene if is_gene.sum() > CNET_MAX_GENE_LABELS else np.ones(len(nodes), dtype=bool)
+        node_index = {node: i for i, node in enumerate(nodes)}
+        edge_index = np.column_stack([edges['Term'].map(node_index).to_numpy(),
+                                      edges['Gene'].map(node_index).to_numpy()])
+
+        with mpl_style.context('default'):
+            fig = _new_figure((12, 12))
+            ax = fig.subplots()
+
+            ax.add_collection(LineCollection(xy[edge_index], colors='grey', alpha=0.8,
+                                             linewidths=1.0 if len(nodes) <= CNET_SPRING_MAX_NODES else 0.3,
+                                             zorder=1))
+            ax.scatter(xy[:, 0], xy[:, 1], s=node_sizes, c=list(node_colors), alpha=0.8, zorder=2)
+            for i in np.flatnonzero(label_mask):
+                ax.text(xy[i, 0], xy[i, 1], aggregated_labels.get(nodes[i], nodes[i]), fontsize=9,
+                        fontweight='bold', ha='center', va='center', zorder=3)
+            ax.set_axis_off()
+
+            ax.set_title("Gene-Concept Network", fontsize=16, weight='bold')
+
+            fig.tight_layout()
+            fig.savefig(output_path, dpi=300, bbox_inches='tight')
         return output_path
     except Exception as e:
         print(_("Error plotting cnet chart: {}").format(e))
         return None
-    finally:  # 确保在任何情况下都关闭图形
-        if fig is not None:
-            plt.close(fig)
\ No newline at end of file
+
+# ------------------- 并行渲染 -------------------
+
+PLOT_FUNCTIONS: Dict[str, Callable[..., Optional[str]]] = {
+    'bubble': plot_enrichment_bubble,
+    'bar': plot_enrichment_bar,
+    'upset': plot_enrichment_upset,
+    'cnet': plot_enrichment_cnet,
+}
+
+
+def _render_plot_job(plot_type: str, plot_kwargs: Dict[str, Any]) -> Optional[str]:
+    return PLOT_FUNCTIONS[plot_type](**plot_kwargs)
+
+
+def render_plot_jobs(
+        jobs: List[Tuple[str, Dict[str, Any], str]],
+        max_workers: Optional[int] = None,
+        progress_callback: Optional[Callable[[int, str], None]] = None,
+        cancel_event: Optional[threading.Event] = None
+) -> List[Optional[str]]:
+    """
+    渲染一组图表。每个任务为 (图表类型, 绘图函数参数, 进度提示文字)。
+    多于一个任务且 max_workers > 1 时使用进程池并行绘制；进度与返回值都严格按任务顺序给出。
+    返回与 jobs 等长的列表，绘制失败或被取消的任务为 None。
+    """
+    progress = progress_callback if progress_callback else lambda p, m: None
+    total = len(jobs)
+    results: List[Optional[str]] = [None] * total
+    if total == 0:
+        return results
+
+    workers = max_workers if max_workers is not None else min(total, os.cpu_count() or 1)
+    if workers <= 1 or total == 1:
+        for i, (plot_type, plot_kwargs, label) in enumerate(jobs):
+            if cancel_event and cancel_event.is_set():
+                break
+            progress(int(i / total * 100), label)
+            results[i] = _render_plot_job(plot_type, plot_kwargs)
+        return results
+
+    with ProcessPoolExecutor(max_workers=min(workers, total)) as executor:
+        futures = [executor.submit(_render_plot_job, plot_type, plot_kwargs) for plot_type, plot_kwargs, _label in jobs]
+        for i, future in enumerate(futures):
+            if cancel_event and cancel_event.is_set():
+                for pending in futures[i:]:
+                    pending.cancel()
+                break
+            progress(int(i / total * 100), jobs[i][2])
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                print(_("Error rendering {} plot: {}").format(jobs[i][0], e))
+    return results
@@ -1,10 +1,14 @@
 ﻿# cotton_toolkit/utils/file_utils.py
+import codecs
+import hashlib
 import io
+import json
 import os
+import re
 import pandas as pd
 import gzip
 import logging
-from typing import Callable, Optional
+from typing import Callable, Optional, Dict, Any, List, Tuple
 
 from cotton_toolkit.core.file_normalizer import normalize_to_csv
 
@@ -18,6 +22,63 @@ except (AttributeError, ImportError):
 
 logger = logging.getLogger(__name__)
 
+# 各类派生缓存（列式存储、索引等）统一放在源文件同级的这个隐藏目录中
+SIDECAR_CACHE_DIRNAME = ".fcgt_cache"
+# 下载器在每个基因组版本目录中记录已下载文件的来源与校验信息
+DOWNLOAD_MANIFEST_FILENAME = "download_manifest.json"
+# 判断文本文件编码与分隔符时读取的前缀字节数
+TEXT_SNIFF_BYTES = 64 * 1024
+WHITESPACE_SEPARATOR = r'\s+'
+
+
+def calculate_file_checksum(file_path: str, algorithm: str = "sha256", chunk_size: int = 1024 * 1024) -> str:
+    """分块计算文件的哈希值，避免一次性将大文件读入内存。"""
+    hasher = hashlib.new(algorithm)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def get_file_fingerprint(file_path: str) -> Dict[str, Any]:
+    """返回文件的轻量指纹（大小与修改时间），用于快速判断文件是否可能已变化。"""
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def read_download_manifest(directory: str) -> Dict[str, Dict[str, Any]]:
+    """读取目录中的下载清单，返回 文件名 -> {url, size, mtime, etag, last_modified, sha256, ...}。清单不存在或损坏时返回空字典。"""
+    try:
+        with open(os.path.join(directory, DOWNLOAD_MANIFEST_FILENAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    files = manifest.get('files') if isinstance(manifest, dict) else None
+    return files if isinstance(files, dict) else {}
+
+
+def get_file_checksum(file_path: str) -> str:
+    """
+    返回文件的 SHA-256。文件由下载器记录过、且大小与修改时间仍与下载清单一致时直接使用清单中的值，
+    否则重新计算。各类派生缓存据此判断源文件是否变化，下载器替换文件后它们会自动失效。
+    """
+    entry = read_download_manifest(os.path.dirname(os.path.abspath(file_path))).get(os.path.basename(file_path))
+    if entry and entry.get('sha256'):
+        fingerprint = get_file_fingerprint(file_path)
+        if fingerprint['size'] == entry.get('size') and fingerprint['mtime'] == entry.get('mtime'):
+            return entry['sha256']
+    return calculate_file_checksum(file_path)
+
+
+def get_sidecar_cache_dir(source_path: str) -> str:
+    """获取源文件所在目录下的派生缓存目录: <源文件目录>/.fcgt_cache。"""
+    return os.path.join(os.path.dirname(os.path.abspath(source_path)), SIDECAR_CACHE_DIRNAME)
+
+
+def get_sidecar_cache_path(source_path: str, suffix: str) -> str:
+    """获取与源文件关联的派生缓存路径: <源文件目录>/.fcgt_cache/<源文件名><suffix>。"""
+    return os.path.join(get_sidecar_cache_dir(source_path), os.path.basename(source_path) + suffix)
+
 
 def prepare_input_file(
         original_path: str,
@@ -75,13 +136,93 @@ def prepare_input_file(
         return None
 
 
-def smart_load_file(file_path: str, logger_func: Optional[Callable] = None) -> Optional[pd.DataFrame]:
+def _open_maybe_gzip(file_path: str):
+    return gzip.open(file_path, 'rb') if file_path.lower().endswith('.gz') else open(file_path, 'rb')
+
+
+def sniff_text_format(file_path: str, comment: Optional[str] = None) -> Tuple[str, str, str]:
+    """
+    只读取文件（支持 .gz）开头的一小段，推断编码与分隔符。
+    返回 (编码, 分隔符, 首个非注释行)：首行含制表符时用制表符，否则用逗号。
+    """
+    with _open_maybe_gzip(file_path) as f:
+        prefix = f.read(TEXT_SNIFF_BYTES)
+
+    if prefix.startswith(codecs.BOM_UTF8):
+        encoding = 'utf-8-sig'
+        prefix = prefix[len(codecs.BOM_UTF8):]
+    else:
+        encoding = 'utf-8'
+    try:
+        # 前缀可能截断在多字节字符中间，使用增量解码器忽略末尾不完整的字节
+        text = codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+    except UnicodeDecodeError:
+        encoding = 'latin-1'
+        text = prefix.decode('latin-1')
+
+    first_line = next((line for line in text.splitlines()
+                       if line.strip() and not (comment and line.startswith(comment))), "")
+    separator = '\t' if '\t' in first_line else ','
+    return encoding, separator, first_line
+
+
+def read_delimited_file(
+        file_path: str,
+        sep: Optional[str] = None,
+        usecols: Optional[List[Any]] = None,
+        dtype: Optional[Any] = None,
+        comment: Optional[str] = None,
+        engine: str = 'c',
+        **kwargs
+) -> pd.DataFrame:
+    """
+    快速读取分隔符文本文件（CSV/TSV/空白分隔，支持 .gz）。
+    编码与分隔符由文件开头的一小段推断，数据直接从（解压）文件句柄流式交给 C 或 pyarrow 引擎解析，
+    不会先把整个文件读成字符串。usecols 中的整数列号超出实际列数时会被忽略，便于按位置只读取需要的列。
+
+    :param sep: 分隔符，None 表示自动推断；空白分隔的文件可传 WHITESPACE_SEPARATOR。
+    :param dtype: 传给 pandas 的显式列类型，避免逐列推断类型。
+    :param engine: 默认 'c'。'pyarrow' 只在显式指定时使用：它不是本项目的依赖，且类型推断与 C 引擎不同
+                   （例如会把日期样式的列解析为日期）；不可用或选项不兼容时回退到 C 引擎。
+    """
+    encoding, sniffed_sep, first_line = sniff_text_format(file_path, comment=comment)
+    separator = sep if sep is not None else sniffed_sep
+    if usecols is not None and not callable(usecols):
+        # 多字符分隔符按正则处理，与 pandas 的约定一致
+        fields = re.split(separator, first_line.strip()) if len(separator) > 1 else first_line.split(separator)
+        usecols = [col for col in usecols if not isinstance(col, int) or col < len(fields)]
+
+    read_kwargs = dict(sep=separator, usecols=usecols, dtype=dtype, comment=comment, encoding=encoding,
+                       compression='infer', **kwargs)
+    if engine == 'pyarrow':
+        try:
+            return pd.read_csv(file_path, engine='pyarrow', **read_kwargs)
+        except (ValueError, TypeError, ImportError) as e:
+            # pyarrow 不支持的选项组合或解析失败时回退到 C 引擎
+            logger.debug(_("pyarrow 引擎读取 {} 失败，回退到 C 引擎: {}").format(os.path.basename(file_path), e))
+    try:
+        return pd.read_csv(file_path, engine='c', **read_kwargs)
+    except UnicodeDecodeError:
+        # 开头部分是合法的 UTF-8 而后文不是：按 latin-1 重新读取，latin-1 可以解码任意字节
+        logger.warning(_("文件 {} 使用UTF-8解码失败，尝试latin-1编码。").format(os.path.basename(file_path)))
+        read_kwargs['encoding'] = 'latin-1'
+        return pd.read_csv(file_path, engine='c', **read_kwargs)
+
+
+def smart_load_file(
+        file_path: str,
+        logger_func: Optional[Callable] = None,
+        usecols: Optional[List[Any]] = None,
+        dtype: Optional[Any] = None
+) -> Optional[pd.DataFrame]:
     """
     智能加载数据文件，能自动处理 .gz 压缩和多种表格格式 (Excel, CSV, TSV)。
 
     Args:
         file_path (str): 要加载的文件路径。
         logger_func (Callable, optional): 用于记录日志的回调函数。如果为None，则使用标准日志。
+        usecols (list, optional): 只读取这些列（列名或列号），其余列不会被解析。
+        dtype (optional): 显式指定列类型，例如 str，跳过类型推断。
 
     Returns:
         Optional[pd.DataFrame]: 成功则返回一个DataFrame，失败则返回None。
@@ -100,7 +241,6 @@ def smart_load_file(file_path: str, logger_func: Optional[Callable] = None) -> O
     try:
         # 2. 自动处理 .gz 压缩
         is_gzipped = file_path.lower().endswith('.gz')
-        open_func = gzip.open if is_gzipped else open
 
         # 获取用于判断文件类型的扩展名（去除.gz）
         uncompressed_path = file_path.lower().replace('.gz', '') if is_gzipped else file_path.lower()
@@ -108,34 +248,16 @@ def smart_load_file(file_path: str, logger_func: Optional[Callable] = None) -> O
 
         logger_func(_("正在读取文件: {} (类型: {}, 压缩: {})").format(file_name_for_log, file_ext, is_gzipped), "DEBUG")
 
-        with open_func(file_path, 'rb') as f:
-            content_bytes = f.read()
-
         # 3. 根据文件扩展名选择合适的读取方式
         df = None
         if file_ext in ['.xlsx', '.xls']:
             # 读取 Excel 文件
-            df = pd.read_excel(io.BytesIO(content_bytes), engine='openpyxl')
+            with _open_maybe_gzip(file_path) as f:
+                df = pd.read_excel(io.BytesIO(f.read()), engine='openpyxl', usecols=usecols, dtype=dtype)
 
         elif file_ext in ['.csv', '.tsv', '.txt']:
-            # 读取文本文件 (CSV, TSV等)
-            # 先尝试用 utf-8 解码
-            try:
-                content_str = content_bytes.decode('utf-8')
-            except UnicodeDecodeError:
-                logger_func(_("文件 {} 使用UTF-8解码失败，尝试latin-1编码。").format(file_name_for_log), "WARNING")
-                content_str = content_bytes.decode('latin-1', errors='ignore')
-
-            # 自动检测分隔符 (制表符优先)
-            first_line = content_str.splitlines()[0] if content_str else ""
-            if '\t' in first_line:
-                separator = '\t'
-                logger_func(_("检测到制表符(Tab)分隔符: {}").format(file_name_for_log), "DEBUG")
-            else:
-                separator = ','
-                logger_func(_("默认使用逗号(Comma)分隔符: {}").format(file_name_for_log), "DEBUG")
-
-            df = pd.read_csv(io.StringIO(content_str), sep=separator, engine='python')
+            # 读取文本文件 (CSV, TSV等)：编码与分隔符（制表符优先）由文件开头推断，随后流式解析
+            df = read_delimited_file(file_path, usecols=usecols, dtype=dtype)
 
         else:
             logger_func(_("警告: 不支持的文件扩展名 '{}' 来自文件: {}").format(file_ext, file_name_for_log), "WARNING")
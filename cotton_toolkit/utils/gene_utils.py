@@ -4,6 +4,8 @@ import re
 import pandas as pd
 from typing import List, Union, Optional, Tuple
 
+from .id_normalizer import normalize_id_series, ID_MODE_EXTRACT
+
 try:
     import builtins
     _ = builtins._
@@ -53,12 +55,8 @@ def normalize_gene_ids(gene_ids: pd.Series, pattern: str) -> pd.Series:
     此版本经过加固，即使正则表达式包含多个捕获组，也能稳定地只返回第一列结果。
     """
     try:
-        # --- 这是核心修改 ---
-        # 1. expand=True 确保 str.extract 的返回结果永远是一个DataFrame。
-        # 2. .iloc[:, 0] 明确选取这个DataFrame的第一列。
-        # 这样，无论用户在YAML中定义的pattern有多少个括号，函数都能稳定返回一个Series。
-        return gene_ids.str.extract(f"({pattern})", expand=True).iloc[:, 0]
-        # --- 修改结束 ---
+        # 取整个匹配部分，因此无论用户在YAML中定义的pattern有多少个括号，结果都是稳定的单列Series。
+        return normalize_id_series(gene_ids, pattern, ID_MODE_EXTRACT)
     except Exception as e:
         # 如果模式无效或出现其他错误，打印警告并返回原始数据
         print(_("Warning: Failed to apply regex for gene ID normalization. Reason: {}").format(e))
@@ -0,0 +1,144 @@
+﻿# cotton_toolkit/utils/id_normalizer.py
+
+import hashlib
+import json
+import logging
+import os
+import re
+from functools import lru_cache
+from typing import Optional, Pattern
+
+import numpy as np
+import pandas as pd
+
+from .file_utils import get_file_fingerprint, get_sidecar_cache_path
+
+try:
+    import builtins
+    _ = builtins._
+except (AttributeError, ImportError):
+    def _(text: str) -> str:
+        return text
+
+
+logger = logging.getLogger(__name__)
+
+# 标准化模式:
+# - fallback: 取第一个捕获组，未匹配（或正则没有捕获组）时保留去除空白后的原值，用于同源映射；
+# - extract: 取整个匹配部分，未匹配时为 NaN，用于注释与富集分析。
+ID_MODE_FALLBACK = "fallback"
+ID_MODE_EXTRACT = "extract"
+
+# 缓存格式版本号，标准化规则变化时递增
+ID_CACHE_VERSION = 1
+
+
+@lru_cache(maxsize=256)
+def get_compiled_id_regex(regex_pattern: str, ignore_case: bool = False) -> Pattern:
+    """编译基因ID正则表达式，同一模式在整个进程中只编译一次。"""
+    return re.compile(regex_pattern, re.IGNORECASE if ignore_case else 0)
+
+
+def normalize_id(gene_id, regex_pattern: Optional[str], mode: str = ID_MODE_FALLBACK,
+                 ignore_case: bool = False, lowercase: bool = False) -> Optional[str]:
+    """标准化单个基因ID，规则与 normalize_id_series 完全一致。"""
+    processed_id = str(gene_id).strip()
+    if not regex_pattern:
+        result = processed_id
+    else:
+        match = get_compiled_id_regex(regex_pattern, ignore_case).search(processed_id)
+        if mode == ID_MODE_FALLBACK:
+            group = match.group(1) if match and match.re.groups else None
+            result = group if group is not None else processed_id
+        else:
+            result = match.group(0) if match else None
+    if result is not None and lowercase:
+        result = result.lower()
+    return result
+
+
+def _wrap_whole_match(regex_pattern: str) -> str:
+    """把整个正则包进第一个捕获组，使 str.extract 返回整个匹配；开头的全局内联标志（如 (?i)）必须留在最前面。"""
+    inline_flags = re.match(r'\(\?[aiLmsux]+\)', regex_pattern)
+    prefix = inline_flags.group(0) if inline_flags else ''
+    return f"{prefix}({regex_pattern[len(prefix):]})"
+
+
+def normalize_id_series(values: pd.Series, regex_pattern: Optional[str], mode: str = ID_MODE_FALLBACK,
+                        ignore_case: bool = False, lowercase: bool = False) -> pd.Series:
+    """
+    向量化地标准化一整列基因ID。
+    注释表与同源表中的ID大量重复，因此先去重，只对唯一值用 str.extract 整列匹配，再按编码映射回整列。
+    """
+    codes, uniques = pd.factorize(values.astype(str), sort=False, use_na_sentinel=False)
+    stripped = pd.Series(uniques, dtype=object).str.strip()
+    flags = re.IGNORECASE if ignore_case else 0
+    if not regex_pattern:
+        normalized = stripped
+    elif mode == ID_MODE_FALLBACK:
+        # 第一个捕获组；未匹配或正则没有捕获组时保留原值
+        if get_compiled_id_regex(regex_pattern, ignore_case).groups:
+            normalized = stripped.str.extract(regex_pattern, flags=flags, expand=True)[0].fillna(stripped)
+        else:
+            normalized = stripped
+    else:
+        normalized = stripped.str.extract(_wrap_whole_match(regex_pattern), flags=flags, expand=True)[0]
+    if lowercase:
+        normalized = normalized.str.lower()
+    normalized_uniques = normalized.to_numpy(dtype=object, copy=True)
+    if mode == ID_MODE_EXTRACT:
+        normalized_uniques[pd.isna(normalized_uniques)] = np.nan
+    result = normalized_uniques.take(codes) if len(codes) else np.array([], dtype=object)
+    return pd.Series(result, index=values.index, name=values.name, dtype=object)
+
+
+def _id_cache_paths(source_path: str, column: str, regex_pattern: Optional[str], mode: str,
+                    ignore_case: bool, lowercase: bool):
+    key = f"{column}\0{regex_pattern or ''}\0{mode}\0{int(ignore_case)}\0{int(lowercase)}\0{ID_CACHE_VERSION}"
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+    data_path = get_sidecar_cache_path(source_path, f".ids_{digest}.npy")
+    return data_path, data_path[:-len(".npy")] + ".json"
+
+
+def load_or_normalize_column(
+        source_path: str,
+        column: str,
+        values: pd.Series,
+        regex_pattern: Optional[str],
+        mode: str = ID_MODE_FALLBACK,
+        ignore_case: bool = False,
+        lowercase: bool = False
+) -> pd.Series:
+    """
+    获取某个文件中某一列的标准化结果，并按 (文件, 列, 正则, 模式) 缓存到源文件旁的 .fcgt_cache 目录。
+    源文件的大小或修改时间变化、或行数不一致时，缓存自动失效并重新计算。
+    """
+    if not source_path or not os.path.exists(source_path):
+        return normalize_id_series(values, regex_pattern, mode, ignore_case, lowercase)
+
+    data_path, meta_path = _id_cache_paths(source_path, column, regex_pattern, mode, ignore_case, lowercase)
+    fingerprint = get_file_fingerprint(source_path)
+
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('source') == fingerprint and meta.get('n_rows') == len(values):
+            cached = np.load(data_path, allow_pickle=False).astype(object)
+            if mode == ID_MODE_EXTRACT:
+                cached[cached == ''] = np.nan
+            return pd.Series(cached, index=values.index, name=values.name, dtype=object)
+    except (OSError, ValueError, KeyError):
+        pass
+
+    normalized = normalize_id_series(values, regex_pattern, mode, ignore_case, lowercase)
+    try:
+        os.makedirs(os.path.dirname(data_path), exist_ok=True)
+        np.save(data_path, normalized.fillna('').to_numpy(dtype=str))
+        tmp_path = f"{meta_path}.tmp-{os.getpid()}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'source': fingerprint, 'n_rows': int(len(values)), 'column': column,
+                       'regex': regex_pattern, 'mode': mode}, f, indent=2)
+        os.replace(tmp_path, meta_path)
+    except OSError as e:
+        logger.debug(_("无法写入ID标准化缓存 {}: {}").format(data_path, e))
+    return normalized
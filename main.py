@@ -3,6 +3,7 @@
 import builtins
 import json
 import logging
+import multiprocessing
 import os
 import sys
 import traceback
@@ -98,4 +99,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # 打包版本中，进程池的子进程会重新执行入口文件，必须先交给 freeze_support 处理，否则会再打开一个主界面
+    multiprocessing.freeze_support()
     main()
\ No newline at end of file
@@ -0,0 +1,67 @@
+# tests/test_bsa_analyzer.py
+# 用模拟的 F2 混池 VCF 验证 BSA 分析在默认配置下能找回已知的候选位点。
+
+import gzip
+
+import numpy as np
+
+from cotton_toolkit.config.models import BSAAnalyzerConfig
+from cotton_toolkit.tools.bsa_analyzer import analyze_bsa_vcf
+
+CHROM_LENGTH = 20_000_000
+CAUSAL_CHROM, UNLINKED_CHROM = "Ghir_A01", "Ghir_A02"
+CAUSAL_POS = 10_000_000
+# 连锁区段半宽：离致因位点越远，混池等位基因频率越接近 0.5
+LINKAGE_HALF_WIDTH = 1_500_000
+
+
+def write_f2_pool_vcf(path, seed=7):
+    """
+    生成两个混池的 VCF：混池1 为野生型（突变等位基因在致因位点处频率约 1/3），混池2 为隐性突变型（约 1.0）；
+    不连锁的位点在两个混池中频率均为 0.5。每 1 kb 一个 SNP，读深服从泊松分布。
+    """
+    rng = np.random.default_rng(seed)
+    lines = ["##fileformat=VCFv4.2",
+             '##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allelic depths">',
+             "\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT", "wt_pool", "mut_pool"])]
+    positions = np.arange(500, CHROM_LENGTH, 1000)
+    for chrom in (CAUSAL_CHROM, UNLINKED_CHROM):
+        linkage = np.zeros(len(positions))
+        if chrom == CAUSAL_CHROM:
+            linkage = np.clip(1 - np.abs(positions - CAUSAL_POS) / LINKAGE_HALF_WIDTH, 0, 1)
+        freqs = (0.5 - (0.5 - 1 / 3) * linkage, 0.5 + 0.5 * linkage)
+        samples = []
+        for freq in freqs:
+            depth = rng.poisson(25, len(positions))
+            alt = rng.binomial(depth, freq)
+            samples.append((depth - alt, alt))
+        for i, pos in enumerate(positions):
+            (ref1, alt1), (ref2, alt2) = samples
+            lines.append(f"{chrom}\t{pos}\t.\tA\tG\t50\tPASS\t.\tGT:AD\t0/1:{ref1[i]},{alt1[i]}\t0/1:{ref2[i]},{alt2[i]}")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def test_default_config_recovers_known_locus(tmp_path):
+    vcf_path = str(tmp_path / "pools.vcf.gz")
+    write_f2_pool_vcf(vcf_path)
+    cfg = BSAAnalyzerConfig()
+
+    result = analyze_bsa_vcf(vcf_path, str(tmp_path / "out"), cfg.window_size, cfg.step_size, cfg.min_depth,
+                             cfg.delta_threshold, min_snps_per_window=cfg.min_snps_per_window,
+                             min_snp_index=cfg.min_snp_ratio, max_workers=cfg.max_workers,
+                             status_callback=lambda msg, level="INFO": None)
+    assert result is not None
+    windows, regions = result["windows"], result["regions"]
+
+    # 位点过滤不能把不连锁区域的窗口清空：两条染色体上几乎所有窗口都应有 Δ 值
+    assert windows["delta_snp_index"].isna().mean() < 0.1
+    unlinked = windows[windows["chrom"] == UNLINKED_CHROM]["delta_snp_index"].dropna()
+    assert len(unlinked) > 0 and unlinked.abs().max() < 0.2
+
+    # 只有一个候选区域，覆盖致因位点，且不超出连锁区段
+    assert len(regions) == 1
+    region = regions.iloc[0]
+    assert region["chrom"] == CAUSAL_CHROM
+    assert region["start"] <= CAUSAL_POS <= region["end"]
+    assert CAUSAL_POS - LINKAGE_HALF_WIDTH <= region["start"] and region["end"] <= CAUSAL_POS + LINKAGE_HALF_WIDTH
@@ -0,0 +1,239 @@
+# tests/test_network_mocks.py
+# 用本地 http.server 模拟AI服务商与下载服务器，验证限流、重试、断点续传与服务池故障转移。
+
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from cotton_toolkit.core.ai_engine import AIExecutionEngine
+from cotton_toolkit.core.ai_pool import AIProviderPool, PoolEndpoint
+from cotton_toolkit.core.ai_wrapper import AIWrapper, AIServiceError
+from cotton_toolkit.core.download_engine import DownloadEngine, DOWNLOAD_STATUS_DOWNLOADED, PART_SUFFIX, \
+    PART_STATE_SUFFIX
+
+
+class MockServer:
+    """
+    在后台线程运行的本地HTTP服务器。每个请求交给 responder(handler) 处理，
+    handler 上可以使用 send(status, body, headers)；所有请求头按顺序记录在 requests 中。
+    """
+
+    def __init__(self, responder):
+        self.responder = responder
+        self.requests = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def send(self, status, body=b"", headers=None):
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                with server._lock:
+                    server.requests.append((self.command, dict(self.headers)))
+                server.responder(self)
+
+            do_GET = do_POST = do_HEAD = _handle
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def count(self, command):
+        with self._lock:
+            return sum(1 for method, _headers in self.requests if method == command)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def mock_server():
+    servers = []
+
+    def start(responder):
+        server = MockServer(responder)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def chat_reply(content):
+    return json.dumps({"choices": [{"message": {"content": content}}]}).encode("utf-8")
+
+
+def make_engine(server, max_retries=3, max_concurrency=4):
+    client = AIWrapper(provider="openai", api_key="test-key", model="test-model", base_url=server.url)
+    return AIExecutionEngine(client, max_concurrency=max_concurrency, max_retries=max_retries, backoff_factor=0.01,
+                             status_callback=lambda msg, level="INFO": None)
+
+
+# --- AI 执行引擎 ---
+
+def test_engine_honours_retry_after_and_reduces_concurrency(mock_server):
+    def responder(handler):
+        if server.count("POST") == 1:
+            handler.send(429, b'{"error": {"message": "slow down"}}', {"Retry-After": "1"})
+        else:
+            handler.send(200, chat_reply("ok"))
+
+    server = mock_server(responder)
+    engine = make_engine(server)
+    started = time.monotonic()
+    assert engine.process("hello") == "ok"
+    assert time.monotonic() - started >= 0.9
+    assert server.count("POST") == 2
+    assert engine.concurrency.limit == 2
+
+
+def test_engine_retries_server_errors(mock_server):
+    def responder(handler):
+        if server.count("POST") <= 2:
+            handler.send(503, b"unavailable")
+        else:
+            handler.send(200, chat_reply("recovered"))
+
+    server = mock_server(responder)
+    assert make_engine(server).process("hello") == "recovered"
+    assert server.count("POST") == 3
+
+
+def test_engine_does_not_retry_client_errors(mock_server):
+    server = mock_server(lambda handler: handler.send(400, b'{"error": {"message": "bad request"}}'))
+    with pytest.raises(AIServiceError) as error:
+        make_engine(server).process("hello")
+    assert error.value.status_code == 400
+    assert server.count("POST") == 1
+
+
+# --- AI 服务池 ---
+
+def test_pool_fails_over_to_healthy_endpoint(mock_server):
+    broken = mock_server(lambda handler: handler.send(503, b"unavailable"))
+    healthy = mock_server(lambda handler: handler.send(200, chat_reply("fine")))
+    endpoints = [PoolEndpoint("broken", make_engine(broken, max_retries=0)),
+                 PoolEndpoint("healthy", make_engine(healthy, max_retries=0))]
+    pool = AIProviderPool(endpoints, max_retries=1, backoff_factor=0.01,
+                          status_callback=lambda msg, level="INFO": None)
+
+    results = pool.map([f"text {i}" for i in range(20)])
+    assert results == ["fine"] * 20
+    stats = {item["endpoint"]: item for item in pool.get_stats()}
+    assert stats["healthy"]["failures"] == 0
+    # 出错的端点进入冷却期，暂不再分配请求
+    assert stats["broken"]["failures"] == broken.count("POST") >= 1
+    assert not endpoints[0].is_available()
+
+
+def test_pool_does_not_cool_down_on_client_errors(mock_server):
+    server = mock_server(lambda handler: handler.send(400, b'{"error": {"message": "bad row"}}'))
+    endpoint = PoolEndpoint("only", make_engine(server, max_retries=0))
+    pool = AIProviderPool([endpoint], max_retries=2, status_callback=lambda msg, level="INFO": None)
+    with pytest.raises(AIServiceError):
+        pool.process("bad")
+    assert server.count("POST") == 1
+    assert endpoint.is_available()
+
+
+# --- 下载引擎 ---
+
+def make_file_responder(state):
+    """支持 HEAD、Range 与 If-Range 的静态文件服务器；state['drop_first'] 为真时第一次 GET 只发送一半内容。"""
+
+    def responder(handler):
+        body, etag = state["body"], state["etag"]
+        headers = {"ETag": etag, "Accept-Ranges": "bytes"}
+        if handler.command == "HEAD":
+            handler.send(200, body, headers)
+            return
+        range_header = handler.headers.get("Range")
+        if_range = handler.headers.get("If-Range")
+        if range_header and (if_range is None or if_range == etag):
+            start = int(range_header.split("=")[1].split("-")[0])
+            content_range = f"bytes {start}-{len(body) - 1}/{len(body)}"
+            handler.send(206, body[start:], {**headers, "Content-Range": content_range})
+            return
+        if state.pop("drop_first", False):
+            handler.send_response(200)
+            handler.send_header("Content-Length", str(len(body)))
+            handler.send_header("ETag", etag)
+            handler.end_headers()
+            handler.wfile.write(body[:len(body) // 2])
+            handler.close_connection = True
+            return
+        handler.send(200, body, headers)
+
+    return responder
+
+
+def download(server, path):
+    engine = DownloadEngine(max_retries=3, backoff_factor=0.01, segments=1)
+    with engine:
+        return engine.fetch(f"{server.url}/file.bin", path, status_callback=lambda msg: None)
+
+
+def test_download_resumes_with_range_after_connection_drop(mock_server, tmp_path):
+    state = {"body": os.urandom(200_000), "etag": '"v1"', "drop_first": True}
+    server = mock_server(make_file_responder(state))
+    target = str(tmp_path / "file.bin")
+
+    result = download(server, target)
+    assert result["status"] == DOWNLOAD_STATUS_DOWNLOADED
+    with open(target, "rb") as f:
+        assert f.read() == state["body"]
+    range_requests = [headers for method, headers in server.requests if method == "GET" and "Range" in headers]
+    assert range_requests and range_requests[0]["If-Range"] == '"v1"'
+    assert not os.path.exists(target + PART_SUFFIX + PART_STATE_SUFFIX)
+
+
+def test_download_discards_partial_file_when_remote_changed(mock_server, tmp_path):
+    state = {"body": b"B" * 5000, "etag": '"v2"'}
+    server = mock_server(make_file_responder(state))
+    target = str(tmp_path / "file.bin")
+    # 上次运行留下的 .part 属于旧版本（长度相同），不能拼接到新版本上
+    with open(target + PART_SUFFIX, "wb") as f:
+        f.write(b"A" * 2000)
+    with open(target + PART_SUFFIX + PART_STATE_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump({"validator": '"v1"', "size": 5000}, f)
+
+    result = download(server, target)
+    assert result["status"] == DOWNLOAD_STATUS_DOWNLOADED
+    with open(target, "rb") as f:
+        assert f.read() == state["body"]
+    assert all("Range" not in headers for method, headers in server.requests if method == "GET")
+
+
+def test_download_resumes_partial_file_of_same_version(mock_server, tmp_path):
+    state = {"body": b"C" * 5000, "etag": '"v1"'}
+    server = mock_server(make_file_responder(state))
+    target = str(tmp_path / "file.bin")
+    with open(target + PART_SUFFIX, "wb") as f:
+        f.write(b"C" * 2000)
+    with open(target + PART_SUFFIX + PART_STATE_SUFFIX, "w", encoding="utf-8") as f:
+        json.dump({"validator": '"v1"', "size": 5000}, f)
+
+    assert download(server, target)["status"] == DOWNLOAD_STATUS_DOWNLOADED
+    with open(target, "rb") as f:
+        assert f.read() == state["body"]
+    gets = [headers for method, headers in server.requests if method == "GET"]
+    assert len(gets) == 1 and gets[0]["Range"] == "bytes=2000-" and gets[0]["If-Range"] == '"v1"'